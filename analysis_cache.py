@@ -0,0 +1,142 @@
+# -----------------------------------------------------------
+# コメント分析結果の永続キャッシュ（app.py / analyze_video_comments.py 共通）
+# -----------------------------------------------------------
+# キー = 正規化したコメント本文 + プロンプトのバージョン + モデル名 + temperature のハッシュ。
+# SQLiteに保存するので、プロセスを再起動しても同じコメントはOpenAIに再送しない。
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+import unicodedata
+
+DEFAULT_CACHE_PATH = os.path.join(".cache", "analysis_cache.sqlite3")
+DEFAULT_TTL_SECONDS = 30 * 24 * 60 * 60  # 30日
+DEFAULT_MAX_ENTRIES = 200_000
+EVICT_EVERY = 100  # 書き込み何回ごとにLRU削除を走らせるか（開いたときにも1回走らせる）
+
+
+def normalize_comment_text(text):
+    # 全角/半角の揺れ・前後の空白・連続空白を吸収する
+    s = unicodedata.normalize("NFKC", str(text or ""))
+    return " ".join(s.split())
+
+
+def make_cache_key(comment_text, prompt_version, model, temperature):
+    payload = json.dumps(
+        [normalize_comment_text(comment_text), str(prompt_version), str(model), float(temperature)],
+        ensure_ascii=False,
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class AnalysisCache:
+    def __init__(self, path=DEFAULT_CACHE_PATH, ttl_seconds=DEFAULT_TTL_SECONDS, max_entries=DEFAULT_MAX_ENTRIES):
+        self.path = path
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._writes = 0
+        self._lock = threading.Lock()
+
+        if path != ":memory:":
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        # Streamlitのワーカースレッドからも使うので check_same_thread=False + ロックで保護
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        with self._lock:
+            if path != ":memory:":
+                self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS analysis_cache (
+                    key TEXT PRIMARY KEY,
+                    value TEXT NOT NULL,
+                    created_at REAL NOT NULL,
+                    accessed_at REAL NOT NULL
+                )
+                """
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS idx_analysis_cache_accessed ON analysis_cache(accessed_at)")
+            self._conn.commit()
+        # 書き込みの回数はプロセスごとに数え直すので、短い実行を繰り返しても上限を守れるよう開いたときにも削除する
+        # （20万件で数十ミリ秒）
+        self.evict()
+
+    def get(self, comment_text, prompt_version, model, temperature):
+        key = make_cache_key(comment_text, prompt_version, model, temperature)
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT value, created_at FROM analysis_cache WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            value, created_at = row
+            if self.ttl_seconds is not None and now - created_at > self.ttl_seconds:
+                self._conn.execute("DELETE FROM analysis_cache WHERE key = ?", (key,))
+                self._conn.commit()
+                self.misses += 1
+                return None
+            self._conn.execute("UPDATE analysis_cache SET accessed_at = ? WHERE key = ?", (now, key))
+            self._conn.commit()
+            self.hits += 1
+        return json.loads(value)
+
+    def set(self, comment_text, prompt_version, model, temperature, analysis):
+        key = make_cache_key(comment_text, prompt_version, model, temperature)
+        now = time.time()
+        value = json.dumps(analysis, ensure_ascii=False)
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO analysis_cache (key, value, created_at, accessed_at) VALUES (?, ?, ?, ?)",
+                (key, value, now, now),
+            )
+            self._writes += 1
+            if self._writes % EVICT_EVERY == 0:
+                self._evict_locked(now)
+            self._conn.commit()
+
+    def _evict_locked(self, now):
+        # 期限切れ → 件数上限を超えた分を最終アクセスが古い順に削除
+        if self.ttl_seconds is not None:
+            self._conn.execute("DELETE FROM analysis_cache WHERE created_at < ?", (now - self.ttl_seconds,))
+        if self.max_entries is not None:
+            self._conn.execute(
+                """
+                DELETE FROM analysis_cache WHERE key IN (
+                    SELECT key FROM analysis_cache ORDER BY accessed_at DESC LIMIT -1 OFFSET ?
+                )
+                """,
+                (self.max_entries,),
+            )
+
+    def evict(self):
+        with self._lock:
+            self._evict_locked(time.time())
+            self._conn.commit()
+
+    def stats(self):
+        with self._lock:
+            entries = self._conn.execute("SELECT COUNT(*) FROM analysis_cache").fetchone()[0]
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": (self.hits / total) if total else 0.0,
+            "entries": entries,
+        }
+
+
+def cache_from_env():
+    # .env から設定を上書きできるようにする
+    path = os.getenv("ANALYSIS_CACHE_PATH", DEFAULT_CACHE_PATH)
+    ttl = os.getenv("ANALYSIS_CACHE_TTL_SECONDS")
+    max_entries = os.getenv("ANALYSIS_CACHE_MAX_ENTRIES")
+    return AnalysisCache(
+        path=path,
+        ttl_seconds=int(ttl) if ttl else DEFAULT_TTL_SECONDS,
+        max_entries=int(max_entries) if max_entries else DEFAULT_MAX_ENTRIES,
+    )
@@ -1,197 +1,526 @@
 # -----------------------------------------------------------
 # ステップ1：ライブラリの読み込みとAPIキーの設定
 # -----------------------------------------------------------
+# Streamlit には依存しない（共通処理は core.py）。pandas / tqdm / googleapiclient / openai は
+# 実際に使う関数の中で読み込み、クライアントも最初のAPI呼び出しまで作らない（--help や再開時の起動を速くする）
 from dotenv import load_dotenv
+import argparse
+import asyncio
 import os
-from googleapiclient.discovery import build
-from openai import OpenAI
-import pandas as pd
-import json
-from tqdm import tqdm
-import time
+import re
+import core
+from analysis_cache import cache_from_env
+from async_engine import engine_from_env, stream_jobs
+from batch_analysis import (
+    DEFAULT_BATCH_SIZE, OUTPUT_TOKENS_PER_COMMENT, SCORES_OUTPUT_TOKENS_PER_COMMENT, is_valid_analysis, pack_batches,
+    scores_response_format,
+)
+from batch_backend import (
+    DEFAULT_POLL_SECONDS, LocalBatchBackend, OpenAIBatchBackend, iter_batch_results, pending_inputs, run_batch_file,
+    write_batch_inputs,
+)
+from checkpoint import CommentCheckpoint
+from dedup import DuplicateIndex
+from local_model import local_model_from_env
+from metrics import METRICS
+from prompts import format_usage, template_from_env
 
 # .envファイルから環境変数を読み込む
 load_dotenv()
 
-# YouTube Data APIキー
-try:
-    YOUTUBE_API_KEY = os.getenv('YOUTUBE_API_KEY')
-    if not YOUTUBE_API_KEY:
-        raise ValueError("YOUTUBE_API_KEY が .env ファイルに見つかりません。")
-    youtube = build('youtube', 'v3', developerKey=YOUTUBE_API_KEY)
+# YouTube Data APIキー / OpenAI APIキー
+YOUTUBE_API_KEY = os.getenv('YOUTUBE_API_KEY')
+if YOUTUBE_API_KEY:
     print("✅ YouTube APIキーの読み込みに成功しました。")
-except Exception as e:
-    print(f"🛑 YouTube APIキーの読み込みエラー: {e}")
-
-# OpenAI APIキー
-try:
-    OPENAI_API_KEY = os.getenv('OPENAI_API_KEY')
-    if not OPENAI_API_KEY:
-        raise ValueError("OPENAI_API_KEY が .env ファイルに見つかりません。")
-    client = OpenAI(api_key=OPENAI_API_KEY)
+else:
+    print("🛑 YouTube APIキーの読み込みエラー: YOUTUBE_API_KEY が .env ファイルに見つかりません。")
+OPENAI_API_KEY = os.getenv('OPENAI_API_KEY')
+if OPENAI_API_KEY:
     print("✅ OpenAI APIキーの読み込みに成功しました。")
-except Exception as e:
-    print(f"🛑 OpenAI APIキーの読み込みエラー: {e}")
+else:
+    print("🛑 OpenAI APIキーの読み込みエラー: OPENAI_API_KEY が .env ファイルに見つかりません。")
+
+# クライアントは最初に使うときに作る。同じページの再取得はキャッシュから返す（app.py と同じSQLiteファイルを共有）
+services = core.Services(YOUTUBE_API_KEY, OPENAI_API_KEY)
+youtube_cache = services.youtube_cache
+# 返信は一緒に返った分で足りないスレッドだけ並列に取得する（YOUTUBE_REPLIES=0 で取得しない）
+reply_fetcher = core.reply_fetcher_from_env()
+
+# 分析結果キャッシュ（app.py と同じSQLiteファイルを共有する）
+MODEL_NAME = "gpt-4o-mini"
+TEMPERATURE = 0.3
+# 分析プロンプト（app.py と共通のテンプレート）。版は文言から自動で決まり、分析キャッシュ・保存結果のキーに含まれる
+PROMPT = template_from_env()
+PROMPT_VERSION = PROMPT.version
+analysis_cache = cache_from_env()
+analyzer = core.Analyzer(services, MODEL_NAME, TEMPERATURE, PROMPT, analysis_cache)
 
 # -----------------------------------------------------------
 # ステップ3：YouTubeコメント取得関数
 # -----------------------------------------------------------
-def get_youtube_comments(video_id, max_comments=200):
-    comments = []
-    try:
-        request = youtube.commentThreads().list(
-            part="snippet",
-            videoId=video_id,
-            maxResults=100,
-            textFormat="plainText",
-            order="relevance"  # ★人気順で取得
-        )
-
-        while request and len(comments) < max_comments:
-            response = request.execute()
-            for item in response["items"]:
-                comment = item["snippet"]["topLevelComment"]["snippet"]["textDisplay"]
-                comments.append(comment)
-            request = youtube.commentThreads().list_next(request, response)
-
-        print(f"✅ {len(comments)}件のコメントを取得しました。")
-        return comments[:max_comments]
-    except Exception as e:
-        print(f"🛑 コメント取得エラー: {e}")
-        return []
+def iter_youtube_comment_pages(video_id, max_comments=200):
+    # 1ページ（最大100スレッド）ずつコメントを返す。取得エラーはそのまま呼び出し側へ
+    # 各コメントは {"id", "text", "published_at", "like_count", "parent_id"} の辞書（返信は親コメントの直後）
+    return core.iter_comment_pages(
+        youtube_cache, video_id, max_comments=max_comments, order="relevance", replies=reply_fetcher
+    )  # ★人気順で取得
 
 # -----------------------------------------------------------
 # ステップ4：GPTによるコメント分析関数（★Colabの定義をそのまま使用）
 # -----------------------------------------------------------
-def analyze_comment(comment_text):
-    prompt = f"""
-    あなたはYouTubeコメントを分析する専門家です。
-    以下のルールに【厳密に】従って、指定されたYouTubeコメントを6つの特徴量で分析し、JSON形式で出力してください。
-    コメントの表面上の意味だけでなく、文脈的・反語的な意味（例：「良い動画なのでいいねを二回押しました！」などの皮肉表現）も考慮して評価してください。
-
-    # 分析ルール
-
-    ##  1. 攻撃性 (Aggressiveness)
-    - **何を測るか**: コメントに含まれる、他者への直接的な敵意、侮辱、脅迫の度合い。
-    - **レベル0: なし**: 敬意が払われている、もしくは中立的。無礼な言葉遣いが一切含まれない。（例: 「いつも動画ありがとうございます。」）
-    - **レベル1: 低**: 相手を小馬鹿にする、見下すような表現。直接的な暴言ではないが、無礼で相手を不快にさせる可能性がある。（例: 「そんなことも知らないの？」）
-    - **レベル2: 中**: 特定の個人や意見に対する直接的な悪口、人格否定、嘲笑。「バカ」「キモい」など、明確な敵意や侮辱が含まれる。（例: 「こいつマジで頭悪いな。」）
-    - **レベル3: 高**: 脅迫、ヘイトスピーチ、自殺の教唆など、心身の安全を脅かす表現。（例: 「こういう奴は社会から消えろ。」）
-
-    ##  2. 挑発性 (Provocation)
-    - **何を測るか**: 皮肉、嫌味、決めつけ、煽りなど、相手の感情を逆撫でして反応を引き出そうとする意図の度合い。
-    - **レベル0: なし**: 誠実でストレートな表現。裏の意図を感じさせない。（例: 「編集お疲れ様です！」）
-    - **レベル1: 低**: 軽度の皮肉や嫌味。分かる人には分かるが、文字通り受け取ることもできるような、曖昧さを含む表現。（例: 「謝罪動画でがっぽり稼げてよかったね。」）
-    - **レベル2: 中**: 明確な「上から目線」、レッテル貼り、意図的な揚げ足取り。「信者」「アンチ」などの言葉を使い、対立を煽る。（例: 「信者さんたちが必死に擁護してて草。」）
-    - **レベル3: 高**: 議論を破壊し、場を荒らすことを目的とした悪質な煽り。（例: 「はい論破。反論できないなら俺の勝ちね。」）
-
-    ##  3. 有用性 (Usefulness)
-    - **何を測るか**: 動画の内容や他の視聴者に対して、有益な価値を提供している度合い。
-    - **レベル0: なし**: 「草」「好き」など、中身のない相槌や単なる感情表現。（例: 「草」）
-    - **レベル1: 低**: 具体的な根拠のない、個人の感想や漠然とした意見。（例: 「今回の動画面白くなかったな。」）
-    - **レベル2: 中**: 具体的な指摘、改善提案、根拠のある意見、体験談など、参考になる情報を含む。（例: 「BGMが大きすぎてナレーションが聞き取りづらかったです。」）
-    - **レベル3: 高**: 専門的な知識に基づく深い分析、データや出典を用いた客観的な訂正など、極めて価値の高い情報を含む。（例: 「この件、〇〇という法律の第△条に抵触する可能性があります。」）
-
-    ##  4. 感情極性 (Sentiment Polarity)
-    - **何を測るか**: コメント全体の感情的なトーン。
-    - **レベル-2: 強いネガティブ**: 強い怒り、憎しみ、軽蔑など。（例: 「史上最悪の動画。時間の無駄だった。」）
-    - **レベル-1: ネガティブ**: 批判、失望、不満など。（例: 「期待してた内容と違って少し残念でした。」）
-    - **レベル0: 中立**: 事実の記述、質問など、感情的な色合いがほとんどない。（例: 「この商品はどこで買えますか？」）
-    - **レベル+1: ポジティブ**: 好意、感謝、賞賛など。（例: 「面白かったです！次回の動画も楽しみにしています！」）
-    - **レベル+2: 強いポジティブ**: 感動、熱狂、深い感謝など。（例: 「感動で涙が出ました。一生ついていきます！」）
-
-    ##  5. 自己顕示性 (Self-display / Superiority)
-    - **何を測るか**: 自分の知識や経験などをアピールし、優位に立とうとする意図の度合い。
-    - **レベル0: なし**: 自分をアピールする意図が見られない。（例: 「この考え方は面白いですね。」）
-    - **レベル1: 低**: 話題に関連した自分の体験談や知識を、補足情報として共有している。（例: 「私が昔〇〇に行った時も同じような感じでしたよ。」）
-    - **レベル2: 中**: 投稿者の説明に対し、訂正や補足という形で、より専門的な知識や自身の成功体験を披露し、暗に優位性を示している。（例: 「インデックス投資は初心者向けですよね。僕はそれで資産8桁いきました。」）
-    - **レベル3: 高**: 経歴、年収などを提示し、他者を直接的・間接的に見下す。（例: 「年収〇〇万以下の人はこの動画見ても意味ないよ。」）
-
-    ##  6. 文脈依存性 (Context-dependency / In-groupness)
-    - **何を測るか**: 内輪にしか真意が伝わらない、専門用語や内輪ネタがどの程度含まれているか。
-    - **レベル0: なし**: 誰が読んでも理解できる、一般的で平易な言葉遣い。（例: 「今日の夕飯はカレーにしようと思います。」）
-    - **レベル1: 低**: 過去の動画での出来事に言及しているが、文脈を知らなくても大意は推測できる。（例: 「前回の動画で言ってた〇〇の件、解決してよかった！」）
-    - **レベル2: 中**: ファンの間だけで通じる愛称、ミーム、決まり文句などが使われており、初見には意味が分かりにくい。（例: 「さすが〇〇さん（ファンの愛称）、今日も平常運転で安心した。」）
-    - **レベル3: 高**: 背景知識がなければ、コメントの意味を全く理解できない。（例: 「今日の動画は完全に『例のあの件』だな…」）
-    
-    最後に総合コメントとして、なぜそのように評価をしたのか説明をしてください。
-
-    # 出力フォーマット（JSON）
-    必ず **有効なJSON形式** で出力してください。
-    数値には「+」を付けず、引用符の閉じ忘れやコメントは入れないでください。
-    {{
-      "攻撃性": {{"score": 0-3 }},
-      "挑発性": {{"score": 0-3 }},
-      "有用性": {{"score": 0-3 }},
-      "感情極性": {{"score": -2〜+2 }},
-      "自己顕示性": {{"score": 0-3 }},
-      "文脈依存性": {{"score": 0-3 }},
-      "総合コメント": "..."
-    }}
-
-    # 分析対象コメント
-    {comment_text}
-    """
-
-    try:
-        response = client.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=[{"role": "user", "content": prompt}],
-            temperature=0.3
-        )
-        raw_output = response.choices[0].message.content.strip()
-
-        try:
-            result = json.loads(raw_output)
-        except json.JSONDecodeError:
-            result = {"raw_output": raw_output}
-        return result
-
-    except Exception as e:
-        return {"error": str(e)}
+# 分析処理は app.py と共通の core.Analyzer（temperature だけCLI用の値）
+call_model = analyzer.call_model
+analysis_params = analyzer.params
+parse_model_output = analyzer.parse_model_output
+analyze_comment = analyzer.analyze_comment
+analyze_comment_async = analyzer.analyze_comment_async
+analyze_comments_batch_async = analyzer.analyze_comments_batch_async
 
 # -----------------------------------------------------------
 # ステップ5：全コメントを一括分析してCSV保存
 # -----------------------------------------------------------
-def analyze_video_comments(video_url, max_comments=200, save_path="analyzed_comments.csv"):
-    # URLから動画IDを抽出
-    video_id = None
+def extract_video_id(video_url):
+    # URL（watch?v= / youtu.be/）または動画IDそのものを受け付ける
+    video_url = video_url.strip()
     if "v=" in video_url:
-        video_id = video_url.split("v=")[-1].split("&")[0]
-    elif "youtu.be/" in video_url:
-         video_id = video_url.split("youtu.be/")[-1].split("?")[0]
-    
+        return video_url.split("v=")[-1].split("&")[0]
+    if "youtu.be/" in video_url:
+        return video_url.split("youtu.be/")[-1].split("?")[0]
+    if re.fullmatch(r"[A-Za-z0-9_-]{11}", video_url):
+        return video_url
+    return None
+
+@METRICS.timed("analysis_run")
+async def analyze_video_async(engine, video_id, max_comments=200, batch_size=DEFAULT_BATCH_SIZE, checkpoint=None,
+                              on_progress=None, scores_only=False, on_planned=None):
+    # 1本の動画を取得しながら分析する。engine は `async with` 済みのものを渡す（複数動画で共有可）
+    # checkpoint（CommentCheckpoint）を渡すと、分析済みコメントを追記し、前回分は分析を飛ばす
+    # ページを取得するそばから分析に回す（YouTubeの取得待ちとGPTの待ち時間を重ねる）
+    # 重複・類似コメントは代表1件だけを分析し、結果をグループ全員に配る
+    # on_planned(n) はページごとに分析に回す代表コメントの数、on_progress(n) は分析を終えた代表コメントの数
+    # （重複の数や返信の数は取得するまで分からないので、進捗の分母は on_planned で足していく）
+    comments = []
+    fetch_errors = []
+    dup_index = DuplicateIndex()
+    analyzed = {}
+    done = checkpoint.load() if checkpoint is not None else {}
+
+    def page_jobs():
+        try:
+            for page in iter_youtube_comment_pages(video_id, max_comments):
+                reps = []
+                for c in page:
+                    comments.append(c)
+                    group, is_new = dup_index.add(c["text"])
+                    if c["id"] in done and group not in analyzed:
+                        # 前回の実行で分析済み
+                        analyzed[group] = done[c["id"]]
+                    elif is_new:
+                        reps.append(len(comments) - 1)
+                if reps and on_planned is not None:
+                    on_planned(len(reps))
+                yield [
+                    [reps[i] for i in b]
+                    for b in pack_batches(
+                        [comments[i]["text"] for i in reps], batch_size=batch_size,
+                        fixed_tokens=PROMPT.fixed_tokens("scores_batch" if scores_only else "batch"),
+                        output_tokens_per_comment=SCORES_OUTPUT_TOKENS_PER_COMMENT if scores_only else OUTPUT_TOKENS_PER_COMMENT,
+                        max_comment_tokens=PROMPT.comment_token_budget,
+                    )
+                ]
+        except Exception as e:
+            METRICS.record_error("get_comments", e)
+            fetch_errors.append(e)
+
+    def on_batch_done(idxs, analyses):
+        for i, analysis in zip(idxs, analyses):
+            analyzed[dup_index.group_of[i]] = analysis
+        if checkpoint is not None:
+            checkpoint.append([(comments[i]["id"], a) for i, a in zip(idxs, analyses) if is_valid_analysis(a)])
+        if on_progress is not None:
+            on_progress(len(idxs))
+
+    await stream_jobs(
+        engine, page_jobs(),
+        lambda eng, idxs: analyze_comments_batch_async([comments[i]["text"] for i in idxs], eng, scores_only),
+        on_done=on_batch_done
+    )
+    return comments, dup_index, analyzed, fetch_errors
+
+@METRICS.timed("normalize")
+def build_records(comments, dup_index, analyzed, prompt_version=None):
+    # 入力（人気順）と同じ順番の1コメント1行のレコード
+    # prompt_version を渡すと（一括ジョブの Parquet 用）コメントID・返信先のID・投稿日時・プロンプト版の列も付ける
+    sizes = dup_index.group_sizes()
+    results = []
+    for i, c in enumerate(comments):
+        group = dup_index.group_of[i]
+        analysis = analyzed.get(group) or {"error": "未分析"}
+        record = {}
+        if prompt_version is not None:
+            record.update({
+                "comment_id": c["id"], "parent_id": c.get("parent_id"), "published_at": c.get("published_at"),
+                "prompt_version": prompt_version,
+            })
+        record.update({"コメント": c["text"], "重複数": sizes[group]})
+        record.update({k: v.get("score", None) if isinstance(v, dict) else v for k, v in analysis.items()})
+        results.append(record)
+    return results
+
+def count_failed_groups(dup_index, analyzed):
+    # 分析できなかった（タイムアウト・APIエラー・締め切り切れなど）代表コメントの数
+    return sum(1 for group in range(len(dup_index.members)) if not is_valid_analysis(analyzed.get(group)))
+
+def print_usage_summary(engine=None):
+    if engine is not None:
+        print(f"🧮 OpenAI使用量（{PROMPT_VERSION}）: {format_usage(engine.stats, MODEL_NAME)}")
+        if engine.stats["timeouts"] or engine.stats["hedged"]:
+            print(
+                f"⏱️ タイムアウト {engine.stats['timeouts']} 回 / ヘッジ {engine.stats['hedged']} 回"
+                f"（先着 {engine.stats['hedge_wins']} 回）"
+            )
+    stats = analysis_cache.stats()
+    print(f"🗄️ 分析キャッシュ: ヒット {stats['hits']} / ミス {stats['misses']}（保存件数 {stats['entries']}）")
+    if analyzer.local_model is not None:
+        print(
+            f"🧠 ローカルモデル: 採点 {METRICS.counter_total('local_model', outcome='scored')} 件"
+            f" / GPTへ {METRICS.counter_total('local_model', outcome='deferred')} 件"
+        )
+    quota = youtube_cache.ledger()
+    print(f"📺 YouTube APIクォータ（本日）: 消費 {quota['units_spent']} / キャッシュで節約 {quota['units_saved']} units")
+    stages = METRICS.snapshot()["stages"]
+    if stages:
+        print("⏱️ 区間ごとの時間: " + " / ".join(
+            f"{name} {m['count']}回 計{m['total_seconds']:.1f}s（p95 {m['p95_seconds'] * 1000:.0f}ms）"
+            for name, m in sorted(stages.items(), key=lambda kv: -kv[1]["total_seconds"])
+        ))
+    print(
+        f"⚠️ エラー {METRICS.counter_total('errors')} 件 / パース失敗 {METRICS.counter_total('parse_failures')} 件"
+        f" / リトライ {METRICS.counter_total('openai_retries')} 回"
+    )
+
+def grow_total(pbar):
+    # 進捗バーの分母を、分析に回す代表コメントが分かるたびに増やす（重複をまとめた後の件数で数える）
+    def on_planned(n):
+        pbar.total += n
+        pbar.refresh()
+    return on_planned
+
+def analyze_video_comments(video_url, max_comments=200, save_path="analyzed_comments.csv", batch_size=DEFAULT_BATCH_SIZE,
+                           scores_only=False, run_timeout=None):
+    import pandas as pd
+    from tqdm import tqdm
+
+    # URLから動画IDを抽出
+    video_id = extract_video_id(video_url)
     if not video_id:
         print("⚠️ 無効なYouTube URLです。")
         return
 
-    comments = get_youtube_comments(video_id, max_comments)
-    if not comments:
-        print("コメントが取得できなかったため、処理を終了します。")
-        return
+    engine = engine_from_env(OPENAI_API_KEY, MODEL_NAME, TEMPERATURE, run_timeout=run_timeout)
 
-    results = []
+    async def _main(pbar):
+        async with engine:
+            return await analyze_video_async(
+                engine, video_id, max_comments=max_comments, batch_size=batch_size, on_progress=pbar.update,
+                scores_only=scores_only, on_planned=grow_total(pbar)
+            )
 
-    for c in tqdm(comments, desc="Analyzing comments"):
-        analysis = analyze_comment(c)
-        time.sleep(0.5)  # API制限対策
+    with tqdm(total=0, desc="Analyzing comments") as pbar:
+        comments, dup_index, analyzed, fetch_errors = asyncio.run(_main(pbar))
 
-        record = {"コメント": c}
-        record.update({k: v.get("score", None) if isinstance(v, dict) else v for k, v in analysis.items()})
-        results.append(record)
+    if fetch_errors:
+        print(f"🛑 コメント取得エラー: {fetch_errors[0]}")
+    if not comments:
+        print("コメントが取得できなかったため、処理を終了します。")
+        return
+    print(f"✅ {len(comments)}件のコメントを取得しました。（重複をまとめてGPTに送ったのは {len(dup_index.members)} 件）")
 
-    df = pd.DataFrame(results)
+    df = pd.DataFrame(build_records(comments, dup_index, analyzed))
     df.to_csv(save_path, index=False)
     print(f"✅ 分析結果を {save_path} に保存しました。")
+    failed = count_failed_groups(dup_index, analyzed)
+    if failed:
+        print(f"⚠️ {failed} グループを分析できませんでした（理由は error 列）。もう一度実行すると失敗した分だけGPTに送り直します。")
+    print_usage_summary(engine)
     return df
 
+# -----------------------------------------------------------
+# ステップ5-2：複数動画の一括ジョブ（チェックポイントから再開可能）
+# -----------------------------------------------------------
+def read_video_list(path):
+    # 1行に1つのURLまたは動画ID。空行と # で始まる行は無視
+    video_ids = []
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            video_id = extract_video_id(line)
+            if video_id is None:
+                print(f"⚠️ 無効なYouTube URLのためスキップします: {line}")
+            elif video_id not in video_ids:
+                video_ids.append(video_id)
+    return video_ids
+
+def partition_path(out_dir, video_id):
+    return os.path.join(out_dir, f"video_id={video_id}", "part-0.parquet")
+
+def write_partition(df, path):
+    # 書き込み途中のファイルを完了扱いしないよう、一時ファイルに書いてから置き換える
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = path + ".tmp"
+    df.to_parquet(tmp_path, index=False)
+    os.replace(tmp_path, path)
+
+def pending_videos(list_path, out_dir, force=False):
+    video_ids = read_video_list(list_path)
+    todo = [v for v in video_ids if force or not os.path.exists(partition_path(out_dir, v))]
+    print(f"🎬 {len(video_ids)} 本中 {len(todo)} 本を処理します（出力先: {out_dir}）")
+    return todo
+
+def run_batch(list_path, out_dir="output", checkpoint_dir=None, max_comments=200,
+              batch_size=DEFAULT_BATCH_SIZE, parallel_videos=4, force=False, scores_only=False, run_timeout=None):
+    # 複数動画を並行に処理する。OpenAIのレート制限（エンジン）は全動画で共有する
+    # 出力は <out_dir>/video_id=<ID>/part-0.parquet（pd.read_parquet(out_dir) で video_id 列付きで読める）
+    # 出力済みの動画は --force が無ければ飛ばす
+    import pandas as pd
+    from tqdm import tqdm
+
+    checkpoint_dir = checkpoint_dir or os.path.join(out_dir, "_checkpoints")
+    todo = pending_videos(list_path, out_dir, force)
+    if not todo:
+        return {}
+
+    engine = engine_from_env(OPENAI_API_KEY, MODEL_NAME, TEMPERATURE, run_timeout=run_timeout)
+    version = analysis_params(scores_only)[0]
+    summary = {}
+
+    async def _one(video_id, sem, pbar):
+        async with sem:
+            comments, dup_index, analyzed, fetch_errors = await analyze_video_async(
+                engine, video_id, max_comments=max_comments, batch_size=batch_size,
+                checkpoint=CommentCheckpoint(checkpoint_dir, video_id, version), on_progress=pbar.update,
+                scores_only=scores_only, on_planned=grow_total(pbar)
+            )
+        if fetch_errors:
+            # 途中までの分析結果はチェックポイントに残っているので、再実行でそこから再開できる
+            summary[video_id] = f"🛑 コメント取得エラー（再実行で再開できます）: {fetch_errors[0]}"
+            return
+        if not comments:
+            summary[video_id] = "⚠️ コメントなし"
+            return
+        records = build_records(comments, dup_index, analyzed, prompt_version=version)
+        await asyncio.to_thread(write_partition, pd.DataFrame(records), partition_path(out_dir, video_id))
+        failed = count_failed_groups(dup_index, analyzed)
+        # 成功した分はチェックポイントにあるので、--force で再実行すると失敗した分だけ分析し直す
+        summary[video_id] = f"✅ {len(records)} 件" + (f"（分析失敗 {failed} グループ・--force で再実行できます）" if failed else "")
+
+    async def _main(pbar):
+        sem = asyncio.Semaphore(parallel_videos)
+        async with engine:
+            await asyncio.gather(*[_one(v, sem, pbar) for v in todo])
+
+    with tqdm(total=0, desc="Analyzing comments") as pbar:
+        asyncio.run(_main(pbar))
+
+    for video_id in todo:
+        print(f"{video_id}: {summary.get(video_id)}")
+    print_usage_summary(engine)
+    return summary
+
+# -----------------------------------------------------------
+# ステップ5-3：OpenAI Batch API で一括分析（夜間ジョブ向け・同期APIより安い）
+# -----------------------------------------------------------
+def ingest_batch_output(output_path, checkpoint_dir, texts, scores_only=False, batch_pricing=True):
+    # 出力JSONLを1行ずつ読み、動画ごとのチェックポイントへ追記する（custom_id = "<動画ID>:<コメントID>"）
+    # 応答は parse_model_output で読み（コードブロックの除去なども同じ）、本文が分かるものは分析キャッシュにも入れる
+    # （前回の実行で提出したバッチは本文が分からないので、パースだけしてチェックポイントに入れる）
+    # トークン使用量は METRICS に記録する（batch_pricing=True なら Batch API の割引料金で計算）
+    results = {}
+    ok = failed = 0
+    for custom_id, content, error, usage in iter_batch_results(output_path):
+        video_id, _, comment_id = (custom_id or "").partition(":")
+        if usage:
+            cached = (usage.get("prompt_tokens_details") or {}).get("cached_tokens")
+            METRICS.record_usage(
+                MODEL_NAME, usage.get("prompt_tokens"), usage.get("completion_tokens"), cached, batch=batch_pricing
+            )
+        analysis = None
+        if content is not None:
+            analysis = parse_model_output(texts.get(custom_id), content, scores_only=scores_only)
+        else:
+            METRICS.count("batch_api_errors")
+        if not is_valid_analysis(analysis):
+            failed += 1
+            continue
+        results.setdefault(video_id, []).append((comment_id, analysis))
+        ok += 1
+    for video_id, items in results.items():
+        CommentCheckpoint(checkpoint_dir, video_id, analysis_params(scores_only)[0]).append(items)
+    return ok, failed
+
+def run_offline_batch(list_path, out_dir="output", checkpoint_dir=None, max_comments=200, force=False,
+                      backend=None, work_dir=None, poll_seconds=DEFAULT_POLL_SECONDS, scores_only=False):
+    # 1) 前回提出したまま取り込めていないバッチがあれば、先にその結果を待って取り込む
+    # 2) 全動画のコメントを取得・重複をまとめ、チェックポイント/キャッシュに無い代表コメントだけを
+    #    Batch API の入力JSONLに書いて提出 → 完了待ち → 取り込み
+    # 3) チェックポイントから動画ごとの Parquet を書く
+    import pandas as pd
+
+    checkpoint_dir = checkpoint_dir or os.path.join(out_dir, "_checkpoints")
+    work_dir = work_dir or os.path.join(out_dir, "_batch_api")
+    backend = backend or OpenAIBatchBackend(services.openai)
+    version = analysis_params(scores_only)[0]
+
+    def on_status(status):
+        print(f"⏳ バッチ {status['id']}: {status['state']}（{status['completed']}/{status['total']} 件完了, 失敗 {status['failed']}）")
+
+    def run_and_ingest(input_path, texts):
+        output_path = run_batch_file(backend, input_path, poll_seconds=poll_seconds, on_status=on_status)
+        ok, failed = ingest_batch_output(output_path, checkpoint_dir, texts, scores_only, backend.batch_pricing)
+        print(f"📥 {os.path.basename(input_path)}: {ok} 件を取り込みました（失敗 {failed} 件）")
+        os.remove(output_path)
+        os.remove(input_path)
+
+    for input_path in pending_inputs(work_dir):
+        print(f"🔁 前回のバッチ {os.path.basename(input_path)} の結果を待ちます")
+        run_and_ingest(input_path, {})
+
+    todo = pending_videos(list_path, out_dir, force)
+    summary = {}
+    videos = {}
+    requests = []
+    texts = {}
+    for video_id in todo:
+        try:
+            comments = [c for page in iter_youtube_comment_pages(video_id, max_comments) for c in page]
+        except Exception as e:
+            METRICS.record_error("get_comments", e)
+            summary[video_id] = f"🛑 コメント取得エラー: {e}"
+            continue
+        if not comments:
+            summary[video_id] = "⚠️ コメントなし"
+            continue
+        done = CommentCheckpoint(checkpoint_dir, video_id, version).load()
+        dup_index = DuplicateIndex()
+        for c in comments:
+            dup_index.add(c["text"])
+        for members in dup_index.members:
+            if any(comments[i]["id"] in done for i in members):
+                continue
+            rep = comments[members[0]]
+            if analysis_cache.get(rep["text"], *analysis_params(scores_only)) is not None:
+                continue
+            local = analyzer.score_locally(rep["text"])
+            if local is not None:
+                # 確信度の高いコメントは提出せず、ローカルの採点をチェックポイントに書いておく
+                CommentCheckpoint(checkpoint_dir, video_id, version).append([(rep["id"], local)])
+                continue
+            custom_id = f"{video_id}:{rep['id']}"
+            requests.append((custom_id, PROMPT.single(rep["text"], scores_only=scores_only)))
+            texts[custom_id] = rep["text"]
+        videos[video_id] = (comments, dup_index)
+
+    print(f"📤 Batch API に {len(requests)} 件のリクエストを提出します")
+    response_format = scores_response_format() if scores_only else None
+    for input_path in write_batch_inputs(requests, work_dir, MODEL_NAME, TEMPERATURE, response_format=response_format):
+        run_and_ingest(input_path, texts)
+
+    for video_id, (comments, dup_index) in videos.items():
+        done = CommentCheckpoint(checkpoint_dir, video_id, version).load()
+        analyzed = {}
+        failed = 0
+        for group, members in enumerate(dup_index.members):
+            analysis = next((done[comments[i]["id"]] for i in members if comments[i]["id"] in done), None)
+            if analysis is None:
+                analysis = analysis_cache.get(comments[members[0]]["text"], *analysis_params(scores_only))
+            if analysis is None:
+                failed += 1
+                analysis = {"error": "Batch API で分析できませんでした"}
+            analyzed[group] = analysis
+        records = build_records(comments, dup_index, analyzed, prompt_version=version)
+        write_partition(pd.DataFrame(records), partition_path(out_dir, video_id))
+        summary[video_id] = f"✅ {len(records)} 件" + (f"（分析失敗 {failed} グループ）" if failed else "")
+
+    for video_id in todo:
+        print(f"{video_id}: {summary.get(video_id)}")
+    usage = {f"{kind}_tokens": METRICS.counter_total("tokens", model=MODEL_NAME, kind=kind) for kind in ("prompt", "completion", "cached")}
+    print(
+        f"🧮 OpenAI使用量（{'Batch API' if backend.batch_pricing else '同期API'}・{version}）: "
+        f"{format_usage(usage, MODEL_NAME, batch=backend.batch_pricing)}"
+    )
+    print_usage_summary()
+    return summary
+
+def complete_request(body):
+    # --batch-api local 用：Batch API の1リクエストを同期APIで呼び、Batch API の出力と同じ形（choices・usage）で返す
+    resp = services.openai.chat.completions.create(**body)
+    usage = resp.usage
+    details = getattr(usage, "prompt_tokens_details", None)
+    return {
+        "choices": [{"index": 0, "message": {"role": "assistant", "content": resp.choices[0].message.content}}],
+        "usage": None if usage is None else {
+            "prompt_tokens": usage.prompt_tokens,
+            "completion_tokens": usage.completion_tokens,
+            "total_tokens": usage.total_tokens,
+            "prompt_tokens_details": {"cached_tokens": getattr(details, "cached_tokens", None) or 0},
+        },
+    }
+
 # -----------------------------------------------------------
 # ステップ6：実行（このファイルが直接実行された時だけ動く）
 # -----------------------------------------------------------
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="YouTubeコメント一括分析スクリプト")
+    parser.add_argument("--batch", metavar="FILE", help="動画URL/IDを1行に1つ書いたファイル（複数動画をまとめて処理）")
+    parser.add_argument("--out-dir", default="output", help="一括ジョブの出力先（動画ごとのParquet）")
+    parser.add_argument("--checkpoint-dir", default=None, help="チェックポイントの保存先（省略時は <out-dir>/_checkpoints）")
+    parser.add_argument("--max-comments", type=int, default=None, help="1動画あたりの最大コメント数")
+    parser.add_argument("--parallel-videos", type=int, default=4, help="同時に処理する動画数")
+    parser.add_argument("--force", action="store_true", help="出力済みの動画も処理し直す")
+    parser.add_argument("--scores-only", action="store_true", help="6つのスコアだけを出力させる（高速・低コスト、総合コメントなし）")
+    parser.add_argument("--batch-api", nargs="?", const="openai", choices=("openai", "local"), default=None,
+                        help="--batch の分析に OpenAI Batch API を使う（24時間以内に完了・低コスト）。"
+                             "local なら同じ入出力ファイルを同期APIで処理する（動作確認用・割引なし）")
+    parser.add_argument("--run-timeout", type=float, default=None, metavar="SECONDS",
+                        help="GPTの応答を待つ実行全体の上限（秒）。過ぎた分は分析失敗として出力に残す")
+    parser.add_argument("--poll-seconds", type=int, default=DEFAULT_POLL_SECONDS, help="Batch API の完了確認の間隔（秒）")
+    parser.add_argument("--no-local-model", action="store_true",
+                        help="ローカルモデル（python local_model.py train で学習）を使わず全件GPTで分析する")
+    parser.add_argument("--metrics-out", metavar="FILE", default=os.getenv("METRICS_OUT"),
+                        help="計測結果の書き出し先（.json なら JSON、それ以外は Prometheus テキスト形式）")
+    args = parser.parse_args()
+
     print("YouTubeコメント一括分析スクリプト")
-    video_url = input("🎥 分析したいYouTube動画のURLを入力してください：")
-    if video_url:
-        df = analyze_video_comments(video_url, max_comments=50) # テスト用に50件に設定
-        if df is not None:
-            print(df.head())
\ No newline at end of file
+    if not args.no_local_model:
+        analyzer.local_model = local_model_from_env(PROMPT_VERSION)
+        if analyzer.local_model is not None:
+            print("🧠 確信度の高いコメントはローカルモデルで採点します（--no-local-model で無効）")
+    if args.batch and args.batch_api:
+        backend = None
+        if args.batch_api == "local":
+            backend = LocalBatchBackend(os.path.join(args.out_dir, "_batch_api", "local"), complete_request)
+        run_offline_batch(
+            args.batch, out_dir=args.out_dir, checkpoint_dir=args.checkpoint_dir,
+            max_comments=args.max_comments or 200, force=args.force, backend=backend, poll_seconds=args.poll_seconds,
+            scores_only=args.scores_only
+        )
+    elif args.batch:
+        run_batch(
+            args.batch, out_dir=args.out_dir, checkpoint_dir=args.checkpoint_dir,
+            max_comments=args.max_comments or 200, parallel_videos=args.parallel_videos, force=args.force,
+            scores_only=args.scores_only, run_timeout=args.run_timeout
+        )
+    else:
+        video_url = input("🎥 分析したいYouTube動画のURLを入力してください：")
+        if video_url:
+            df = analyze_video_comments(
+                video_url, max_comments=args.max_comments or 50, scores_only=args.scores_only, run_timeout=args.run_timeout
+            ) # テスト用に50件に設定
+            if df is not None:
+                print(df.head())
+
+    if args.metrics_out:
+        METRICS.write(args.metrics_out)
+        print(f"📈 計測結果を {args.metrics_out} に保存しました。")
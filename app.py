@@ -1,13 +1,29 @@
 import streamlit as st
-import pandas as pd
-from googleapiclient.discovery import build
-from openai import OpenAI
 from dotenv import load_dotenv
 import os
 import time
 import json
 import re
-import concurrent.futures
+import uuid
+import core
+from analysis_cache import cache_from_env
+from async_engine import engine_from_env, run_streaming_jobs, stream_jobs
+from batch_analysis import DEFAULT_BATCH_SIZE, OUTPUT_TOKENS_PER_COMMENT, SCORES_OUTPUT_TOKENS_PER_COMMENT, is_valid_analysis, pack_batches
+from dedup import DuplicateIndex
+from jobs import DONE, FAILED, QUEUED, runner_from_env
+from local_model import SOURCE as LOCAL_SOURCE, local_model_available, local_model_from_env
+from metrics import METRICS
+from prefetch import DEFAULT_TOP_VIDEOS, executor_from_env, prefetcher_from_env
+from prompts import format_usage, template_from_env
+from sampling import (
+    DEFAULT_MAX_SAMPLE, DEFAULT_SCAN_LIMIT, DEFAULT_TARGET_MARGIN, FIRST_ROUND_SIZE, STRATA, StratifiedSampler,
+    estimate_share, next_sample_size,
+)
+from shared_results import SharedResult, frame_nbytes, shared_results_from_env
+from video_state import is_known, state_from_env, watermark
+# pandas / pyarrow（result_store, score_index, export）と googleapiclient / openai は
+# 使う場面（分析・結果表示・API呼び出し）で初めて読み込む。検索画面だけなら読み込まないので起動が速い
+# NumPy は dedup / local_model / sampling が使うので起動時に読み込む（サイドバーでローカルモデルの有無を確かめるため）
 
 # 1. 環境設定 ---------------------------------------------------------
 load_dotenv()
@@ -21,16 +37,97 @@ if not YOUTUBE_API_KEY or not OPENAI_API_KEY:
     st.error("❌ APIキーが見つかりません。.env に YOUTUBE_API_KEY と OPENAI_API_KEY を設定してください。")
     st.stop()
 
-# キャッシュを利用してリソースの再確保を防ぐ
+# キャッシュを利用してリソースの再確保を防ぐ（クライアント自体は最初に使うときに作られる）
 @st.cache_resource
 def get_services():
-    yt = build("youtube", "v3", developerKey=YOUTUBE_API_KEY)
-    ai = OpenAI(api_key=OPENAI_API_KEY)
-    return yt, ai
+    return core.Services(YOUTUBE_API_KEY, OPENAI_API_KEY)
 
-youtube, client = get_services()
+@st.cache_resource
+def get_analysis_cache():
+    return cache_from_env()
+
+@st.cache_resource
+def get_video_state():
+    return state_from_env()
+
+# 分析結果はセッションをまたいで共有する（同じ動画・設定の分析は1回だけ実行し、結果のメモリも1つ）
+@st.cache_resource
+def get_shared_results():
+    return shared_results_from_env()
+
+# 分析はスクリプトの実行とは別のスレッド（ジョブ）で動かす。プロセスで1つ
+@st.cache_resource
+def get_job_runner():
+    return runner_from_env()
+
+# 返信を並列に取得するスレッド（全セッション共通）。YOUTUBE_REPLIES=0 なら None（返信を取得しない）
+@st.cache_resource
+def get_reply_fetcher():
+    return core.reply_fetcher_from_env()
+
+# 検索画面の先読みを行うスレッド（全セッション共通）。先読みの世代と予算はセッションごと
+@st.cache_resource
+def get_prefetch_executor():
+    return executor_from_env()
+
+services = get_services()
+analysis_cache = get_analysis_cache()
+youtube_cache = services.youtube_cache
+reply_fetcher = get_reply_fetcher()
+video_state = get_video_state()
+shared_results = get_shared_results()
+job_runner = get_job_runner()
+if "prefetcher" not in st.session_state:
+    st.session_state["prefetcher"] = prefetcher_from_env(get_prefetch_executor())
+prefetcher = st.session_state["prefetcher"]
+# 分析ジョブの購読者としてのこのセッションのID（同じジョブに何度合流しても1人として数える）
+if "session_id" not in st.session_state:
+    st.session_state["session_id"] = uuid.uuid4().hex
+session_id = st.session_state["session_id"]
 
 # 2. 定数・ヘルパー関数 ----------------------------------
+MODEL_NAME = "gpt-4o-mini"
+TEMPERATURE = 0.2
+# 分析プロンプト（CLIと共通のテンプレート）。版は文言から自動で決まり、分析キャッシュ・保存結果のキーに含まれる
+PROMPT = template_from_env()
+PROMPT_VERSION = PROMPT.version
+analyzer = core.Analyzer(services, MODEL_NAME, TEMPERATURE, PROMPT, analysis_cache)
+# 分析中の途中経過を描画する間隔（行数 / 秒）
+RENDER_CHUNK_ROWS = 20
+RENDER_INTERVAL_SECONDS = 1.0
+# 「新着コメントだけ分析」で1回に取得する最大件数
+NEW_COMMENTS_LIMIT = 1000
+# 分析ジョブの状態・途中経過を見に行く間隔（秒）
+JOB_POLL_SECONDS = 1.0
+# 1回の分析でGPTの応答を待つ上限（秒）。過ぎたら残りは「分析できなかったコメント」として表示する
+ANALYSIS_RUN_TIMEOUT_SECONDS = 300
+# 検索結果の上位何件の動画のコメントを先読みするか / 何件を先に分析しておくか（GPTを使うので既定は0）
+PREFETCH_TOP_VIDEOS = int(os.getenv("PREFETCH_TOP_VIDEOS", DEFAULT_TOP_VIDEOS))
+PREFETCH_ANALYSES = int(os.getenv("PREFETCH_ANALYSES", "0"))
+# 結果表示の1ページあたりの件数
+PAGE_SIZES = [50, 100, 200, 500]
+DEFAULT_PAGE_SIZE = 100
+# 「似たコメントを探す」で表に出す最大件数 / 「似たコメントのまとまり」の数
+SIMILAR_MAX_ROWS = 500
+DEFAULT_CLUSTERS = 10
+MAX_CLUSTERS = 50
+
+# サイドバーのプリセット（特徴量 → 許容レンジ）。サンプリング推定ではプリセットごとに割合を推定する
+PRESET_RANGES = {
+    "フィルタなし": {
+        "攻撃性": (0,3), "挑発性": (0,3), "有用性": (0,3), "感情極性": (-2,2),
+        "自己顕示性": (0,3), "文脈依存性": (0,3)
+    },
+    "平和モード": {
+        "攻撃性": (0,1), "挑発性": (0,1), "有用性": (0,3), "感情極性": (0,2),
+        "自己顕示性": (0,3), "文脈依存性": (0,3)
+    },
+    "議論モード": {
+        "攻撃性": (0,2), "挑発性": (0,2), "有用性": (1,3), "感情極性": (-2,2),
+        "自己顕示性": (0,3), "文脈依存性": (0,3)
+    },
+}
+
 FEATURES = [
     {"key": "攻撃性", "min": 0, "max": 3, "desc": "他者への直接的な敵意・侮辱・脅迫の度合い。0=なし, 3=高"},
     {"key": "挑発性", "min": 0, "max": 3, "desc": "皮肉・煽り等で反応を引き出す度合い。0=なし, 3=高"},
@@ -91,6 +188,8 @@ def normalize_analysis_to_row(analysis):
             reasons.append(f"{k}：{reason}")
     if model_overall and isinstance(model_overall, str) and model_overall.strip():
         overall = model_overall
+    elif isinstance(analysis, dict) and analysis.get("error") and not reasons:
+        overall = f"分析失敗: {analysis['error']}"
     else:
         if reasons:
             overall = "モデル理由に基づく総合コメント — " + "；".join(reasons[:6])
@@ -104,174 +203,418 @@ def normalize_analysis_to_row(analysis):
     row["総合コメント"] = overall
     return row
 
+@st.fragment(run_every=JOB_POLL_SECONDS)
+def render_job_progress(job_id, video_id):
+    # 実行中のジョブの進捗と途中経過を描画する（この部分だけを一定間隔で再実行する）
+    job = job_runner.get(job_id)
+    if job is None or job.finished:
+        # 終わったらページ全体を再実行して結果を取り込む
+        st.rerun()
+    counters, partial = job.snapshot()
+    if job.state == QUEUED:
+        st.info(f"⏳ 分析の順番待ちです（同時に実行できる分析は {job_runner.max_workers} 件）")
+    st.progress(job.progress())
+    st.caption(
+        f"⏳ バックグラウンドで分析中（{job.elapsed():.0f}秒）: 分析済み {counters.get('done', 0)} 件"
+        f"（GPT送信 {counters.get('sent', 0)} 件）/ 取得済み {counters.get('fetched', 0)} 件"
+        "　※ 他の画面に移っても分析は続きます"
+    )
+    if counters.get("note"):
+        st.caption(counters["note"])
+    if partial is not None:
+        st.dataframe(partial.tail(RENDER_CHUNK_ROWS), use_container_width=True)
+    if st.button("⏹ 分析を中止", key=f"cancel_{job_id}"):
+        # 同じ分析を見ている他のセッションがあれば、ジョブは止めずにこのセッションだけ抜ける
+        job_runner.cancel(job_id, session_id)
+        st.session_state["analysis_jobs"].pop(video_id, None)
+        st.session_state["analysis_df_raw"] = partial
+        st.session_state["analysis_index"] = None
+        st.session_state["analysis_similar"] = None
+        st.session_state["sample_meta"] = None
+        st.rerun()
+
+def watch_job(video_id, job_id):
+    # この動画で見るジョブを切り替える。前に見ていた別のジョブは購読をやめる（誰も見ていなければ中止される）
+    jobs = st.session_state.setdefault("analysis_jobs", {})
+    previous = jobs.pop(video_id, None)
+    if previous is not None and previous != job_id:
+        job_runner.cancel(previous, session_id)
+    if job_id is not None:
+        jobs[video_id] = job_id
+
+def adopt_finished_job(job):
+    # 終わったジョブの結果をこのセッションの表示対象にする
+    if job is None:
+        st.warning("分析ジョブが見つかりませんでした（時間が経って破棄された可能性があります）。もう一度実行してください。")
+    elif job.state == DONE:
+        out = job.result
+        st.session_state["analysis_df_raw"] = out["shared"].df
+        st.session_state["analysis_index"] = out["shared"].index
+        st.session_state["analysis_similar"] = out["shared"].similar
+        st.session_state["sample_meta"] = out["shared"].meta
+        for message in out["warnings"]:
+            st.warning(message)
+        st.success(out["message"])
+        st.caption(out["usage"])
+    elif job.state == FAILED:
+        st.error(f"❌ {job.error}")
+
 # 3. API関連関数 ---------------------------------------
 
 def search_videos(query, max_results=6, page_token=None):
     try:
-        req = youtube.search().list(
-            part="snippet", q=query, type="video",
-            videoEmbeddable="true", maxResults=max_results, order="relevance",
-            pageToken=page_token 
-        )
-        res = req.execute()
+        return core.search_videos(youtube_cache, query, max_results=max_results, page_token=page_token)
     except Exception as e:
+        METRICS.record_error("search_videos", e)
         st.error(f"検索エラー: {e}")
         return [], None
-    
-    results = []
-    for item in res.get("items", []):
-        vid = item.get("id", {}).get("videoId")
-        if not vid: continue
-        snip = item.get("snippet", {})
-        results.append({
-            "title": snip.get("title"),
-            "video_id": vid,
-            "thumbnail": snip.get("thumbnails", {}).get("medium", {}).get("url")
-        })
-    
-    next_token = res.get("nextPageToken")
-    return results, next_token
 
-def get_comments(video_id, max_comments=120):
-    comments = []
-    try:
-        request = youtube.commentThreads().list(
-            part="snippet",
-            videoId=video_id,
-            maxResults=100,
-            textFormat="plainText",
-            order="relevance"
-        )
-        
-        while request and len(comments) < max_comments:
-            response = request.execute()
-            for item in response.get("items", []):
-                try:
-                    c = item["snippet"]["topLevelComment"]["snippet"]["textDisplay"]
-                    comments.append(c)
-                    if len(comments) >= max_comments:
-                        break
-                except KeyError:
-                    continue
-            
-            if len(comments) < max_comments:
-                request = youtube.commentThreads().list_next(request, response)
-            else:
-                break
-                
-    except Exception as e:
-        st.warning(f"コメント取得エラー: {e}")
-        return []
-    
-    return comments[:max_comments]
-
-def analyze_comment(comment_text):
-    prompt = f"""
-    あなたはYouTubeコメントを分析する専門家です。
-    以下のルールに【厳密に】従って、指定されたYouTubeコメントを6つの特徴量で分析し、JSON形式で出力してください。
-    文脈や皮肉（反語）も考慮して評価してください。
-
-    # 分析ルール（YouTubeコメントの実態に即した評価基準）
-
-    ## 1. 攻撃性 (Aggressiveness)
-    他者への敵意、侮辱、暴言の強さ。
-    - **0: なし**: 敬意がある、または中立的。
-    - **1: 低**: 小馬鹿にする、見下すような表現。
-    - **2: 中**: 明確な悪口、強い嘲笑。
-    - **3: 高**: **非常に激しい敵意、人格否定、または執拗な攻撃。**
-
-    ## 2. 挑発性 (Provocation)
-    皮肉、煽りなど、相手を感情的にさせる意図。
-    - **0: なし**: 誠実でストレートな表現。
-    - **1: 低**: 軽度の皮肉や嫌味。
-    - **2: 中**: 上から目線、レッテル貼り。
-    - **3: 高**: **相手を激昂させることを主目的とした強い煽り。**
-
-    ## 3. 有用性 (Usefulness)
-    視聴者や動画にとって有益な価値があるか。
-    - **0: なし**: 中身のない相槌、単なる感情表現。
-    - **1: 低**: 根拠のない個人の感想。
-    - **2: 中**: 具体的な指摘、改善提案。
-    - **3: 高**: **非常に論理的で、独自の深い視点に基づき、議論に貢献するコメント。**
-
-    ## 4. 感情極性 (Sentiment Polarity)
-    - **-2: 強いネガティブ**
-    - **-1: ネガティブ**
-    - **0: 中立**
-    - **+1: ポジティブ**
-    - **+2: 強いポジティブ**
-
-    ## 5. 自己顕示性 (Self-display)
-    自分を優位に見せようとする意図。
-    - **0: なし**
-    - **1: 低**: 文脈に沿った自分語り。
-    - **2: 中**: 知識や経験をひけらかす。
-    - **3: 高**: **他者を見下すことで自分を上げる表現。露骨なマウント。**
-
-    ## 6. 文脈依存性 (Context-dependency)
-    背景知識が必要か。
-    - **0: なし**: 誰でもわかる。
-    - **1: 低**: 推測可能。
-    - **2: 中**: ファン用語、ミーム。
-    - **3: 高**: **深い知識がないと理解不可。**
-
-    最後に総合コメントとして、評価理由を簡潔に説明してください。
-
-    # 出力フォーマット（JSON）
-    必ず **有効なJSON形式** で出力してください。
-    {{
-      "攻撃性": {{"score": 0-3 }},
-      "挑発性": {{"score": 0-3 }},
-      "有用性": {{"score": 0-3 }},
-      "感情極性": {{"score": -2〜+2 }},
-      "自己顕示性": {{"score": 0-3 }},
-      "文脈依存性": {{"score": 0-3 }},
-      "総合コメント": "..."
-    }}
-
-    # 分析対象コメント
-    {comment_text}
-    """
-    try:
-        resp = client.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=[{"role":"user", "content": prompt}],
-            temperature=0.2
+def prefetch_search_page(ticket, query, page_token):
+    # 「もっと動画を読み込む」と同じ引数で取得してキャッシュに入れておく
+    core.search_videos(youtube_cache, query, max_results=12, page_token=page_token, should_fetch=ticket.fetch_guard(youtube_cache))
+
+def prefetch_comment_pages(ticket, video_id):
+    # 「コメント分析を実行」と同じ引数でコメントのページを取得してキャッシュに入れておく
+    for _ in core.iter_comment_pages(
+        youtube_cache, video_id, max_comments=120, should_fetch=ticket.fetch_guard(youtube_cache), replies=reply_fetcher
+    ):
+        pass
+
+def analysis_share_key(mode, scores_only, use_local_model):
+    # 共有結果・ジョブの合流のキー（取得方法＋プロンプトの版・モデル・temperature＋ローカルモデルの有無）
+    return mode + analysis_params(scores_only) + (use_local_model,)
+
+def schedule_prefetch(query, videos, page_token):
+    # 検索結果を描画した後で、次に押されそうなものを裏で取得しておく（同じクエリの間は同じものを1回だけ）
+    if page_token:
+        prefetcher.submit(f"search:{page_token}", prefetch_search_page, query, page_token)
+    for v in videos[:PREFETCH_TOP_VIDEOS]:
+        prefetcher.submit(f"comments:{v['video_id']}", prefetch_comment_pages, v["video_id"])
+    # 上位の動画の分析を先に始めておく（選んで「分析」を押すとこのジョブに合流する）。クエリが変わったら購読をやめる
+    for v in videos[:PREFETCH_ANALYSES]:
+        share_key = analysis_share_key((v["video_id"], "full", 120), scores_only, use_local_model)
+        name = f"analysis:{share_key}"
+        if name in st.session_state.setdefault("prefetched_analyses", set()) or shared_results.get(share_key) is not None:
+            continue
+        job = job_runner.submit(
+            run_analysis_job, v["video_id"], False, scores_only, int(batch_size), share_key, use_local_model,
+            key=share_key, label="prefetch", subscriber=f"{session_id}:prefetch"
         )
-        raw = resp.choices[0].message.content.strip()
-        
-        # Markdownのコードブロックを削除
-        raw = re.sub(r"```json", "", raw)
-        raw = re.sub(r"```", "", raw)
-        raw = raw.strip()
+        st.session_state["prefetched_analyses"].add(name)
+        # 先読みの購読はセッション本体とは別に数える（選んで合流した後でクエリが変わっても分析は止まらない）
+        prefetcher.on_reset(lambda job_id=job.id: job_runner.cancel(job_id, f"{session_id}:prefetch"))
+
+def iter_comment_pages(video_id, max_comments=120, order="relevance", max_age=None, with_replies=True, until=None):
+    # commentThreads を1ページ（最大100スレッド、返信は親コメントの直後）ずつ返すジェネレータ。取得エラーは呼び出し側で扱う
+    # with_replies=False ならトップレベルのコメントだけ（返信の取得にクォータを使わない）
+    return core.iter_comment_pages(
+        youtube_cache, video_id, max_comments=max_comments, order=order, max_age=max_age,
+        replies=reply_fetcher if with_replies else None, until=until,
+    )
+
+def iter_new_comment_pages(video_id, known_items, max_new=NEW_COMMENTS_LIMIT):
+    # 新着順に取得し、前回までに分析済みのスレッド（IDまたは投稿日時）に達したら打ち切る
+    # 返信は新しいスレッドの分だけ取得する（分析済みのスレッドの返信は取りに行かない）
+    known_ids = {c["id"] for c in known_items}
+    newest_seen = watermark(known_items)
+    return iter_comment_pages(
+        video_id, max_comments=max_new, order="time", max_age=0,
+        until=lambda c: is_known(c, known_ids, newest_seen),
+    )
 
+# 分析（バッチ・評価理由の後付け生成）は CLI と共通の core.Analyzer
+analysis_params = analyzer.params
+analyze_comments_batch_async = analyzer.analyze_comments_batch_async
+explain_scores = analyzer.explain_scores
+
+def run_analysis_job(job, vid, refresh, scores_only, batch_size, share_key, use_local_model=False):
+    # バックグラウンドのジョブとして実行する分析（別スレッドなので st.* は使わず、途中経過は job.update() で渡す）
+    from result_store import ResultStore, normalize_scores
+    from score_index import ScoreIndex
+    from similarity import SimilarityIndex
+
+    # ローカルモデルはジョブごとに読み込んで渡す（共有の analyzer は書き換えない）
+    local_model = local_model_from_env(PROMPT_VERSION) if use_local_model else None
+
+    state_version = analysis_params(scores_only)[0]
+    if refresh:
+        # 保存済みの結果はそのまま使い、前回以降の新着コメントだけを取得・分析する
+        base_items = video_state.load(vid, state_version)
+        pages = iter_new_comment_pages(vid, base_items)
+        max_comments = len(base_items) + NEW_COMMENTS_LIMIT
+    else:
+        base_items = []
+        pages = iter_comment_pages(vid, max_comments=120)
+        max_comments = 120
+    fetch_errors = []
+    fetched = []
+    texts_by_id = {}  # コメントID -> 本文（返信の行に親コメントの本文を付ける）
+    new_items = []
+    store = ResultStore()
+    last_render = [0.0, 0]  # 最後に途中経過を渡した時刻, そのときの件数
+    local_scored = [0]  # ローカルモデルで採点した代表コメントの数
+    failed_groups = set()  # タイムアウト・APIエラーなどで分析できなかった代表コメント
+    # 重複・類似コメントは代表1件だけ分析し、結果をグループ全員に配る
+    dup_index = DuplicateIndex()
+    # 似たコメントの検索用に、新しい重複グループの本文をページごとに索引へ足していく
+    similar = SimilarityIndex()
+    group_analysis = {}
+    group_scores = {}
+    emitted = {}
+
+    def set_group_analysis(group, analysis):
+        group_analysis[group] = analysis
+        with METRICS.span("normalize"):
+            group_scores[group] = normalize_scores(analysis, fallback=normalize_analysis_to_row)
+
+    def page_jobs():
+        # 取得できたページから順に、新しい代表コメントだけをバッチへ分割して分析に回す（中止されたら取得もやめる）
         try:
-            return json.loads(raw)
-        except json.JSONDecodeError:
-            return {"raw_output": raw}
+            for page in pages:
+                if job.cancelled:
+                    return
+                reps = []
+                for c in page:
+                    fetched.append(c)
+                    texts_by_id[c["id"]] = c["text"]
+                    group, is_new = dup_index.add(c["text"])
+                    if is_new:
+                        reps.append((group, c["text"]))
+                with METRICS.span("similarity_index", rows=len(reps)):
+                    similar.add([group for group, _ in reps], [text for _, text in reps])
+                yield [
+                    [reps[i] for i in b]
+                    for b in pack_batches(
+                        [text for _, text in reps], batch_size=batch_size,
+                        fixed_tokens=PROMPT.fixed_tokens("scores_batch" if scores_only else "batch"),
+                        output_tokens_per_comment=SCORES_OUTPUT_TOKENS_PER_COMMENT if scores_only else OUTPUT_TOKENS_PER_COMMENT,
+                        max_comment_tokens=PROMPT.comment_token_budget,
+                    )
+                ]
+        except Exception as e:
+            METRICS.record_error("get_comments", e)
+            fetch_errors.append(e)
+
+    def emit_members(group):
+        members = dup_index.members[group]
+        scores, overall = group_scores[group]
+        for idx in members[emitted.get(group, 0):]:
+            c = fetched[idx]
+            store.append(scores, overall, c["text"], group, parent=texts_by_id.get(c["parent_id"]) if c.get("parent_id") else None)
+            if "analysis" not in c:
+                new_items.append(dict(c, analysis=group_analysis[group]))
+        emitted[group] = len(members)
+
+    def flush_rows(force=False):
+        # 溜まった行をチャンク単位でDataFrame化し、途中経過としてジョブに渡す
+        pending = len(store) - last_render[1]
+        if pending == 0 or (not force and pending < RENDER_CHUNK_ROWS and time.time() - last_render[0] < RENDER_INTERVAL_SECONDS):
+            return
+        with METRICS.span("build_frame", rows=len(store)):
+            df = store.to_frame(group_sizes=dup_index.group_sizes())
+        job.update(partial=df, done=len(df), total=max(max_comments, len(df)), fetched=len(fetched), sent=len(group_scores))
+        last_render[0] = time.time()
+        last_render[1] = len(df)
+
+    def on_batch_done(batch, analyses):
+        for (group, text), analysis in zip(batch, analyses):
+            if isinstance(analysis, dict) and analysis.get("source") == LOCAL_SOURCE:
+                local_scored[0] += 1
+            if not is_valid_analysis(analysis):
+                failed_groups.add(group)
+            set_group_analysis(group, analysis)
+            emit_members(group)
+        flush_rows()
+
+    # 保存済みのコメントは分析済みとして先に並べる（新着の重複コメントもこの結果を使う）
+    for c in base_items:
+        fetched.append(c)
+        texts_by_id[c["id"]] = c["text"]
+        group, is_new = dup_index.add(c["text"])
+        if is_new:
+            set_group_analysis(group, c["analysis"])
+            similar.add([group], [c["text"]])
+    for group in list(group_scores):
+        emit_members(group)
+
+    engine = engine_from_env(OPENAI_API_KEY, MODEL_NAME, TEMPERATURE, run_timeout=ANALYSIS_RUN_TIMEOUT_SECONDS)
+    with METRICS.span("analysis_run", video=vid, refresh=refresh, scores_only=scores_only):
+        run_streaming_jobs(
+            engine, page_jobs(),
+            lambda eng, batch: analyze_comments_batch_async([text for _, text in batch], eng, scores_only, local_model),
+            on_done=on_batch_done, should_stop=lambda: job.cancelled
+        )
+    if job.cancelled:
+        return None
+    # 代表コメントの分析後に届いた重複コメントにも結果を配る
+    for group in group_scores:
+        emit_members(group)
+    flush_rows(force=True)
+
+    # 正しく分析できたものだけ保存し、次回の差分再分析の起点にする
+    video_state.save(vid, [c for c in new_items if c.get("id") and is_valid_analysis(c["analysis"])], state_version)
+
+    _, df = job.snapshot()
+    if df is None or len(df) == 0:
+        if fetch_errors:
+            raise RuntimeError(f"コメント取得エラー: {fetch_errors[0]}")
+        raise RuntimeError("コメントを取得できませんでした（コメント無効またはAPI制限の可能性）")
+    # 分析1回につき1度だけインデックスを作り、スライダー操作時はこれを引くだけにする
+    with METRICS.span("build_index", rows=len(df)):
+        index = ScoreIndex(df)
+    if refresh:
+        message = f"✅ 新着 {len(fetched) - len(base_items)} 件を分析し、保存済みの結果と合わせて {len(df)} 件になりました。"
+    else:
+        message = f"✅ {len(df)} 件のコメントを分析しました。"
+    n_replies = sum(1 for c in fetched if c.get("parent_id"))
+    if n_replies:
+        message += f"（うち返信 {n_replies} 件）"
+    warnings = [f"コメント取得エラー: {fetch_errors[0]}"] if fetch_errors else []
+    if failed_groups:
+        n_failed = sum(len(dup_index.members[g]) for g in failed_groups)
+        warnings.append(
+            f"{n_failed} 件のコメントを分析できませんでした（タイムアウト・APIエラーなど）。"
+            "結果の下の「分析できなかったコメント」に理由を表示しています。もう一度分析すると、失敗した分だけGPTに送り直します。"
+        )
+        # 失敗を含む結果は他のセッションと共有しない（次の分析で送り直せるように）
+        shared = SharedResult(share_key, df, index, frame_nbytes(df, index, similar), similar=similar)
+    else:
+        shared = shared_results.put(share_key, df, index, similar=similar)
+    usage = f"🧮 今回の分析（{PROMPT_VERSION}）: {format_usage(engine.stats, MODEL_NAME)}"
+    if local_scored[0]:
+        usage += f" / ローカルモデルで採点 {local_scored[0]} 件"
+    if engine.stats["timeouts"] or engine.stats["hedged"]:
+        usage += f" / タイムアウト {engine.stats['timeouts']} 回・ヘッジ {engine.stats['hedged']} 回（先着 {engine.stats['hedge_wins']} 回）"
+    return {"shared": shared, "message": message, "warnings": warnings, "usage": usage}
+
+def run_sampling_job(job, vid, sample_by, scan_limit, max_sample, target_margin, track_ranges, scores_only, batch_size,
+                     share_key, use_local_model=False):
+    # コメントの多い動画向け：流し読みしたコメントから層別に無作為抽出し、抽出した分だけ分析して割合を推定する
+    # track_ranges（[(名前, 閾値レンジ)]）の推定がすべて ±target_margin に収まるか、max_sample 件に達したら打ち切る
+    import asyncio
+
+    from result_store import ResultStore, normalize_scores, score_mask
+    from score_index import ScoreIndex
+    from similarity import SimilarityIndex
+
+    # ローカルモデルはジョブごとに読み込んで渡す（共有の analyzer は書き換えない）
+    local_model = local_model_from_env(PROMPT_VERSION) if use_local_model else None
+
+    # 1) 流し読み：新しい順に scan_limit 件まで取得し、層ごとの件数と抽出候補だけを持つ
+    # 返信は取らない（母集団＝スレッド数にして scan_limit と比べられるようにし、返信のクォータも使わない）
+    sampler = StratifiedSampler(sample_by, capacity=max_sample)
+    fetch_errors = []
+    try:
+        for page in iter_comment_pages(vid, max_comments=scan_limit, order="time", with_replies=False):
+            if job.cancelled:
+                return None
+            for c in page:
+                sampler.add(c)
+            job.update(done=0, total=max_sample, fetched=sampler.population, sent=0, note="コメントを流し読みしています")
     except Exception as e:
-        return {"error": str(e)}
+        METRICS.record_error("get_comments", e)
+        fetch_errors.append(e)
+    if sampler.population == 0:
+        if fetch_errors:
+            raise RuntimeError(f"コメント取得エラー: {fetch_errors[0]}")
+        raise RuntimeError("コメントを取得できませんでした（コメント無効またはAPI制限の可能性）")
+
+    # 2) 抽出した分を分析し、推定の誤差が目標に届くまで追加で抽出する
+    store = ResultStore()
+    similar = SimilarityIndex()
+    strata = []
+    state = {"df": None, "margin": 1.0}
+    full_ranges = {f["key"]: (f["min"], f["max"]) for f in FEATURES}
+
+    def on_batch_done(batch, analyses):
+        first = len(store)
+        for (stratum, c), analysis in zip(batch, analyses):
+            with METRICS.span("normalize"):
+                scores, overall = normalize_scores(analysis, fallback=normalize_analysis_to_row)
+            store.append(scores, overall, c["text"], len(store))
+            strata.append(stratum)
+        similar.add(list(range(first, len(store))), [c["text"] for _, c in batch])
+
+    def update_estimate():
+        with METRICS.span("build_frame", rows=len(store)):
+            df = store.to_frame(group_sizes=[1] * len(store))
+        df["層"] = strata
+        valid = score_mask(df, full_ranges)
+        margins = []
+        for _, ranges in track_ranges:
+            _, low, high, _ = estimate_share(score_mask(df, ranges), strata, valid, sampler.totals)
+            margins.append((high - low) / 2)
+        state["df"], state["margin"] = df, max(margins)
+        job.update(
+            partial=df, done=len(df), total=max_sample, fetched=sampler.population, sent=len(df),
+            note=f"🎲 推定の誤差 ±{state['margin'] * 100:.1f}ポイント（目標 ±{target_margin * 100:.0f}ポイント）",
+        )
+
+    async def _main(engine):
+        target = min(max_sample, FIRST_ROUND_SIZE)
+        async with engine:
+            while not job.cancelled:
+                drawn = sampler.draw(target)
+                if not drawn:
+                    break
+                batches = pack_batches(
+                    [c["text"] for _, c in drawn], batch_size=batch_size,
+                    fixed_tokens=PROMPT.fixed_tokens("scores_batch" if scores_only else "batch"),
+                    output_tokens_per_comment=SCORES_OUTPUT_TOKENS_PER_COMMENT if scores_only else OUTPUT_TOKENS_PER_COMMENT,
+                    max_comment_tokens=PROMPT.comment_token_budget,
+                )
+                await stream_jobs(
+                    engine, [[[drawn[i] for i in b] for b in batches]],
+                    lambda eng, batch: analyze_comments_batch_async([c["text"] for _, c in batch], eng, scores_only, local_model),
+                    on_done=on_batch_done, should_stop=lambda: job.cancelled
+                )
+                update_estimate()
+                if state["margin"] <= target_margin or len(store) >= max_sample or engine.expired():
+                    break
+                target = next_sample_size(len(store), state["margin"], target_margin, max_sample)
+
+    engine = engine_from_env(OPENAI_API_KEY, MODEL_NAME, TEMPERATURE, run_timeout=ANALYSIS_RUN_TIMEOUT_SECONDS)
+    with METRICS.span("analysis_run", video=vid, sample=sample_by, scores_only=scores_only):
+        asyncio.run(_main(engine))
+    if job.cancelled:
+        return None
+    df = state["df"]
+    if df is None or len(df) == 0:
+        raise RuntimeError("抽出したコメントを分析できませんでした")
+
+    with METRICS.span("build_index", rows=len(df)):
+        index = ScoreIndex(df)
+    meta = {
+        "population": sampler.population,
+        "totals": dict(sampler.totals),
+        "by": sample_by,
+        "target_margin": target_margin,
+        "scan_limited": sampler.population >= scan_limit,
+    }
+    warnings = [f"コメント取得エラー: {fetch_errors[0]}"] if fetch_errors else []
+    if meta["scan_limited"]:
+        warnings.append(f"流し読みの上限（{scan_limit:,} 件）に達したため、推定は新しい順の {scan_limit:,} 件についてのものです。")
+    if state["margin"] > target_margin:
+        warnings.append(
+            f"分析件数の上限（{max_sample:,} 件）までに誤差が目標に届きませんでした（±{state['margin'] * 100:.1f}ポイント）。"
+        )
+    if len(index.incomplete):
+        warnings.append(f"抽出したうち {len(index.incomplete)} 件を分析できませんでした（推定からは除いています）。")
+    message = f"✅ {sampler.population:,} 件を流し読みし、{STRATA[sample_by]}で層別に抽出した {len(df)} 件を分析しました。"
+    if fetch_errors or len(index.incomplete):
+        shared = SharedResult(share_key, df, index, frame_nbytes(df, index, similar), meta, similar)
+    else:
+        shared = shared_results.put(share_key, df, index, meta, similar)
+    usage = f"🧮 今回の分析（{PROMPT_VERSION}）: {format_usage(engine.stats, MODEL_NAME)}"
+    return {"shared": shared, "message": message, "warnings": warnings, "usage": usage}
 
 # 4. サイドバー設定 ---------------------------------------
 st.sidebar.header("🔧 フィルタ（閾値レンジ）設定")
 
-preset = st.sidebar.radio("プリセットを選ぶ", ["フィルタなし", "平和モード", "議論モード", "カスタム"], index=0)
+preset = st.sidebar.radio("プリセットを選ぶ", list(PRESET_RANGES) + ["カスタム"], index=0)
 
-if preset == "フィルタなし":
-    preset_ranges = {
-        "攻撃性": (0,3), "挑発性": (0,3), "有用性": (0,3), "感情極性": (-2,2),
-        "自己顕示性": (0,3), "文脈依存性": (0,3)
-    }
-elif preset == "平和モード":
-    preset_ranges = {
-        "攻撃性": (0,1), "挑発性": (0,1), "有用性": (0,3), "感情極性": (0,2),
-        "自己顕示性": (0,3), "文脈依存性": (0,3)
-    }
-elif preset == "議論モード":
-    preset_ranges = {
-        "攻撃性": (0,2), "挑発性": (0,2), "有用性": (1,3), "感情極性": (-2,2),
-        "自己顕示性": (0,3), "文脈依存性": (0,3)
-    }
+if preset in PRESET_RANGES:
+    preset_ranges = PRESET_RANGES[preset]
 else:
     preset_ranges = {f["key"]:(f["min"], f["max"]) for f in FEATURES}
 
@@ -293,6 +636,44 @@ with st.sidebar.expander("各特徴量の説明と閾値設定（範囲）", exp
         )
         threshold_ranges[key] = rng
 
+st.sidebar.header("⚙️ 分析設定")
+batch_size = st.sidebar.number_input(
+    "1リクエストあたりのコメント数（1=単発モード）", min_value=1, max_value=50, value=DEFAULT_BATCH_SIZE
+)
+scores_only = st.sidebar.checkbox(
+    "スコアのみで分析（高速・総合コメントは必要な行だけ後から生成）", value=False
+)
+# GPTの採点から学習したローカルモデル（python local_model.py train で作る）があれば、確信度の高いコメントはそれで採点する
+use_local_model = st.sidebar.checkbox(
+    "ローカルモデルで確信度の高いコメントを採点（GPT送信を削減）",
+    value=local_model_available(), disabled=not local_model_available()
+)
+
+cache_stats = analysis_cache.stats()
+st.sidebar.caption(
+    f"🗄️ 分析キャッシュ: {cache_stats['entries']}件保存 / ヒット {cache_stats['hits']} / ミス {cache_stats['misses']}"
+)
+quota = youtube_cache.ledger()
+st.sidebar.caption(
+    f"📺 YouTube APIクォータ（本日）: 消費 {quota['units_spent']} / キャッシュで節約 {quota['units_saved']} units"
+)
+shared_stats = shared_results.stats()
+st.sidebar.caption(
+    f"🤝 共有中の分析結果: {shared_stats['entries']}件 / {shared_stats['bytes'] / 2**20:.1f} MB"
+    f"（上限 {shared_stats['max_bytes'] / 2**20:.0f} MB）"
+)
+job_stats = job_runner.stats()
+st.sidebar.caption(
+    f"⏳ 分析ジョブ: 実行中 {job_stats['running']} / 順番待ち {job_stats['queued']}（同時実行 {job_stats['max_workers']}）"
+)
+if prefetcher.quota_units > 0:
+    st.sidebar.caption(
+        f"🔮 先読み: このクエリで {prefetcher.spent} / {prefetcher.quota_units} units"
+        f"（完了 {METRICS.counter_total('prefetch', outcome='done')} 件）"
+    )
+# 計測パネルは今回の実行分まで反映するため、ページの最後（7.）で中身を描く
+metrics_panel = st.sidebar.container()
+
 # 5. メインロジック ------------------------------
 
 if "selected_video_id" not in st.session_state:
@@ -313,8 +694,12 @@ if st.session_state["selected_video_id"] is None:
         search_btn = st.button("検索", use_container_width=True)
     
     if search_btn and query:
+        # クエリが変わったので、前のクエリの先読み（始まっていないもの・先に始めた分析）は取り消す
+        prefetcher.reset()
+        st.session_state["prefetched_analyses"] = set()
         st.session_state["search_results"] = []
         st.session_state["next_page_token"] = None
+        st.session_state["search_query"] = query
         results, token = search_videos(query, max_results=12) 
         st.session_state["search_results"] = results
         st.session_state["next_page_token"] = token
@@ -348,14 +733,17 @@ if st.session_state["selected_video_id"] is None:
         if st.session_state["next_page_token"]:
             st.divider()
             if st.button("⬇️ もっと動画を読み込む"):
+                # 結果を出したときのクエリで続きを取る（先読み済みならキャッシュから返る）
                 new_results, new_token = search_videos(
-                    query, max_results=12, page_token=st.session_state["next_page_token"]
+                    st.session_state.get("search_query", query), max_results=12, page_token=st.session_state["next_page_token"]
                 )
                 if new_results:
                     st.session_state["search_results"].extend(new_results)
                     st.session_state["next_page_token"] = new_token
                     st.rerun()
 
+        schedule_prefetch(st.session_state.get("search_query", query), videos, st.session_state["next_page_token"])
+
 # 【シーン2】動画選択後（分析画面）
 else:
     vid = st.session_state["selected_video_id"]
@@ -363,70 +751,317 @@ else:
     st.markdown(f"### 🎞️ 選択中: {st.session_state.get('selected_title','(no title)')}")
     st.video(f"https://www.youtube.com/watch?v={vid}")
 
-    if st.button("💬 コメント分析を実行（120件取得）"):
-        with st.spinner("コメントを取得してGPTで分析しています...（数十秒〜数分）"):
-            comments = get_comments(vid, max_comments=120)
-            if not comments:
-                st.error("コメントを取得できませんでした（コメント無効またはAPI制限の可能性）")
-            else:
-                rows = []
-                progress_bar = st.progress(0)
-                
-                with concurrent.futures.ThreadPoolExecutor(max_workers=10) as executor:
-                    future_to_comment = {executor.submit(analyze_comment, c): c for c in comments}
-                    
-                    for i, future in enumerate(concurrent.futures.as_completed(future_to_comment)):
-                        c = future_to_comment[future]
-                        try:
-                            analysis = future.result()
-                            row = normalize_analysis_to_row(analysis)
-                            row["コメント"] = c
-                            rows.append(row)
-                        except Exception as e:
-                            pass 
-                        
-                        progress_bar.progress((i + 1) / len(comments))
+    # 保存済みの結果は同じプロンプト版・モードのものだけを使う
+    state_version = analysis_params(scores_only)[0]
+    saved_count = video_state.count(vid, state_version)
+    col_run, col_refresh = st.columns(2)
+    with col_run:
+        run_full = st.button("💬 コメント分析を実行（120件取得）")
+    with col_refresh:
+        run_refresh = st.button(
+            f"🔄 新着コメントだけ分析（保存済み {saved_count} 件）", disabled=not saved_count,
+            help="前回の分析より後に投稿されたスレッドと、その返信だけを分析します。"
+                 "分析済みのスレッドに後から付いた返信は取り込まれないので、必要なら「コメント分析を実行」で分析し直してください。"
+        )
+    with st.expander("🎲 コメントの多い動画：サンプリングで推定"):
+        st.caption(
+            "コメントを流し読みして層別に無作為抽出し、抽出した分だけをGPTで分析して、"
+            "各プリセット（と現在の閾値）に入るコメントの割合を95%信頼区間つきで推定します。"
+            "区間が目標の幅に収まったら抽出を打ち切ります。流し読みは100件ごとに1 unit です。"
+        )
+        col_scan, col_sample = st.columns(2)
+        with col_scan:
+            scan_limit = st.number_input("流し読みする最大件数", min_value=1000, max_value=200_000, value=DEFAULT_SCAN_LIMIT, step=1000)
+            sample_by = st.selectbox("層の分け方", list(STRATA), format_func=STRATA.get)
+        with col_sample:
+            max_sample = st.number_input("分析する最大件数", min_value=100, max_value=5000, value=DEFAULT_MAX_SAMPLE, step=100)
+            target_margin_pt = st.slider("目標の誤差（±ポイント）", 1, 10, int(DEFAULT_TARGET_MARGIN * 100))
+        run_sample = st.button("🎲 サンプルで推定を実行")
+
+    # 分析はバックグラウンドのジョブで実行する（画面の再実行や「検索に戻る」で途切れない）。
+    # 同じ動画・設定（取得方法・プロンプトの版・モデル・temperature）の分析は、実行中のジョブか共有済みの結果を使う
+    if run_full or run_refresh or run_sample:
+        # サンプリング推定は、プリセットと現在の閾値の推定がすべて目標の誤差に収まるまで抽出する
+        track_ranges = list(PRESET_RANGES.items()) + [("現在の閾値", dict(threshold_ranges))]
+        if run_sample:
+            mode = (vid, "sample", sample_by, int(scan_limit), int(max_sample), target_margin_pt, tuple(sorted(threshold_ranges.items())))
+        elif run_refresh:
+            mode = (vid, "refresh", saved_count)
+        else:
+            mode = (vid, "full", 120)
+        share_key = analysis_share_key(mode, scores_only, use_local_model)
+        shared = shared_results.get(share_key)
+        if shared is not None:
+            watch_job(vid, None)
+            st.session_state["analysis_df_raw"] = shared.df
+            st.session_state["analysis_index"] = shared.index
+            st.session_state["analysis_similar"] = shared.similar
+            st.session_state["sample_meta"] = shared.meta
+            st.success(
+                f"✅ 分析済みの結果（{len(shared.df)} 件・{time.strftime('%H:%M', time.localtime(shared.created_at))} 時点）を表示しています。"
+            )
+        elif run_sample:
+            job = job_runner.submit(
+                run_sampling_job, vid, sample_by, int(scan_limit), int(max_sample), target_margin_pt / 100, track_ranges,
+                scores_only, int(batch_size), share_key, use_local_model,
+                key=share_key, label="sample", subscriber=session_id
+            )
+        else:
+            job = job_runner.submit(
+                run_analysis_job, vid, bool(run_refresh), scores_only, int(batch_size), share_key, use_local_model,
+                key=share_key, label="refresh" if run_refresh else "full", subscriber=session_id
+            )
+        if shared is None:
+            # 実行中の同じジョブをもう一度押しても購読は増えない。別の取得方法に切り替えたら前のジョブは購読をやめる
+            watch_job(vid, job.id)
+            st.session_state["analysis_df_raw"] = None
+            st.session_state["sample_meta"] = None
 
-                df = pd.DataFrame(rows)
-                st.session_state["analysis_df_raw"] = df
-                st.success(f"✅ {len(df)} 件のコメントを分析しました。（画面表示は上位100件となります）")
+    # この動画の分析ジョブ：実行中なら途中経過を描画し、終わっていれば結果を取り込む
+    job_id = st.session_state.get("analysis_jobs", {}).get(vid)
+    if job_id is not None:
+        job = job_runner.get(job_id)
+        if job is None or job.finished:
+            del st.session_state["analysis_jobs"][vid]
+            adopt_finished_job(job)
+        else:
+            render_job_progress(job_id, vid)
 
 # 6. 結果表示 ---------------------------------
 if "analysis_df_raw" in st.session_state and st.session_state["analysis_df_raw"] is not None:
-    df_raw = st.session_state["analysis_df_raw"]
-    df = df_raw.copy()
+    import numpy as np
+    import pandas as pd
+    from export import FORMATS, export_bytes
+    from score_index import ScoreIndex
+    from similarity import DEFAULT_MIN_SIMILARITY, similarity_from_frame
 
-    mask = pd.Series([True] * len(df))
-    for f in FEATURES:
-        key = f["key"]
-        score_col = f"{key}_score"
-        low, high = threshold_ranges.get(key, (f["min"], f["max"]))
-        if score_col in df.columns:
-            s = pd.to_numeric(df[score_col], errors="coerce")
-            mask &= s.notna() & (s >= float(low)) & (s <= float(high))
-        else:
-            mask &= True
-    df_filtered = df[mask]
+    df = st.session_state["analysis_df_raw"]
 
-    # 表示用データフレームを100件に絞る
-    if len(df_filtered) > 100:
-        df_filtered = df_filtered.head(100)
+    index = st.session_state.get("analysis_index")
+    if index is None or index.n_rows != len(df):
+        with METRICS.span("build_index", rows=len(df)):
+            index = ScoreIndex(df)
+        st.session_state["analysis_index"] = index
+    # 似たコメントの索引は分析中に作ったもの。無ければ（中止した途中結果など）ここで作る
+    similar = st.session_state.get("analysis_similar")
+    if similar is None:
+        with METRICS.span("build_similarity", rows=len(df)):
+            similar = similarity_from_frame(df)
+        st.session_state["analysis_similar"] = similar
+    groups = df["重複グループ"].to_numpy()
+    n_group_ids = int(max(groups.max(initial=0), similar.keys.max(initial=0))) + 1
 
-    st.markdown(f"**表示件数:** {len(df_filtered)} / 100 件（閾値レンジで絞り込み）")
+    # 件数・分布は件数キューブ、該当行はビットマップのANDで求める（行数によらず一瞬）
+    # 該当行は行番号の配列で持ち、表示する1ページ分の行だけを取り出す（フィルタ結果全体のコピーは作らない）
+    ranges = {f["key"]: threshold_ranges.get(f["key"], (f["min"], f["max"])) for f in FEATURES}
+    with METRICS.span("filter", rows=len(df)):
+        matched = index.count(ranges)
+        positions = np.flatnonzero(index.mask(ranges))
 
-    display_cols = ["コメント"] + [f"{f['key']}_score" for f in FEATURES] + ["総合コメント"]
-    display_cols = [c for c in display_cols if c in df_filtered.columns]
-    
-    if len(df_filtered) > 0:
-        df_display = df_filtered[display_cols].reset_index(drop=True)
-        df_display.index = df_display.index + 1
+    sample_meta = st.session_state.get("sample_meta")
+    if sample_meta is not None and "層" in df.columns:
+        # サンプリング推定：表は抽出したコメント。割合は層の大きさで重み付けして母集団全体に引き伸ばす
+        from sampling import estimate_share
+
+        valid = np.ones(len(df), dtype=bool)
+        valid[index.incomplete] = False
+        strata = df["層"].to_numpy()
+        population = sample_meta["population"]
+        estimates = []
+        for name, preset_r in list(PRESET_RANGES.items()) + [(f"現在の閾値（{preset}）", ranges)]:
+            share, low, high, n = estimate_share(index.mask(preset_r), strata, valid, sample_meta["totals"])
+            estimates.append({
+                "フィルタ": name,
+                "推定割合": f"{share:.1%}",
+                "95%信頼区間": f"{low:.1%} 〜 {high:.1%}",
+                "推定件数": f"約 {round(share * population):,} 件",
+            })
+        st.markdown(f"#### 🎲 サンプルからの推定（{population:,} 件中 {int(valid.sum())} 件を分析）")
+        st.dataframe(pd.DataFrame(estimates), use_container_width=True, hide_index=True)
+        st.caption(f"以下の表は抽出したコメントです（層の分け方: {STRATA[sample_meta['by']]}）。")
+
+    st.markdown(f"**条件に合うコメント:** {matched} / {len(df)} 件")
+    if len(index.incomplete):
+        # スコアがそろわなかった行はどの閾値レンジにも入らないので、ここにまとめて出す
+        with st.expander(f"⚠️ 分析できなかったコメント（{len(index.incomplete)} 件）"):
+            st.dataframe(
+                df.iloc[index.incomplete][[c for c in ("コメント", "返信先", "重複数", "総合コメント") if c in df.columns]],
+                use_container_width=True
+            )
+    with st.expander("📊 フィルタ後のスコア分布"):
+        hist = pd.DataFrame(index.histograms(ranges)).T
+        hist = hist[sorted(hist.columns)].fillna(0).astype(int)
+        st.dataframe(hist, use_container_width=True)
+
+    display_cols = ["コメント", "返信先", "重複数", "層"] + [f"{f['key']}_score" for f in FEATURES] + ["総合コメント"]
+    display_cols = [c for c in display_cols if c in df.columns]
+    score_cols = [f"{f['key']}_score" for f in FEATURES if f"{f['key']}_score" in df.columns]
+    in_filter = np.zeros(len(df), dtype=bool)
+    in_filter[positions] = True
+
+    with st.expander("🧩 似たコメントのまとまり（クラスタ）"):
+        # 本文の似たコメントをまとめ、まとまりごとの件数・平均スコアを出す（閾値に関係なく分析した全件）
+        n_clusters = st.slider("まとまりの数", 2, MAX_CLUSTERS, DEFAULT_CLUSTERS)
+        if st.checkbox("まとまりを計算する", key="show_clusters") and len(similar):
+            with METRICS.span("clusters", rows=len(similar)):
+                labels, centrality = similar.clusters(n_clusters)
+            keys = similar.keys
+            cluster_of_group = np.zeros(n_group_ids, dtype=np.int32)
+            cluster_of_group[keys] = labels
+            row_cluster = cluster_of_group[groups]
+            # 代表コメント = まとまりの重心に最も近いグループの最初の行
+            first_row = np.zeros(n_group_ids, dtype=np.int64)
+            unique_groups, first_positions = np.unique(groups, return_index=True)
+            first_row[unique_groups] = first_positions
+            order = np.lexsort((-centrality, labels))
+            leaders = order[np.r_[True, labels[order][1:] != labels[order][:-1]]]
+            clusters = df[score_cols].astype("float64").groupby(row_cluster).mean().round(2)
+            clusters.columns = [c.replace("_score", "（平均）") for c in clusters.columns]
+            sizes = np.bincount(row_cluster, minlength=n_clusters)
+            matched_sizes = np.bincount(row_cluster[in_filter], minlength=n_clusters)
+            representative = dict(zip(labels[leaders], df["コメント"].to_numpy()[first_row[keys[leaders]]]))
+            clusters.insert(0, "代表コメント", [representative.get(c) for c in clusters.index])
+            clusters.insert(1, "件数", sizes[clusters.index])
+            clusters.insert(2, "条件に合う件数", matched_sizes[clusters.index])
+            clusters = clusters.sort_values("件数", ascending=False)
+            clusters.index.name = "まとまり"
+            st.dataframe(clusters, use_container_width=True)
+            chosen = st.selectbox(
+                "中身を見るまとまり", list(clusters.index),
+                format_func=lambda c: f"{c}: {str(clusters.at[c, '代表コメント'])[:40]}（{clusters.at[c, '件数']} 件）",
+            )
+            members = np.flatnonzero(row_cluster == chosen)
+            st.dataframe(df.iloc[members[:SIMILAR_MAX_ROWS]][display_cols], use_container_width=True)
+
+    if len(positions) > 0:
+        # ページ送り（フィルタ条件が変わって総ページ数が減ったら最後のページに合わせる）
+        col_size, col_page = st.columns(2)
+        with col_size:
+            page_size = st.selectbox("1ページの表示件数", PAGE_SIZES, index=PAGE_SIZES.index(DEFAULT_PAGE_SIZE))
+        n_pages = (len(positions) + page_size - 1) // page_size
+        if st.session_state.get("result_page", 1) > n_pages:
+            st.session_state["result_page"] = n_pages
+        with col_page:
+            page = st.number_input(f"ページ（全 {n_pages} ページ）", min_value=1, max_value=n_pages, key="result_page")
+        start = (page - 1) * page_size
+        page_positions = positions[start:start + page_size]
+
+        st.markdown(f"**表示件数:** {start + 1}〜{start + len(page_positions)} 件目 / {len(positions)} 件（閾値レンジで絞り込み）")
+        df_display = df.iloc[page_positions][display_cols].reset_index(drop=True)
+        df_display.index = df_display.index + start + 1
         st.dataframe(df_display, use_container_width=True)
 
-        st.download_button(
-            "💾 フィルタ結果をCSVでダウンロード",
-            df_filtered.to_csv(index=False).encode("utf-8"),
-            file_name="filtered_comment_analysis.csv",
-            mime="text/csv"
-        )
+        # スコアのみモードで分析した行は、開いたときだけ評価理由を生成する
+        if "総合コメント" in df_display.columns and df_display["総合コメント"].isna().any():
+            with st.expander("💬 評価理由（総合コメント）を生成"):
+                choice = st.selectbox(
+                    "理由を見たいコメント",
+                    list(df_display.index[df_display["総合コメント"].isna()]),
+                    format_func=lambda i: f"{i}. {str(df_display.at[i, 'コメント'])[:40]}",
+                )
+                row = df_display.loc[choice]
+                rationales = st.session_state.setdefault("rationales", {})
+                if st.button("理由を生成"):
+                    scores = {f["key"]: row.get(f"{f['key']}_score") for f in FEATURES}
+                    rationales[row["コメント"]] = explain_scores(row["コメント"], scores)
+                if row["コメント"] in rationales:
+                    st.info(rationales[row["コメント"]])
+
+        # 気になったコメントに似たものを、分析した全件から探す（閾値の外のものも含む）
+        with st.expander("🔍 似たコメントを探す"):
+            choice = st.selectbox(
+                "基準にするコメント（このページから）",
+                list(df_display.index),
+                format_func=lambda i: f"{i}. {str(df_display.at[i, 'コメント'])[:40]}",
+                key="similar_choice",
+            )
+            query_text = st.text_input("または文章を入力して探す", key="similar_query")
+            min_similarity = st.slider("類似度の下限", 0.3, 1.0, DEFAULT_MIN_SIMILARITY, 0.05, key="similar_min")
+            chosen_row = page_positions[choice - start - 1]
+            with METRICS.span("similar_search", rows=len(similar)):
+                if query_text.strip():
+                    keys, sims = similar.search(query_text, min_similarity=min_similarity)
+                else:
+                    keys, sims = similar.similar_to(int(groups[chosen_row]), min_similarity=min_similarity)
+                similarity_of_group = np.full(n_group_ids, -1.0, dtype=np.float32)
+                similarity_of_group[keys] = sims
+                row_similarity = similarity_of_group[groups]
+                hits = np.flatnonzero(row_similarity >= min_similarity)
+                if not query_text.strip():
+                    hits = hits[hits != chosen_row]
+                hits = hits[np.argsort(-row_similarity[hits], kind="stable")]
+            if len(hits):
+                means = df.iloc[hits][score_cols].astype("float64").mean()
+                st.caption(
+                    f"似たコメント {len(hits)} 件（うち現在の閾値に合う {int(in_filter[hits].sum())} 件）/ 平均スコア: "
+                    + "・".join(f"{c.replace('_score', '')} {means[c]:.2f}" for c in score_cols if means[c] == means[c])
+                )
+                similar_rows = df.iloc[hits[:SIMILAR_MAX_ROWS]][display_cols].reset_index(drop=True)
+                similar_rows.insert(0, "類似度", row_similarity[hits[:SIMILAR_MAX_ROWS]].round(2))
+                st.dataframe(similar_rows, use_container_width=True)
+            else:
+                st.caption("似たコメントは見つかりませんでした。")
+
+        # ファイルはボタンを押したときにだけ作る（スライダーを動かすたびに全件を変換しない）
+        col_format, col_download = st.columns([1, 2])
+        with col_format:
+            export_format = st.selectbox("形式", list(FORMATS), label_visibility="collapsed")
+        extension, mime = FORMATS[export_format]
+        with col_download:
+            st.download_button(
+                f"💾 フィルタ結果（{len(positions)} 件）を{export_format}でダウンロード",
+                lambda: export_bytes(df, positions, export_format),
+                file_name=f"filtered_comment_analysis.{extension}",
+                mime=mime
+            )
     else:
         st.warning("条件に合うコメントがありませんでした。")
+
+# 7. 計測パネル ---------------------------------
+def render_metrics_panel(container):
+    snap = METRICS.snapshot()
+    with container.expander("📈 計測（処理時間・トークン・料金）"):
+        if snap["stages"]:
+            # 検索画面でも pandas を読み込まずに済むよう、表は Markdown で描く
+            lines = ["| 区間 | 回数 | 合計秒 | p50ms | p95ms | エラー |", "|---|---:|---:|---:|---:|---:|"]
+            for stage, m in sorted(snap["stages"].items(), key=lambda kv: -kv[1]["total_seconds"]):
+                lines.append(
+                    f"| {stage} | {m['count']} | {m['total_seconds']:.2f} | {m['p50_seconds'] * 1000:.1f}"
+                    f" | {m['p95_seconds'] * 1000:.1f} | {m['errors']} |"
+                )
+            st.markdown("\n".join(lines))
+        else:
+            st.caption("まだ計測データがありません。")
+
+        cost = METRICS.counter_total("cost_usd")
+        st.caption(
+            f"🧮 トークン: 入力 {METRICS.counter_total('tokens', kind='prompt'):,}"
+            f"（キャッシュ {METRICS.counter_total('tokens', kind='cached'):,}）"
+            f" / 出力 {METRICS.counter_total('tokens', kind='completion'):,}・推定 ${cost:.4f}"
+        )
+        st.caption(
+            f"⚠️ エラー {METRICS.counter_total('errors')} 件 / パース失敗 {METRICS.counter_total('parse_failures')} 件"
+            f" / リトライ {METRICS.counter_total('openai_retries')} 回"
+            f" / ヘッジ {METRICS.counter_total('openai_hedges', outcome='sent')} 回"
+            f"（先着 {METRICS.counter_total('openai_hedges', outcome='won')} 回）"
+        )
+        for e in reversed(snap["recent_errors"][-5:]):
+            st.caption(f"・{time.strftime('%H:%M:%S', time.localtime(e['time']))} [{e['stage']}] {e['type']}: {e['message']}")
+
+        col_json, col_prom = st.columns(2)
+        with col_json:
+            st.download_button(
+                "JSON", json.dumps(snap, ensure_ascii=False, indent=2).encode("utf-8"),
+                file_name="metrics.json", mime="application/json"
+            )
+        with col_prom:
+            st.download_button(
+                "Prometheus", METRICS.to_prometheus().encode("utf-8"),
+                file_name="metrics.prom", mime="text/plain"
+            )
+        st.button("計測をリセット", on_click=METRICS.reset)
+
+render_metrics_panel(metrics_panel)
+
+# 初回表示を終えてから、分析・結果表示で使うライブラリを裏で読み込んでおく
+core.preload_in_background(["pandas", "result_store", "score_index", "similarity", "openai", "googleapiclient.discovery"])
@@ -0,0 +1,431 @@
+# -----------------------------------------------------------
+# AsyncOpenAI を使った分析エンジン（app.py / analyze_video_comments.py 共通）
+# -----------------------------------------------------------
+# - RPM（リクエスト/分）と TPM（トークン/分）のトークンバケットで送信ペースを制御
+# - 同時実行数は AIMD：成功が続けば少しずつ増やし、429/5xx で半分に減らす
+# - Retry-After ヘッダがあればその秒数だけ全リクエストを止める
+# - 1回の呼び出しには制限時間を設け、超えたら（リトライ可能なエラーとして）送り直す
+# - 応答が直近の p95 より遅い呼び出しには同じリクエストをもう1本送り、先に返った方を使う（ヘッジ）。
+#   負けた側のトークンも使用量・料金に数える（取り消した側は送った入力トークンだけ）
+# - 実行全体の締め切りを過ぎたら、それ以降の呼び出しは DeadlineExceeded で打ち切る（失敗として結果に残す）
+# asyncio のプリミティブはイベントループに紐づくため、エンジンは1回の実行ごとに
+# `async with` で作り直す（Streamlitの再実行ごとに asyncio.run するため）。
+# openai の読み込みは重いので、最初にエンジンを開くとき（またはエラーを判定するとき）まで遅らせる。
+import asyncio
+import os
+import random
+import time
+from collections import deque
+
+from batch_analysis import OUTPUT_TOKENS_PER_COMMENT
+from metrics import METRICS
+from prompts import count_tokens
+
+DEFAULT_RPM = 500
+DEFAULT_TPM = 200_000
+DEFAULT_INITIAL_CONCURRENCY = 8
+DEFAULT_MAX_CONCURRENCY = 64
+DEFAULT_MAX_RETRIES = 6
+BACKOFF_BASE_SECONDS = 1.0
+BACKOFF_MAX_SECONDS = 60.0
+STOP_POLL_SECONDS = 0.5  # stream_jobs が中止の指示を確認する間隔
+DEFAULT_CALL_TIMEOUT_SECONDS = 60.0  # API呼び出し1回の制限時間
+LATENCY_WINDOW = 200  # ヘッジの基準（p95）に使う直近の成功した呼び出しの数
+HEDGE_MIN_SAMPLES = 20  # これだけ所要時間が集まるまではヘッジしない
+HEDGE_QUANTILE = 0.95
+HEDGE_MAX_RATIO = 0.1  # ヘッジで余分に送るリクエストは全体の1割まで
+HEDGE_CHECK_SECONDS = 0.25  # 送信前・p95 が決まる前に、ヘッジするかどうかを見直す間隔
+
+
+class DeadlineExceeded(Exception):
+    pass
+
+
+class TokenBucket:
+    def __init__(self, per_minute):
+        self.capacity = float(per_minute)
+        self.rate = self.capacity / 60.0
+        self.level = self.capacity
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self, amount):
+        amount = min(float(amount), self.capacity)
+        while True:
+            self._refill()
+            # 判定と減算の間に await が無いので、同じループ内では排他的に動く
+            if self.level >= amount:
+                self.level -= amount
+                return
+            await asyncio.sleep((amount - self.level) / self.rate)
+
+    def adjust(self, delta):
+        # 見積もりと実際の消費トークン数の差を後から反映する
+        self._refill()
+        self.level = min(self.capacity, self.level - delta)
+
+
+class AIMDLimiter:
+    def __init__(self, initial, min_limit=1, max_limit=DEFAULT_MAX_CONCURRENCY):
+        self.limit = float(initial)
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.in_flight = 0
+        self._cond = asyncio.Condition()
+
+    async def acquire(self):
+        async with self._cond:
+            await self._cond.wait_for(lambda: self.in_flight < max(1, int(self.limit)))
+            self.in_flight += 1
+
+    async def release(self):
+        async with self._cond:
+            self.in_flight -= 1
+            self._cond.notify_all()
+
+    def on_success(self):
+        # 加算的増加：limit 回成功するごとにおよそ +1
+        self.limit = min(self.max_limit, self.limit + 1.0 / max(self.limit, 1.0))
+
+    def on_throttle(self):
+        # 乗算的減少
+        self.limit = max(self.min_limit, self.limit / 2.0)
+
+
+def is_retryable(error):
+    from openai import APIConnectionError, APIStatusError, APITimeoutError
+
+    if isinstance(error, (APIConnectionError, APITimeoutError, asyncio.TimeoutError)):
+        return True
+    if isinstance(error, APIStatusError):
+        return error.status_code == 429 or error.status_code >= 500
+    return False
+
+
+def retry_after_seconds(error):
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None) or {}
+    try:
+        if headers.get("retry-after-ms"):
+            return float(headers["retry-after-ms"]) / 1000.0
+        if headers.get("retry-after"):
+            return float(headers["retry-after"])
+    except (TypeError, ValueError):
+        return None
+    return None
+
+
+class AnalysisEngine:
+    def __init__(
+        self,
+        api_key,
+        model,
+        temperature,
+        rpm=DEFAULT_RPM,
+        tpm=DEFAULT_TPM,
+        initial_concurrency=DEFAULT_INITIAL_CONCURRENCY,
+        max_concurrency=DEFAULT_MAX_CONCURRENCY,
+        max_retries=DEFAULT_MAX_RETRIES,
+        call_timeout=DEFAULT_CALL_TIMEOUT_SECONDS,
+        run_timeout=None,
+        hedge=True,
+    ):
+        self.api_key = api_key
+        self.model = model
+        self.temperature = temperature
+        self.rpm = rpm
+        self.tpm = tpm
+        self.initial_concurrency = initial_concurrency
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+        self.call_timeout = call_timeout
+        self.run_timeout = run_timeout
+        self.hedge = hedge
+        self.stats = {
+            "requests": 0, "retries": 0, "throttled": 0, "errors": 0, "tokens": 0,
+            "prompt_tokens": 0, "completion_tokens": 0, "cached_tokens": 0,
+            "timeouts": 0, "hedged": 0, "hedge_wins": 0,
+        }
+        self.client = None
+        self.deadline = None
+        self._latencies = deque(maxlen=LATENCY_WINDOW)
+
+    async def __aenter__(self):
+        from openai import AsyncOpenAI
+
+        # リトライはエンジン側で制御するので SDK のリトライは切る
+        self.client = AsyncOpenAI(api_key=self.api_key, max_retries=0)
+        self.request_bucket = TokenBucket(self.rpm)
+        self.token_bucket = TokenBucket(self.tpm)
+        self.limiter = AIMDLimiter(self.initial_concurrency, max_limit=self.max_concurrency)
+        self._resume_at = 0.0
+        # 締め切りは `async with` した時点から数える（複数の動画で共有するなら全体の締め切り）
+        self.deadline = time.monotonic() + self.run_timeout if self.run_timeout else None
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.client.close()
+        self.client = None
+
+    async def _wait_if_paused(self):
+        delay = self._resume_at - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    def remaining(self):
+        # 締め切りまでの残り秒数（締め切りが無ければ None）
+        if self.deadline is None:
+            return None
+        return self.deadline - time.monotonic()
+
+    def expired(self):
+        remaining = self.remaining()
+        return remaining is not None and remaining <= 0
+
+    def hedge_after(self):
+        # 直近の所要時間の p95。これを過ぎても返らない呼び出しはヘッジする（サンプルが少ないうちは None）
+        if not self.hedge or len(self._latencies) < HEDGE_MIN_SAMPLES:
+            return None
+        if self.stats["hedged"] >= HEDGE_MAX_RATIO * self.stats["requests"]:
+            return None
+        latencies = sorted(self._latencies)
+        return latencies[min(len(latencies) - 1, int(len(latencies) * HEDGE_QUANTILE))]
+
+    async def _send(self, prompt, estimate, extra, sent_at=None):
+        # レート制限を通してAPIを1回呼ぶ。制限時間を過ぎたら asyncio.TimeoutError
+        # sent_at（リスト）を渡すと、待ち行列を抜けて実際に送った時刻を入れる
+        await self._wait_if_paused()
+        await self.request_bucket.acquire(1)
+        await self.token_bucket.acquire(estimate)
+        await self.limiter.acquire()
+        error = None
+        started = time.perf_counter()
+        if sent_at is not None:
+            sent_at.append(started)
+        try:
+            self.stats["requests"] += 1
+            resp = await asyncio.wait_for(
+                self.client.chat.completions.create(
+                    model=self.model,
+                    messages=[{"role": "user", "content": prompt}],
+                    temperature=self.temperature,
+                    **extra,
+                ),
+                timeout=self.call_timeout,
+            )
+        except Exception as e:
+            error = e
+        finally:
+            # ヘッジの負けた側が取り消されても同時実行数は必ず戻す
+            await asyncio.shield(self.limiter.release())
+        elapsed = time.perf_counter() - started
+        # API呼び出し1回ごとの所要時間（待ち行列・リトライの待ちは含まない）
+        METRICS.observe("openai_call", elapsed, ok=error is None)
+        if error is not None:
+            if isinstance(error, asyncio.TimeoutError):
+                self.stats["timeouts"] += 1
+            raise error
+        self.limiter.on_success()
+        self._latencies.append(elapsed)
+        # 使用量は返った応答ごとに数える（ヘッジで使わなかった応答も料金はかかる）
+        self._record_usage(resp, estimate)
+        return resp
+
+    def _record_usage(self, resp, estimate):
+        usage = getattr(resp, "usage", None)
+        if usage is None or not getattr(usage, "total_tokens", None):
+            return
+        details = getattr(usage, "prompt_tokens_details", None)
+        cached = getattr(details, "cached_tokens", None) or 0
+        self.stats["tokens"] += usage.total_tokens
+        self.stats["prompt_tokens"] += usage.prompt_tokens or 0
+        self.stats["completion_tokens"] += usage.completion_tokens or 0
+        self.stats["cached_tokens"] += cached
+        self.token_bucket.adjust(usage.total_tokens - estimate)
+        METRICS.record_usage(self.model, usage.prompt_tokens, usage.completion_tokens, cached)
+
+    def _record_cancelled(self, prompt):
+        # 送った後で取り消した呼び出し（ヘッジの負け側など）。応答が無いので入力トークンだけを数える
+        prompt_tokens = count_tokens(prompt)
+        self.stats["tokens"] += prompt_tokens
+        self.stats["prompt_tokens"] += prompt_tokens
+        METRICS.record_usage(self.model, prompt_tokens, 0)
+
+    async def _send_hedged(self, prompt, estimate, extra):
+        # 送ってから p95 を過ぎても返らなければ同じリクエストをもう1本送り、先に成功した方を使う
+        # （待ち行列にいる時間は数えない。p95 が決まっていなければ決まるまで見直し続ける）
+        if not self.hedge:
+            return await self._send(prompt, estimate, extra)
+        sent_at = []
+        primary = asyncio.ensure_future(self._send(prompt, estimate, extra, sent_at))
+        tasks = [primary]
+        sent = {primary: sent_at}
+        try:
+            while True:
+                hedge_after = self.hedge_after()
+                if not sent_at or hedge_after is None:
+                    timeout = HEDGE_CHECK_SECONDS
+                else:
+                    timeout = sent_at[0] + hedge_after - time.perf_counter()
+                    if timeout <= 0:
+                        break
+                done, _ = await asyncio.wait({primary}, timeout=timeout)
+                if done:
+                    return primary.result()
+            self.stats["hedged"] += 1
+            METRICS.count("openai_hedges", outcome="sent")
+            backup_sent_at = []
+            backup = asyncio.ensure_future(self._send(prompt, estimate, extra, backup_sent_at))
+            tasks.append(backup)
+            sent[backup] = backup_sent_at
+            pending = set(tasks)
+            error = None
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if task is backup:
+                            self.stats["hedge_wins"] += 1
+                            METRICS.count("openai_hedges", outcome="won")
+                        return task.result()
+                    error = error or task.exception()
+            raise error
+        finally:
+            # 負けた側（または呼び出し元が取り消されたときは両方）を取り消す
+            unfinished = [task for task in tasks if not task.done()]
+            for task in unfinished:
+                task.cancel()
+            if unfinished:
+                await asyncio.gather(*unfinished, return_exceptions=True)
+            # 取り消す前に送ってしまった分は、料金がかかるものとして入力トークンを数える
+            for task in unfinished:
+                if sent[task] and task.cancelled():
+                    self._record_cancelled(prompt)
+                    METRICS.count("openai_hedges", outcome="cancelled")
+
+    async def complete(self, prompt, expected_output_tokens=OUTPUT_TOKENS_PER_COMMENT, response_format=None):
+        # response_format を渡すと Structured Outputs（JSON Schema）で出力の形を固定する
+        extra = {"response_format": response_format} if response_format is not None else {}
+        estimate = count_tokens(prompt) + expected_output_tokens
+        attempt = 0
+        while True:
+            remaining = self.remaining()
+            try:
+                if remaining is not None and remaining <= 0:
+                    raise asyncio.TimeoutError()
+                # 締め切りがあれば、待ち行列・リトライを含めて締め切りまでに返らない呼び出しは打ち切る
+                resp = await asyncio.wait_for(self._send_hedged(prompt, estimate, extra), timeout=remaining)
+                error = None
+            except asyncio.TimeoutError as e:
+                error = e
+                if self.expired():
+                    error = DeadlineExceeded(f"分析の制限時間（{self.run_timeout:g}秒）を過ぎたため打ち切りました")
+            except Exception as e:
+                error = e
+
+            if error is None:
+                return resp.choices[0].message.content.strip()
+
+            if not is_retryable(error) or attempt >= self.max_retries:
+                self.stats["errors"] += 1
+                METRICS.record_error("openai_call", error)
+                raise error
+            self.stats["retries"] += 1
+            METRICS.count("openai_retries", status=getattr(error, "status_code", None) or type(error).__name__)
+            if getattr(error, "status_code", None) == 429:
+                self.stats["throttled"] += 1
+            if not isinstance(error, asyncio.TimeoutError):
+                # 制限時間切れはサーバの混雑とは限らないので、同時実行数は減らさない
+                self.limiter.on_throttle()
+            delay = retry_after_seconds(error)
+            if delay is None:
+                delay = min(BACKOFF_MAX_SECONDS, BACKOFF_BASE_SECONDS * (2 ** attempt))
+                delay = random.uniform(delay / 2, delay)
+            else:
+                # サーバ指定の待ち時間は全リクエスト共通で守る
+                self._resume_at = max(self._resume_at, time.monotonic() + delay)
+            attempt += 1
+            remaining = self.remaining()
+            await asyncio.sleep(delay if remaining is None else max(0.0, min(delay, remaining)))
+
+
+def call_timeout_from_env():
+    return float(os.getenv("OPENAI_CALL_TIMEOUT_SECONDS", DEFAULT_CALL_TIMEOUT_SECONDS))
+
+
+def engine_from_env(api_key, model, temperature, run_timeout=None):
+    # run_timeout: 実行全体の締め切り（秒）。OPENAI_RUN_TIMEOUT_SECONDS があればそちらを使う（0 で締め切りなし）
+    run_timeout = float(os.getenv("OPENAI_RUN_TIMEOUT_SECONDS", run_timeout or 0)) or None
+    return AnalysisEngine(
+        api_key,
+        model,
+        temperature,
+        rpm=int(os.getenv("OPENAI_RPM", DEFAULT_RPM)),
+        tpm=int(os.getenv("OPENAI_TPM", DEFAULT_TPM)),
+        initial_concurrency=int(os.getenv("OPENAI_INITIAL_CONCURRENCY", DEFAULT_INITIAL_CONCURRENCY)),
+        max_concurrency=int(os.getenv("OPENAI_MAX_CONCURRENCY", DEFAULT_MAX_CONCURRENCY)),
+        call_timeout=call_timeout_from_env(),
+        run_timeout=run_timeout,
+        hedge=os.getenv("OPENAI_HEDGE", "1") != "0",
+    )
+
+
+async def stream_jobs(engine, job_pages, worker, on_done=None, should_stop=None):
+    # job_pages はジョブのリストを順に返すイテラブル（例：YouTubeの1ページ＝100件分のバッチ群）。
+    # 次のページの取得（同期I/O）は別スレッドで行い、届いたページのジョブはすぐに分析を開始する。
+    # 終わった順に on_done(job, result) を呼び、全ての (job, result) を返す。
+    # should_stop() が True を返したら、実行中のジョブを取り消してそれまでの結果を返す（中止）。
+    # エンジンの締め切りを過ぎたら次のページは取りに行かない（取得済みのジョブは失敗として結果に残る）。
+    # engine は呼び出し側で `async with` 済みであること（複数の動画で1つのエンジン＝同じレート制限を共有できる）。
+    end = object()
+    results = []
+    pages = iter(job_pages)
+
+    async def _run(job):
+        return job, await worker(engine, job)
+
+    async def _next_page():
+        return await asyncio.to_thread(next, pages, end)
+
+    fetch = asyncio.ensure_future(_next_page())
+    pending = {fetch}
+    while pending:
+        done, pending = await asyncio.wait(
+            pending, timeout=STOP_POLL_SECONDS if should_stop else None, return_when=asyncio.FIRST_COMPLETED
+        )
+        for task in done:
+            if task is fetch:
+                jobs = task.result()
+                if jobs is end:
+                    fetch = None
+                    continue
+                pending.update(asyncio.ensure_future(_run(job)) for job in jobs)
+                if engine.expired():
+                    fetch = None
+                    continue
+                fetch = asyncio.ensure_future(_next_page())
+                pending.add(fetch)
+            else:
+                job, result = task.result()
+                results.append((job, result))
+                if on_done is not None:
+                    on_done(job, result)
+        if should_stop is not None and should_stop():
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+            break
+    return results
+
+
+def run_streaming_jobs(engine, job_pages, worker, on_done=None, should_stop=None):
+    # stream_jobs を新しいイベントループで1回だけ実行する（Streamlit / CLI の単発実行用）
+    async def _main():
+        async with engine:
+            return await stream_jobs(engine, job_pages, worker, on_done=on_done, should_stop=should_stop)
+
+    return asyncio.run(_main())
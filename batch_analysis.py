@@ -0,0 +1,247 @@
+# -----------------------------------------------------------
+# 複数コメントを1リクエストにまとめて分析するバッチモード
+# -----------------------------------------------------------
+# 1.5KB程度のルール（ルーブリック）を毎回送るのは無駄なので、
+# N件のコメントを番号付きで1つのプロンプトに詰め、JSON配列で返してもらう。
+# 欠落・不正な要素だけを1件ずつの analyze_comment で再分析する。
+# プロンプトの文面は prompts.py のテンプレートが持つ。
+import asyncio
+import json
+import re
+
+from metrics import METRICS
+from prompts import count_tokens
+
+DEFAULT_BATCH_SIZE = 20
+DEFAULT_MAX_BATCH_TOKENS = 6000
+# 1コメントあたりの出力（スコア6つ＋短い総合コメント）の見積もり
+OUTPUT_TOKENS_PER_COMMENT = 150
+# スコアのみモード（総合コメントなし）の1コメントあたりの出力の見積もり
+SCORES_OUTPUT_TOKENS_PER_COMMENT = 40
+
+# 各特徴量の取りうる範囲（app.py の FEATURES と同じ）
+FEATURE_RANGES = {
+    "攻撃性": (0, 3),
+    "挑発性": (0, 3),
+    "有用性": (0, 3),
+    "感情極性": (-2, 2),
+    "自己顕示性": (0, 3),
+    "文脈依存性": (0, 3),
+}
+
+
+# スコアのみモード：6つの整数だけを JSON Schema（Structured Outputs）で返してもらう。
+# 出力トークンが1/4程度になり、形も保証されるので json.loads 1回で読める。
+def _scores_properties():
+    return {key: {"type": "integer", "enum": list(range(low, high + 1))} for key, (low, high) in FEATURE_RANGES.items()}
+
+
+def scores_response_format(batch=False):
+    # chat.completions.create(response_format=...) に渡す JSON Schema（strict）
+    if batch:
+        item = {
+            "type": "object",
+            "properties": dict({"index": {"type": "integer"}}, **_scores_properties()),
+            "required": ["index"] + list(FEATURE_RANGES),
+            "additionalProperties": False,
+        }
+        schema = {
+            "type": "object",
+            "properties": {"results": {"type": "array", "items": item}},
+            "required": ["results"],
+            "additionalProperties": False,
+        }
+    else:
+        schema = {
+            "type": "object",
+            "properties": _scores_properties(),
+            "required": list(FEATURE_RANGES),
+            "additionalProperties": False,
+        }
+    return {
+        "type": "json_schema",
+        "json_schema": {"name": "comment_scores_batch" if batch else "comment_scores", "strict": True, "schema": schema},
+    }
+
+
+def scores_to_analysis(item):
+    # {"攻撃性": 1, ...} -> 通常モードと同じ {"攻撃性": {"score": 1}, ..., "総合コメント": None}
+    # 総合コメントが None の結果は「スコアのみ」を表す（理由は必要な行だけ後から生成する）
+    if not isinstance(item, dict):
+        return None
+    analysis = {}
+    for key, (low, high) in FEATURE_RANGES.items():
+        score = item.get(key)
+        if type(score) is not int or not (low <= score <= high):
+            return None
+        analysis[key] = {"score": score}
+    analysis["総合コメント"] = None
+    return analysis
+
+
+def parse_scores_strict(raw):
+    # スキーマ通りの出力を json.loads 1回と範囲チェックだけで読む。崩れていれば None
+    try:
+        return scores_to_analysis(json.loads(raw))
+    except (TypeError, ValueError):
+        return None
+
+
+def parse_batch_scores(raw, n_items):
+    # index -> 分析結果。スキーマ通りなら高速に、崩れていれば parse_batch_response と同じ寛容な読み方に落とす
+    try:
+        data = json.loads(raw)
+    except (TypeError, ValueError):
+        data = None
+    items = data.get("results") if isinstance(data, dict) else None
+    if isinstance(items, list):
+        parsed = {}
+        for item in items:
+            idx = item.get("index") if isinstance(item, dict) else None
+            analysis = scores_to_analysis(item)
+            if type(idx) is int and 0 <= idx < n_items and idx not in parsed and analysis is not None:
+                parsed[idx] = analysis
+        return parsed
+    return {idx: scores_to_analysis(a) or a for idx, a in parse_batch_response(raw, n_items).items()}
+
+
+def pack_batches(comments, batch_size=DEFAULT_BATCH_SIZE, max_batch_tokens=DEFAULT_MAX_BATCH_TOKENS, fixed_tokens=0,
+                 output_tokens_per_comment=OUTPUT_TOKENS_PER_COMMENT, max_comment_tokens=None):
+    # 件数上限とトークン予算の両方を満たすようにコメントのインデックスを詰める
+    # max_comment_tokens: テンプレートが長いコメントを切り詰める上限（見積もりもそこで頭打ちにする）
+    batches = []
+    current = []
+    used = fixed_tokens
+    for i, c in enumerate(comments):
+        tokens = count_tokens(c)
+        if max_comment_tokens is not None:
+            tokens = min(tokens, max_comment_tokens)
+        cost = tokens + output_tokens_per_comment
+        if current and (len(current) >= batch_size or used + cost > max_batch_tokens):
+            batches.append(current)
+            current = []
+            used = fixed_tokens
+        current.append(i)
+        used += cost
+    if current:
+        batches.append(current)
+    return batches
+
+
+def is_valid_analysis(item):
+    if not isinstance(item, dict):
+        return False
+    for key, (low, high) in FEATURE_RANGES.items():
+        val = item.get(key)
+        score = val.get("score") if isinstance(val, dict) else val
+        if isinstance(score, bool) or not isinstance(score, (int, float)):
+            return False
+        if not (low <= score <= high):
+            return False
+    return True
+
+
+def parse_batch_response(raw, n_items):
+    # index -> 分析結果 の辞書を返す。壊れている要素は含めない
+    raw = re.sub(r"```json", "", raw or "")
+    raw = re.sub(r"```", "", raw).strip()
+    try:
+        data = json.loads(raw)
+    except json.JSONDecodeError:
+        return {}
+    if isinstance(data, dict):
+        # {"results": [...]} のように包まれて返ってくる場合にも対応
+        data = next((v for v in data.values() if isinstance(v, list)), [])
+    if not isinstance(data, list):
+        return {}
+
+    parsed = {}
+    for item in data:
+        if not isinstance(item, dict):
+            continue
+        idx = item.get("index")
+        if isinstance(idx, str) and idx.strip().isdigit():
+            idx = int(idx.strip())
+        if not isinstance(idx, int) or isinstance(idx, bool) or not (0 <= idx < n_items) or idx in parsed:
+            continue
+        analysis = {k: v for k, v in item.items() if k != "index"}
+        if is_valid_analysis(analysis):
+            parsed[idx] = analysis
+    return parsed
+
+
+def _count_parse_failures(n):
+    # バッチ応答のうち読めなかった（単発で再分析する）要素の数
+    if n > 0:
+        METRICS.count("parse_failures", n, stage="batch")
+
+
+def _split_cached(comments, cache, cache_params):
+    results = [None] * len(comments)
+    pending = []
+    for i, c in enumerate(comments):
+        cached = cache.get(c, *cache_params) if cache is not None else None
+        if cached is not None:
+            results[i] = cached
+        else:
+            pending.append(i)
+    return results, pending
+
+
+def _store_parsed(comments, pending, parsed, results, cache, cache_params):
+    # バッチで得られた結果を反映し、再分析が必要なインデックスを返す
+    retry = []
+    for j, i in enumerate(pending):
+        if j in parsed:
+            results[i] = parsed[j]
+            if cache is not None:
+                cache.set(comments[i], *cache_params, parsed[j])
+        else:
+            retry.append(i)
+    return retry
+
+
+async def analyze_batch_async(comments, template, complete, analyze_single_async, cache=None, cache_params=None, scores_only=False,
+                              local_model=None):
+    # comments と同じ順番で分析結果のリストを返す。complete(prompt, expected_output_tokens, response_format) は async_engine の AnalysisEngine.complete
+    # analyze_single_async(comment) は欠落・不正な要素を1件ずつ分析し直すフォールバック
+    # scores_only=True ならスコアのみモード（JSON Schema 指定・総合コメントなし）
+    # local_model（local_model.LocalScorer）があれば、キャッシュに無いコメントのうち確信度の高いものはローカルで採点する
+    results, pending = _split_cached(comments, cache, cache_params)
+    if local_model is not None and pending:
+        remaining = []
+        for i, analysis in zip(pending, local_model.triage([comments[i] for i in pending])):
+            if analysis is None:
+                remaining.append(i)
+            else:
+                results[i] = analysis
+        pending = remaining
+
+    parsed = {}
+    if len(pending) > 1:
+        pending_comments = [comments[i] for i in pending]
+        try:
+            if scores_only:
+                raw = await complete(
+                    template.batch(pending_comments, scores_only=True),
+                    expected_output_tokens=SCORES_OUTPUT_TOKENS_PER_COMMENT * len(pending),
+                    response_format=scores_response_format(batch=True),
+                )
+                parsed = parse_batch_scores(raw, len(pending))
+            else:
+                raw = await complete(
+                    template.batch(pending_comments),
+                    expected_output_tokens=OUTPUT_TOKENS_PER_COMMENT * len(pending),
+                )
+                parsed = parse_batch_response(raw, len(pending))
+            _count_parse_failures(len(pending) - len(parsed))
+        except Exception as e:
+            METRICS.record_error("analyze_batch", e)
+            parsed = {}
+
+    retry = _store_parsed(comments, pending, parsed, results, cache, cache_params)
+    if retry:
+        singles = await asyncio.gather(*[analyze_single_async(comments[i]) for i in retry])
+        for i, analysis in zip(retry, singles):
+            results[i] = analysis
+    return results
@@ -0,0 +1,237 @@
+# -----------------------------------------------------------
+# OpenAI Batch API バックエンド（夜間の一括分析用）
+# -----------------------------------------------------------
+# 1コメント=1リクエストのプロンプトを Batch API の入力JSONL（custom_id 付き）に書き出し、
+# 提出 → 完了までポーリング → 出力JSONLを1行ずつ読み戻す。
+# 同期APIより安く、RPM/TPM の制限も受けないので、チャンネル単位の大量分析に向く。
+#
+# バックエンドは submit / status / download の3つと batch_pricing（Batch API の割引料金が効くか）を持つクラスなら何でもよい。
+# - OpenAIBatchBackend: 本物の Batch API
+# - LocalBatchBackend : 同じファイル形式で手元の関数（同期APIなど）を呼ぶ代替（CLI の --batch-api local。動作確認用）
+import json
+import os
+import shutil
+import time
+import uuid
+
+BATCH_ENDPOINT = "/v1/chat/completions"
+COMPLETION_WINDOW = "24h"
+MAX_REQUESTS_PER_FILE = 50_000  # Batch API の1ファイルあたりの上限
+DEFAULT_POLL_SECONDS = 60
+TERMINAL_STATES = ("completed", "failed", "expired", "cancelled")
+
+
+def make_request_line(custom_id, prompt, model, temperature, response_format=None):
+    body = {
+        "model": model,
+        "messages": [{"role": "user", "content": prompt}],
+        "temperature": temperature,
+    }
+    if response_format is not None:
+        body["response_format"] = response_format
+    return {"custom_id": custom_id, "method": "POST", "url": BATCH_ENDPOINT, "body": body}
+
+
+def write_batch_inputs(requests, directory, model, temperature, response_format=None, prefix="batch_input",
+                       max_per_file=MAX_REQUESTS_PER_FILE):
+    # requests: [(custom_id, prompt), ...] を上限件数ごとのJSONLに分けて書き、パスのリストを返す
+    os.makedirs(directory, exist_ok=True)
+    run_id = time.strftime("%Y%m%d-%H%M%S")
+    paths = []
+    for start in range(0, len(requests), max_per_file):
+        path = os.path.join(directory, f"{prefix}-{run_id}-{len(paths):03d}.jsonl")
+        with open(path, "w", encoding="utf-8") as f:
+            for custom_id, prompt in requests[start:start + max_per_file]:
+                f.write(json.dumps(make_request_line(custom_id, prompt, model, temperature, response_format), ensure_ascii=False) + "\n")
+        paths.append(path)
+    return paths
+
+
+class OpenAIBatchBackend:
+    batch_pricing = True
+
+    def __init__(self, client):
+        self.client = client
+
+    def submit(self, input_path):
+        with open(input_path, "rb") as f:
+            uploaded = self.client.files.create(file=f, purpose="batch")
+        batch = self.client.batches.create(
+            input_file_id=uploaded.id,
+            endpoint=BATCH_ENDPOINT,
+            completion_window=COMPLETION_WINDOW,
+        )
+        return batch.id
+
+    def status(self, batch_id):
+        batch = self.client.batches.retrieve(batch_id)
+        counts = batch.request_counts
+        return {
+            "id": batch_id,
+            "state": batch.status,
+            "total": counts.total if counts else 0,
+            "completed": counts.completed if counts else 0,
+            "failed": counts.failed if counts else 0,
+            "output_file_id": batch.output_file_id,
+            "error_file_id": batch.error_file_id,
+        }
+
+    def download(self, status, dest_path):
+        # 出力ファイルとエラーファイル（どちらも同じ形式のJSONL）を1つにまとめて保存する
+        tmp_path = dest_path + ".tmp"
+        with open(tmp_path, "wb") as out:
+            for file_id in (status.get("output_file_id"), status.get("error_file_id")):
+                if not file_id:
+                    continue
+                last = b"\n"
+                for chunk in self.client.files.content(file_id).iter_bytes():
+                    if chunk:
+                        out.write(chunk)
+                        last = chunk[-1:]
+                if last != b"\n":
+                    out.write(b"\n")
+        os.replace(tmp_path, dest_path)
+
+
+class LocalBatchBackend:
+    # Batch API と同じ入出力形式で、complete(リクエストの body) -> 応答の body（choices・usage）を手元で呼ぶ代替
+    # 同期APIで呼ぶなら料金は通常どおり（Batch API の割引は効かない）
+    batch_pricing = False
+
+    def __init__(self, directory, complete):
+        self.directory = directory
+        self.complete = complete
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, batch_id, kind):
+        return os.path.join(self.directory, f"{batch_id}.{kind}.jsonl")
+
+    def submit(self, input_path):
+        batch_id = f"local_batch_{uuid.uuid4().hex[:12]}"
+        shutil.copyfile(input_path, self._path(batch_id, "input"))
+        return batch_id
+
+    def _process(self, batch_id):
+        total = 0
+        tmp_path = self._path(batch_id, "output") + ".tmp"
+        with open(self._path(batch_id, "input"), encoding="utf-8") as src, open(tmp_path, "w", encoding="utf-8") as dst:
+            for line in src:
+                if not line.strip():
+                    continue
+                request = json.loads(line)
+                total += 1
+                try:
+                    response = {
+                        "status_code": 200,
+                        "request_id": f"local_req_{total}",
+                        "body": self.complete(request["body"]),
+                    }
+                    error = None
+                except Exception as e:
+                    response = None
+                    error = {"code": "local_error", "message": str(e)}
+                record = {"id": f"batch_req_{total}", "custom_id": request["custom_id"], "response": response, "error": error}
+                dst.write(json.dumps(record, ensure_ascii=False) + "\n")
+        os.replace(tmp_path, self._path(batch_id, "output"))
+
+    def status(self, batch_id):
+        # 最初の問い合わせで全件を処理し、以後は完了として返す
+        output_path = self._path(batch_id, "output")
+        if not os.path.exists(output_path):
+            self._process(batch_id)
+        with open(output_path, encoding="utf-8") as f:
+            errors = [json.loads(line).get("error") for line in f if line.strip()]
+        total, failed = len(errors), sum(1 for e in errors if e)
+        return {
+            "id": batch_id,
+            "state": "completed",
+            "total": total,
+            "completed": total - failed,
+            "failed": failed,
+            "output_file_id": output_path,
+            "error_file_id": None,
+        }
+
+    def download(self, status, dest_path):
+        shutil.copyfile(status["output_file_id"], dest_path)
+
+
+def wait_for_batch(backend, batch_id, poll_seconds=DEFAULT_POLL_SECONDS, timeout=None, on_status=None):
+    started = time.time()
+    while True:
+        status = backend.status(batch_id)
+        if on_status is not None:
+            on_status(status)
+        if status["state"] in TERMINAL_STATES:
+            return status
+        if timeout is not None and time.time() - started > timeout:
+            raise TimeoutError(f"バッチ {batch_id} が {timeout} 秒以内に終わりませんでした（状態: {status['state']}）")
+        time.sleep(poll_seconds)
+
+
+def output_path_for(input_path):
+    return input_path[:-len(".jsonl")] + ".output.jsonl" if input_path.endswith(".jsonl") else input_path + ".output"
+
+
+def run_batch_file(backend, input_path, poll_seconds=DEFAULT_POLL_SECONDS, timeout=None, on_status=None):
+    # 入力JSONLを1つ提出し、完了を待って出力JSONLのパスを返す
+    # 提出したバッチIDを <入力>.batch_id に残すので、途中で落ちても再提出せずにポーリングから再開できる
+    output_path = output_path_for(input_path)
+    if os.path.exists(output_path):
+        return output_path
+    state_path = input_path + ".batch_id"
+    if os.path.exists(state_path):
+        with open(state_path, encoding="utf-8") as f:
+            batch_id = f.read().strip()
+    else:
+        batch_id = backend.submit(input_path)
+        with open(state_path, "w", encoding="utf-8") as f:
+            f.write(batch_id)
+
+    status = wait_for_batch(backend, batch_id, poll_seconds=poll_seconds, timeout=timeout, on_status=on_status)
+    # 期限切れ・キャンセルでも処理済みの分は出力ファイルに入っているので取り込む
+    if not status.get("output_file_id") and not status.get("error_file_id"):
+        # 出力のないまま終わったバッチのIDは <入力>.batch_id.failed に退避し、次の実行では新しく提出し直す
+        os.replace(state_path, state_path + ".failed")
+        raise RuntimeError(f"バッチ {batch_id} が {status['state']} で終了し、出力がありません（次の実行で再提出します）")
+    backend.download(status, output_path)
+    os.remove(state_path)
+    return output_path
+
+
+def pending_inputs(directory, prefix="batch_input"):
+    # 前回の実行で書き出したまま結果を取り込み終えていない入力ファイル
+    # （取り込みが済んだら呼び出し側で入力・出力ファイルを消す）
+    if not os.path.isdir(directory):
+        return []
+    return sorted(
+        os.path.join(directory, name)
+        for name in os.listdir(directory)
+        if name.startswith(prefix) and name.endswith(".jsonl") and not name.endswith(".output.jsonl")
+    )
+
+
+def iter_batch_results(path):
+    # 出力JSONLを1行ずつ読み、(custom_id, 応答本文 or None, エラー内容 or None, トークン使用量 or None) を返す
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            custom_id = record.get("custom_id")
+            response = record.get("response") or {}
+            body = response.get("body") or {}
+            usage = body.get("usage") if isinstance(body, dict) else None
+            if record.get("error") or response.get("status_code") != 200:
+                error = record.get("error") or (body.get("error") if isinstance(body, dict) else None) or response.get("status_code")
+                yield custom_id, None, str(error), usage
+                continue
+            try:
+                content = body["choices"][0]["message"]["content"]
+            except (KeyError, IndexError, TypeError):
+                yield custom_id, None, "応答の形式が不正です", usage
+                continue
+            yield custom_id, (content or "").strip(), None, usage
@@ -0,0 +1,329 @@
+# -----------------------------------------------------------
+# ベンチマーク用の YouTube / OpenAI のローカル代替
+# -----------------------------------------------------------
+# 本物のクォータやAPI料金を使わずに、app.py / analyze_video_comments.py と同じコードを動かすためのもの。
+# - YouTube: youtube.commentThreads().list / list_next と youtube.search().list
+# - OpenAI : chat.completions.create（同期 OpenAI / 非同期 AsyncOpenAI）
+# 応答の遅延分布・429の割合・壊れたJSONの割合を設定できる。
+# 乱数は「シード＋リクエスト内容＋同じ内容での試行回数」から決めるので、
+# 並行実行の順番が変わっても同じ設定なら同じ結果になる。
+import asyncio
+import hashlib
+import json
+import math
+import random
+import threading
+import time
+
+import openai
+
+DEFAULT_CONFIG = {
+    "seed": 1234,
+    # YouTube 1ページあたりの遅延（"fixed:秒" / "uniform:最小,最大" / "lognormal:中央値,σ"）
+    "youtube_latency": "lognormal:0.08,0.3",
+    # OpenAI 1リクエストあたりの遅延（バッチは件数に応じて伸ばす）
+    "openai_latency": "lognormal:0.5,0.4",
+    "openai_latency_per_item": 0.01,
+    "rate_limit_rate": 0.02,       # 429 を返す割合
+    "retry_after_ms": 200,         # 429 に付ける retry-after-ms
+    "malformed_rate": 0.01,        # 壊れたJSONを返す割合
+    "duplicate_rate": 0.2,         # 合成コメントのうち既出コメントの使い回しの割合
+    "long_comment_rate": 0.01,     # 数千文字の長文コメントの割合
+}
+
+FEATURE_KEYS = ["攻撃性", "挑発性", "有用性", "感情極性", "自己顕示性", "文脈依存性"]
+_WORDS = [
+    "草", "神回", "編集", "すごい", "わかりやすい", "BGM", "うるさい", "次回", "楽しみ", "信者",
+    "アンチ", "論破", "ありがとう", "最高", "残念", "初見", "例のあの件", "データ", "出典", "年収",
+]
+
+CALLS = {
+    "youtube_comment_threads": 0,
+    "youtube_search": 0,
+    "chat_completions": 0,
+    "rate_limited": 0,
+    "malformed": 0,
+}
+# chat.completions.create 1回ごとの実測の所要時間（秒）
+CALL_LATENCIES = []
+_calls_lock = threading.Lock()
+_attempts = {}
+CONFIG = dict(DEFAULT_CONFIG)
+
+
+def _count(name):
+    with _calls_lock:
+        CALLS[name] += 1
+
+
+def _rng(*parts):
+    # 内容と試行回数から決まる乱数（実行順に依存しない）
+    key = "\x00".join(str(p) for p in (CONFIG["seed"],) + parts)
+    with _calls_lock:
+        attempt = _attempts.get(key, 0)
+        _attempts[key] = attempt + 1
+    digest = hashlib.sha256(f"{key}\x00{attempt}".encode("utf-8")).digest()
+    return random.Random(int.from_bytes(digest[:8], "big"))
+
+
+def sample_latency(spec, rng):
+    kind, _, args = spec.partition(":")
+    values = [float(v) for v in args.split(",") if v]
+    if kind == "fixed":
+        return values[0]
+    if kind == "uniform":
+        return rng.uniform(values[0], values[1])
+    if kind == "lognormal":
+        median, sigma = values
+        return median * math.exp(rng.gauss(0.0, sigma))
+    raise ValueError(f"未対応の遅延分布です: {spec}")
+
+
+# --- 合成データ -------------------------------------------------------
+def synthetic_comments(video_id, n):
+    rng = random.Random(f"{CONFIG['seed']}:{video_id}")
+    comments = []
+    for i in range(n):
+        if comments and rng.random() < CONFIG["duplicate_rate"]:
+            text = rng.choice(comments)["text"]
+        elif rng.random() < CONFIG["long_comment_rate"]:
+            text = "".join(rng.choice(_WORDS) for _ in range(1500))
+        else:
+            text = f"{video_id}-{i} " + " ".join(rng.choice(_WORDS) for _ in range(rng.randint(1, 30)))
+        comments.append({
+            "id": f"{video_id}-c{i}",
+            "text": text,
+            "published_at": f"2024-{1 + i % 12:02d}-{1 + i % 28:02d}T00:00:00Z",
+        })
+    return comments
+
+
+# --- YouTube ----------------------------------------------------------
+class _Request:
+    def __init__(self, youtube, resource, params):
+        self.youtube = youtube
+        self.resource = resource
+        self.params = params
+        self.headers = {}
+        self.uri = f"mock://youtube/{resource}"
+
+    def execute(self, **kwargs):
+        return self.youtube._execute(self.resource, self.params)
+
+
+class _Resource:
+    def __init__(self, youtube, name):
+        self.youtube = youtube
+        self.name = name
+
+    def list(self, **params):
+        return _Request(self.youtube, self.name, params)
+
+    def list_next(self, previous_request, previous_response):
+        token = previous_response.get("nextPageToken")
+        if not token:
+            return None
+        return _Request(self.youtube, self.name, dict(previous_request.params, pageToken=token))
+
+
+class MockYouTube:
+    def __init__(self, comments_per_video):
+        self.comments_per_video = comments_per_video
+        self._videos = {}
+        self._lock = threading.Lock()
+
+    def commentThreads(self):
+        return _Resource(self, "commentThreads")
+
+    def search(self):
+        return _Resource(self, "search")
+
+    def _comments(self, video_id):
+        with self._lock:
+            if video_id not in self._videos:
+                self._videos[video_id] = synthetic_comments(video_id, self.comments_per_video)
+            return self._videos[video_id]
+
+    def _execute(self, resource, params):
+        rng = _rng("youtube", resource, json.dumps(params, sort_keys=True, ensure_ascii=False))
+        time.sleep(sample_latency(CONFIG["youtube_latency"], rng))
+        start = int(params.get("pageToken") or 0)
+        limit = int(params.get("maxResults") or 20)
+        if resource == "search":
+            _count("youtube_search")
+            items = [
+                {"id": {"videoId": f"vid{i:08d}"}, "snippet": {"title": f"{params.get('q', '')} 動画 {i}", "thumbnails": {}}}
+                for i in range(start, start + limit)
+            ]
+            return {"items": items, "nextPageToken": str(start + limit), "etag": f"search-{start}"}
+
+        _count("youtube_comment_threads")
+        comments = self._comments(params["videoId"])
+        items = []
+        for c in comments[start:start + limit]:
+            snippet = {"textDisplay": c["text"], "publishedAt": c["published_at"], "likeCount": 0}
+            items.append({
+                "id": c["id"],
+                "snippet": {"topLevelComment": {"id": c["id"], "snippet": snippet}, "totalReplyCount": 0},
+            })
+        response = {"items": items, "etag": f"threads-{params['videoId']}-{start}"}
+        if start + limit < len(comments):
+            response["nextPageToken"] = str(start + limit)
+        return response
+
+
+# --- OpenAI -----------------------------------------------------------
+class _Usage:
+    def __init__(self, prompt_tokens, completion_tokens):
+        self.prompt_tokens = prompt_tokens
+        self.completion_tokens = completion_tokens
+        self.total_tokens = prompt_tokens + completion_tokens
+        self.prompt_tokens_details = None
+
+
+class _Message:
+    def __init__(self, content):
+        self.role = "assistant"
+        self.content = content
+
+
+class _Choice:
+    def __init__(self, content):
+        self.index = 0
+        self.message = _Message(content)
+        self.finish_reason = "stop"
+
+
+class _Response:
+    def __init__(self, content, usage):
+        self.choices = [_Choice(content)]
+        self.usage = usage
+
+
+def _scores_for(text):
+    digest = hashlib.md5(str(text).encode("utf-8")).digest()
+    scores = {key: digest[i] % 4 for i, key in enumerate(FEATURE_KEYS)}
+    scores["感情極性"] = digest[3] % 5 - 2
+    return scores
+
+
+def _answer(prompt, response_format):
+    head, _, target = prompt.rpartition("# 分析対象コメント\n")
+    scores_only = response_format is not None
+    try:
+        items = json.loads(target)
+        batch = isinstance(items, list)
+    except ValueError:
+        batch = False
+    if not batch:
+        if "既に次のスコア" in head:
+            return "ベンチマーク用の説明文です。"
+        scores = _scores_for(target)
+        if scores_only:
+            return json.dumps(scores, ensure_ascii=False)
+        result = {k: {"score": v} for k, v in scores.items()}
+        result["総合コメント"] = "ベンチマーク用の総合コメントです。"
+        return json.dumps(result, ensure_ascii=False)
+
+    results = []
+    for item in items:
+        scores = _scores_for(item["comment"])
+        if scores_only:
+            results.append(dict({"index": item["index"]}, **scores))
+        else:
+            entry = {"index": item["index"]}
+            entry.update({k: {"score": v} for k, v in scores.items()})
+            entry["総合コメント"] = "ベンチマーク用の総合コメントです。"
+            results.append(entry)
+    if scores_only:
+        return json.dumps({"results": results}, ensure_ascii=False)
+    return json.dumps(results, ensure_ascii=False)
+
+
+def _plan(kwargs):
+    # (遅延秒, 返す本文 or None, 429 にするか)
+    prompt = kwargs["messages"][-1]["content"]
+    rng = _rng("openai", prompt, json.dumps(kwargs.get("response_format"), sort_keys=True))
+    n_items = max(1, prompt.count('"index":'))
+    delay = sample_latency(CONFIG["openai_latency"], rng) + CONFIG["openai_latency_per_item"] * n_items
+    if rng.random() < CONFIG["rate_limit_rate"]:
+        return delay * 0.1, None, True
+    content = _answer(prompt, kwargs.get("response_format"))
+    if rng.random() < CONFIG["malformed_rate"]:
+        _count("malformed")
+        content = content[: max(1, len(content) // 2)]
+    return delay, content, False
+
+
+class _HTTPResponse:
+    # openai.RateLimitError が参照する属性だけを持つ429応答（httpx のバージョン差を避ける）
+    def __init__(self, status_code, headers):
+        self.status_code = status_code
+        self.headers = headers
+        self.request = None
+
+
+def _rate_limit_error():
+    _count("rate_limited")
+    response = _HTTPResponse(429, {"retry-after-ms": str(CONFIG["retry_after_ms"])})
+    return openai.RateLimitError("mock rate limit", response=response, body=None)
+
+
+def _usage(kwargs, content):
+    prompt = kwargs["messages"][-1]["content"]
+    return _Usage(len(prompt) // 2 + 1, len(content) // 2 + 1)
+
+
+class _Completions:
+    def create(self, **kwargs):
+        _count("chat_completions")
+        started = time.perf_counter()
+        delay, content, limited = _plan(kwargs)
+        time.sleep(delay)
+        CALL_LATENCIES.append(time.perf_counter() - started)
+        if limited:
+            raise _rate_limit_error()
+        return _Response(content, _usage(kwargs, content))
+
+
+class _AsyncCompletions:
+    async def create(self, **kwargs):
+        _count("chat_completions")
+        started = time.perf_counter()
+        delay, content, limited = _plan(kwargs)
+        await asyncio.sleep(delay)
+        CALL_LATENCIES.append(time.perf_counter() - started)
+        if limited:
+            raise _rate_limit_error()
+        return _Response(content, _usage(kwargs, content))
+
+
+class _Chat:
+    def __init__(self, completions):
+        self.completions = completions
+
+
+class MockOpenAI:
+    def __init__(self, **kwargs):
+        self.chat = _Chat(_Completions())
+
+
+class MockAsyncOpenAI:
+    def __init__(self, **kwargs):
+        self.chat = _Chat(_AsyncCompletions())
+
+    async def close(self):
+        pass
+
+
+def install(config=None, comments_per_video=120):
+    # googleapiclient / openai のクライアント生成を差し替える（app.py / CLI を import する前に呼ぶ）
+    import googleapiclient.discovery
+
+    CONFIG.update(config or {})
+    youtube = MockYouTube(comments_per_video)
+    googleapiclient.discovery.build = lambda *args, **kwargs: youtube
+    googleapiclient.discovery.build_from_document = lambda *args, **kwargs: youtube
+    openai.OpenAI = MockOpenAI
+    openai.AsyncOpenAI = MockAsyncOpenAI
+    return youtube
@@ -0,0 +1,356 @@
+# -----------------------------------------------------------
+# オフライン・ベンチマーク（YouTube / OpenAI はローカルの代替を使う）
+# -----------------------------------------------------------
+# 使い方:
+#   python benchmarks/run_benchmarks.py                              # cli/app × 120,1k,10k,100k
+#   python benchmarks/run_benchmarks.py --sizes 120,1000 --out benchmarks/results/latest.json
+#   python benchmarks/run_benchmarks.py --baseline benchmarks/results/baseline.json --tolerance 0.2
+#   python benchmarks/run_benchmarks.py --set rate_limit_rate=0.1 --set openai_latency=fixed:0.2
+#
+# シナリオ:
+#   cli: analyze_video_comments.analyze_video_async → build_records → DataFrame（CLI・一括ジョブと同じ経路）
+#   app: streamlit の AppTest で app.py を動かす（検索 → 選択 → 分析 → フィルタ）。
+#        app.py は1動画120件固定で取得するので 120 以外のサイズはスキップとして記録する
+#
+# 各（シナリオ, 件数）は別プロセスで実行する（ピークRSSを混ぜないため・キャッシュを空から始めるため）。
+# 結果は1つのJSONに書き出し、--baseline を渡すと件数/秒とp95の悪化が許容幅を超えたときに終了コード1で終わる。
+import argparse
+import asyncio
+import json
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+DEFAULT_SIZES = [120, 1000, 10_000, 100_000]
+DEFAULT_SCENARIOS = ["cli", "app"]
+APP_COMMENTS = 120  # app.py の1回あたりの取得件数
+APP_POLL_SECONDS = 0.2  # app シナリオで分析ジョブの完了を確認する間隔
+DEFAULT_TOLERANCE = 0.2
+
+# ベンチマーク中のエンジン設定（レート制限はモック側の429で再現するので、ここでは十分大きくする）
+BENCH_ENV = {
+    "YOUTUBE_API_KEY": "bench",
+    "OPENAI_API_KEY": "bench",
+    "OPENAI_RPM": "100000",
+    "OPENAI_TPM": "1000000000",
+    "OPENAI_INITIAL_CONCURRENCY": "32",
+    "OPENAI_MAX_CONCURRENCY": "128",
+}
+
+
+def percentile(values, q):
+    if not values:
+        return None
+    values = sorted(values)
+    k = (len(values) - 1) * q
+    lo = int(k)
+    hi = min(lo + 1, len(values) - 1)
+    return values[lo] + (values[hi] - values[lo]) * (k - lo)
+
+
+def peak_rss_mb():
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux は KB、macOS はバイト
+    return usage / (1024 * 1024) if sys.platform == "darwin" else usage / 1024
+
+
+def parse_config(pairs):
+    config = {}
+    for pair in pairs or []:
+        key, _, value = pair.partition("=")
+        try:
+            config[key] = json.loads(value)
+        except ValueError:
+            config[key] = value
+    return config
+
+
+# --- ワーカー（1シナリオ×1件数） ------------------------------------
+def _prepare_worker(config, size, work_dir):
+    # 環境変数とモックの差し込みは app.py / CLI を import する前に済ませる
+    os.environ.update(BENCH_ENV)
+    os.environ["ANALYSIS_CACHE_PATH"] = os.path.join(work_dir, "analysis_cache.sqlite3")
+    os.environ["YOUTUBE_CACHE_PATH"] = os.path.join(work_dir, "youtube_cache.sqlite3")
+    os.environ["VIDEO_STATE_PATH"] = os.path.join(work_dir, "video_state.sqlite3")
+    sys.path.insert(0, REPO_DIR)
+    sys.path.insert(0, BENCH_DIR)
+
+    import mock_services
+    mock_services.install(config, comments_per_video=size)
+
+    # LLM 1リクエスト（リトライ込み）ごとの所要時間と、使われたエンジンを記録する
+    import async_engine
+    latencies = []
+    engines = []
+    original = async_engine.AnalysisEngine.complete
+
+    async def timed_complete(self, *args, **kwargs):
+        if self not in engines:
+            engines.append(self)
+        started = time.perf_counter()
+        try:
+            return await original(self, *args, **kwargs)
+        finally:
+            latencies.append(time.perf_counter() - started)
+
+    async_engine.AnalysisEngine.complete = timed_complete
+    return mock_services, latencies, engines
+
+
+def _latency_ms(values):
+    return {
+        "p50": _ms(percentile(values, 0.50)),
+        "p95": _ms(percentile(values, 0.95)),
+        "p99": _ms(percentile(values, 0.99)),
+        "count": len(values),
+    }
+
+
+def _stage_metrics():
+    # アプリ側の計測（metrics.METRICS）の区間ごとの回数・合計・p95
+    from metrics import METRICS
+    return {
+        name: {"count": m["count"], "total_seconds": round(m["total_seconds"], 3), "p95_ms": _ms(m["p95_seconds"])}
+        for name, m in METRICS.snapshot()["stages"].items()
+    }
+
+
+def _summary(scenario, size, elapsed, rows, ok, latencies, engines, mock_services, stages=None):
+    stats = {}
+    for engine in engines:
+        for key, value in engine.stats.items():
+            stats[key] = stats.get(key, 0) + value
+    return {
+        "scenario": scenario,
+        "size": size,
+        "status": "ok",
+        "elapsed_seconds": round(elapsed, 3),
+        "comments_per_second": round(rows / elapsed, 2) if elapsed > 0 else None,
+        "rows": rows,
+        "analyzed_ok": ok,
+        "failed": rows - ok,
+        # 分析1リクエストの所要時間（同時実行数の空き待ち・リトライ込み）
+        "llm_latency_ms": _latency_ms(latencies),
+        # API呼び出し1回の所要時間（待ち行列を含まない）
+        "api_latency_ms": _latency_ms(mock_services.CALL_LATENCIES),
+        "peak_rss_mb": round(peak_rss_mb(), 1),
+        "api_calls": dict(mock_services.CALLS),
+        "engine": stats,
+        "stages": stages or {},
+        "stage_metrics": _stage_metrics(),
+    }
+
+
+def _ms(seconds):
+    return None if seconds is None else round(seconds * 1000, 1)
+
+
+def run_cli_worker(size, config, work_dir):
+    mock_services, latencies, engines = _prepare_worker(config, size, work_dir)
+    import pandas as pd
+    import analyze_video_comments as cli
+    from async_engine import engine_from_env
+
+    async def _run():
+        async with engine_from_env(cli.OPENAI_API_KEY, cli.MODEL_NAME, cli.TEMPERATURE) as engine:
+            return await cli.analyze_video_async(engine, "benchvideo01", max_comments=size)
+
+    started = time.perf_counter()
+    comments, dup_index, analyzed, fetch_errors = asyncio.run(_run())
+    analyzed_at = time.perf_counter()
+    df = pd.DataFrame(cli.build_records(comments, dup_index, analyzed))
+    elapsed = time.perf_counter() - started
+    if fetch_errors:
+        raise fetch_errors[0]
+    ok = sum(1 for i in range(len(comments)) if cli.is_valid_analysis(analyzed.get(dup_index.group_of[i])))
+    stages = {
+        "fetch_and_analyze_seconds": round(analyzed_at - started, 3),
+        "build_frame_seconds": round(elapsed - (analyzed_at - started), 3),
+        "duplicate_groups": len(set(dup_index.group_of)),
+    }
+    return _summary("cli", size, elapsed, len(df), ok, latencies, engines, mock_services, stages)
+
+
+def run_app_worker(size, config, work_dir):
+    mock_services, latencies, engines = _prepare_worker(config, size, work_dir)
+    from streamlit.testing.v1 import AppTest
+
+    os.chdir(work_dir)
+    at = AppTest.from_file(os.path.join(REPO_DIR, "app.py"), default_timeout=600).run()
+    stages = {}
+
+    started = time.perf_counter()
+    at.text_input[0].input("ベンチマーク").run()
+    next(b for b in at.button if b.label == "検索").click().run()
+    stages["search_seconds"] = round(time.perf_counter() - started, 3)
+
+    t = time.perf_counter()
+    next(b for b in at.button if b.label == "選択").click().run()
+    stages["select_seconds"] = round(time.perf_counter() - t, 3)
+
+    # 分析はバックグラウンドのジョブで動くので、画面の再実行（ポーリング）で結果が取り込まれるまで待つ
+    t = time.perf_counter()
+    next(b for b in at.button if "コメント分析" in b.label).click().run()
+    while at.session_state["analysis_jobs"] and not at.exception:
+        time.sleep(APP_POLL_SECONDS)
+        at.run()
+    analyze_seconds = time.perf_counter() - t
+    stages["analyze_seconds"] = round(analyze_seconds, 3)
+    if at.exception:
+        raise RuntimeError(str(at.exception[0].value))
+
+    t = time.perf_counter()
+    at.sidebar.radio[0].set_value("平和モード").run()
+    stages["filter_seconds"] = round(time.perf_counter() - t, 3)
+
+    df = at.session_state["analysis_df_raw"]
+    rows = 0 if df is None else len(df)
+    ok = 0 if df is None else int(df["攻撃性_score"].notna().sum())
+    return _summary("app", size, analyze_seconds, rows, ok, latencies, engines, mock_services, stages)
+
+
+WORKERS = {"cli": run_cli_worker, "app": run_app_worker}
+
+
+def worker_main(args):
+    config = json.loads(args.config_json)
+    work_dir = tempfile.mkdtemp(prefix="yt-bench-")
+    try:
+        result = WORKERS[args.worker](args.size, config, work_dir)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    with open(args.result_file, "w", encoding="utf-8") as f:
+        json.dump(result, f, ensure_ascii=False)
+
+
+# --- 親プロセス -------------------------------------------------------
+def run_case(scenario, size, config):
+    if scenario == "app" and size != APP_COMMENTS:
+        return {"scenario": scenario, "size": size, "status": "skipped",
+                "reason": f"app.py は1回 {APP_COMMENTS} 件固定で取得します"}
+    fd, result_file = tempfile.mkstemp(suffix=".json")
+    os.close(fd)
+    try:
+        proc = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), "--worker", scenario, "--size", str(size),
+             "--config-json", json.dumps(config), "--result-file", result_file],
+            cwd=REPO_DIR, capture_output=True, text=True,
+        )
+        if proc.returncode != 0:
+            return {"scenario": scenario, "size": size, "status": "error",
+                    "reason": (proc.stderr or proc.stdout).strip().splitlines()[-1:] or ["不明なエラー"]}
+        with open(result_file, encoding="utf-8") as f:
+            return json.load(f)
+    finally:
+        os.remove(result_file)
+
+
+def environment_info(config):
+    commit = None
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=REPO_DIR, capture_output=True, text=True
+        ).stdout.strip() or None
+    except OSError:
+        pass
+    from mock_services import DEFAULT_CONFIG
+    return {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "git_commit": commit,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "mock_config": dict(DEFAULT_CONFIG, **config),
+        "engine_env": BENCH_ENV,
+    }
+
+
+def compare_with_baseline(results, baseline, tolerance):
+    # 件数/秒が (1 - tolerance) 倍未満、または p95 が (1 + tolerance) 倍を超えたものを返す
+    base = {(r["scenario"], r["size"]): r for r in baseline.get("results", []) if r.get("status") == "ok"}
+    regressions = []
+    for r in results:
+        b = base.get((r["scenario"], r["size"]))
+        if r.get("status") != "ok" or b is None:
+            continue
+        if b["comments_per_second"] and r["comments_per_second"] < b["comments_per_second"] * (1 - tolerance):
+            regressions.append(f"{r['scenario']}/{r['size']}: 件数/秒 {b['comments_per_second']} → {r['comments_per_second']}")
+        b95, r95 = b["llm_latency_ms"]["p95"], r["llm_latency_ms"]["p95"]
+        if b95 and r95 and r95 > b95 * (1 + tolerance):
+            regressions.append(f"{r['scenario']}/{r['size']}: p95 {b95}ms → {r95}ms")
+    return regressions
+
+
+def print_table(results):
+    print(f"{'scenario':<8} {'size':>7} {'status':<8} {'件数/秒':>9} {'p50ms':>8} {'p95ms':>8} {'p99ms':>8} "
+          f"{'RSS MB':>8} {'YT':>6} {'LLM':>6} {'429':>5} {'失敗':>5}")
+    for r in results:
+        if r.get("status") != "ok":
+            print(f"{r['scenario']:<8} {r['size']:>7} {r['status']:<8} {r.get('reason')}")
+            continue
+        lat, calls = r["llm_latency_ms"], r["api_calls"]
+        print(
+            f"{r['scenario']:<8} {r['size']:>7} {'ok':<8} {r['comments_per_second']:>9} "
+            f"{lat['p50'] or '-':>8} {lat['p95'] or '-':>8} {lat['p99'] or '-':>8} {r['peak_rss_mb']:>8} "
+            f"{calls['youtube_comment_threads'] + calls['youtube_search']:>6} {calls['chat_completions']:>6} "
+            f"{calls['rate_limited']:>5} {r['failed']:>5}"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="YouTubeコメント分析のオフライン・ベンチマーク")
+    parser.add_argument("--sizes", default=",".join(str(s) for s in DEFAULT_SIZES), help="コメント件数（カンマ区切り）")
+    parser.add_argument("--scenarios", default=",".join(DEFAULT_SCENARIOS), help="cli,app のどれを実行するか")
+    parser.add_argument("--set", action="append", metavar="KEY=VALUE",
+                        help="モックの設定を上書き（例: rate_limit_rate=0.1, openai_latency=fixed:0.2）")
+    parser.add_argument("--out", default=os.path.join(BENCH_DIR, "results", "latest.json"), help="結果JSONの出力先")
+    parser.add_argument("--baseline", help="比較する過去の結果JSON")
+    parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE, help="許容する悪化の割合")
+    # 以下は内部用（子プロセスとして1ケースを実行する）
+    parser.add_argument("--worker", choices=sorted(WORKERS), help=argparse.SUPPRESS)
+    parser.add_argument("--size", type=int, help=argparse.SUPPRESS)
+    parser.add_argument("--config-json", default="{}", help=argparse.SUPPRESS)
+    parser.add_argument("--result-file", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        worker_main(args)
+        return
+
+    sys.path.insert(0, BENCH_DIR)
+    config = parse_config(args.set)
+    results = []
+    for scenario in [s.strip() for s in args.scenarios.split(",") if s.strip()]:
+        for size in [int(s) for s in args.sizes.split(",") if s.strip()]:
+            print(f"▶ {scenario} / {size} 件 ...", flush=True)
+            results.append(run_case(scenario, size, config))
+
+    report = {"environment": environment_info(config), "results": results}
+    os.makedirs(os.path.dirname(os.path.abspath(args.out)), exist_ok=True)
+    with open(args.out, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print_table(results)
+    print(f"✅ 結果を {args.out} に保存しました。")
+
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            regressions = compare_with_baseline(results, json.load(f), args.tolerance)
+        if regressions:
+            print("🛑 ベースラインから悪化しています:")
+            for line in regressions:
+                print(f"  - {line}")
+            sys.exit(1)
+        print(f"✅ ベースライン比で許容範囲内です（±{args.tolerance:.0%}）。")
+    if any(r["status"] == "error" for r in results):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
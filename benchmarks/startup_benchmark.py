@@ -0,0 +1,179 @@
+# -----------------------------------------------------------
+# 起動時間のベンチマーク（コールドスタート）
+# -----------------------------------------------------------
+# 使い方:
+#   python benchmarks/startup_benchmark.py                     # 作業ツリーを計測
+#   python benchmarks/startup_benchmark.py --ref HEAD~1        # 過去のコミットと並べて比較
+#   python benchmarks/startup_benchmark.py --repeat 10 --out benchmarks/results/startup.json
+#
+# 計測項目（どれも毎回新しいプロセスで計測するので、モジュールは読み込まれていない状態から始まる）:
+#   cli_import     : import analyze_video_comments にかかる時間
+#   cli_help       : python analyze_video_comments.py --help の終了までの時間
+#   app_first_run  : streamlit の AppTest で app.py を1回実行する時間（最初の画面＝検索画面の描画まで）
+#   youtube_client : YouTube クライアントの作成（googleapiclient の読み込みは除く。ライブラリの discovery 文書 vs 同梱の文書）
+# APIキーはダミーを使い、ネットワークには接続しない。
+import argparse
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tarfile
+import tempfile
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+DEFAULT_REPEAT = 5
+
+_APP_SNIPPET = """
+import json, os, sys, time
+sys.path.insert(0, os.getcwd())
+from streamlit.testing.v1 import AppTest
+started = time.perf_counter()
+at = AppTest.from_file(os.path.join(os.getcwd(), "app.py"), default_timeout=120).run()
+print(json.dumps({"seconds": time.perf_counter() - started, "error": str(at.exception[0].value) if at.exception else None}))
+"""
+
+_CLI_IMPORT_SNIPPET = """
+import json, os, sys, time
+sys.path.insert(0, os.getcwd())
+started = time.perf_counter()
+import analyze_video_comments
+print(json.dumps({"seconds": time.perf_counter() - started, "error": None}))
+"""
+
+_YOUTUBE_SNIPPET = """
+import json, os, sys, time
+from googleapiclient.discovery import build, build_from_document
+path = os.path.join(os.getcwd(), "discovery", "youtube.v3.json")
+started = time.perf_counter()
+if sys.argv[1] == "bundled":
+    if not os.path.exists(path):
+        print(json.dumps({"seconds": None, "error": "同梱の discovery 文書がありません"}))
+        sys.exit(0)
+    with open(path, encoding="utf-8") as f:
+        youtube = build_from_document(f.read(), developerKey="bench")
+else:
+    youtube = build("youtube", "v3", developerKey="bench")
+youtube.commentThreads().list(part="snippet", videoId="bench")
+print(json.dumps({"seconds": time.perf_counter() - started, "error": None}))
+"""
+
+
+def _env(work_dir):
+    env = dict(os.environ)
+    env.update({
+        "YOUTUBE_API_KEY": "bench",
+        "OPENAI_API_KEY": "bench",
+        "ANALYSIS_CACHE_PATH": os.path.join(work_dir, "analysis_cache.sqlite3"),
+        "YOUTUBE_CACHE_PATH": os.path.join(work_dir, "youtube_cache.sqlite3"),
+        "VIDEO_STATE_PATH": os.path.join(work_dir, "video_state.sqlite3"),
+        "PYTHONDONTWRITEBYTECODE": "1",
+    })
+    return env
+
+
+def _run_snippet(tree, work_dir, code, *args):
+    proc = subprocess.run(
+        [sys.executable, "-c", code, *args], cwd=tree, env=_env(work_dir), capture_output=True, text=True
+    )
+    if proc.returncode != 0:
+        return None, (proc.stderr or proc.stdout).strip().splitlines()[-1:]
+    result = json.loads(proc.stdout.strip().splitlines()[-1])
+    return result["seconds"], result["error"]
+
+
+def _run_wall(tree, work_dir, argv):
+    started = time.perf_counter()
+    proc = subprocess.run(argv, cwd=tree, env=_env(work_dir), capture_output=True, text=True)
+    seconds = time.perf_counter() - started
+    return (seconds, None) if proc.returncode == 0 else (None, (proc.stderr or proc.stdout).strip().splitlines()[-1:])
+
+
+MEASUREMENTS = {
+    "cli_import": lambda tree, wd: _run_snippet(tree, wd, _CLI_IMPORT_SNIPPET),
+    "cli_help": lambda tree, wd: _run_wall(tree, wd, [sys.executable, "analyze_video_comments.py", "--help"]),
+    "app_first_run": lambda tree, wd: _run_snippet(tree, wd, _APP_SNIPPET),
+    "youtube_client_library": lambda tree, wd: _run_snippet(tree, wd, _YOUTUBE_SNIPPET, "library"),
+    "youtube_client_bundled": lambda tree, wd: _run_snippet(tree, wd, _YOUTUBE_SNIPPET, "bundled"),
+}
+
+
+def measure_tree(tree, repeat):
+    results = {}
+    for name, run in MEASUREMENTS.items():
+        samples, error = [], None
+        for _ in range(repeat):
+            work_dir = tempfile.mkdtemp(prefix="yt-startup-")
+            try:
+                seconds, error = run(tree, work_dir)
+            finally:
+                shutil.rmtree(work_dir, ignore_errors=True)
+            if seconds is None:
+                break
+            samples.append(seconds)
+        if samples:
+            results[name] = {
+                "median_ms": round(statistics.median(samples) * 1000, 1),
+                "min_ms": round(min(samples) * 1000, 1),
+                "runs": len(samples),
+            }
+        else:
+            results[name] = {"error": error}
+    return results
+
+
+def export_ref(ref, dest):
+    # git archive で指定コミットのツリーを書き出す（作業ツリーには触らない）
+    archive = os.path.join(dest, "tree.tar")
+    with open(archive, "wb") as f:
+        subprocess.run(["git", "archive", ref], cwd=REPO_DIR, stdout=f, check=True)
+    tree = os.path.join(dest, "tree")
+    with tarfile.open(archive) as tar:
+        tar.extractall(tree)
+    return tree
+
+
+def print_table(report):
+    labels = list(report)
+    print(f"{'計測項目':<24}" + "".join(f"{label[:22]:>24}" for label in labels))
+    for name in MEASUREMENTS:
+        cells = []
+        for label in labels:
+            r = report[label].get(name, {})
+            cells.append(f"{r['median_ms']:.1f} ms" if "median_ms" in r else "-")
+        print(f"{name:<24}" + "".join(f"{c:>24}" for c in cells))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="起動時間（コールドスタート）のベンチマーク")
+    parser.add_argument("--ref", action="append", default=[], help="比較するコミット（複数指定可）")
+    parser.add_argument("--repeat", type=int, default=DEFAULT_REPEAT, help="各項目の計測回数（中央値を使う）")
+    parser.add_argument("--out", default=os.path.join(BENCH_DIR, "results", "startup.json"), help="結果JSONの出力先")
+    args = parser.parse_args()
+
+    report = {}
+    temp_dirs = []
+    try:
+        for ref in args.ref:
+            dest = tempfile.mkdtemp(prefix="yt-startup-ref-")
+            temp_dirs.append(dest)
+            print(f"▶ {ref} を計測しています ...", flush=True)
+            report[ref] = measure_tree(export_ref(ref, dest), args.repeat)
+        print("▶ 作業ツリーを計測しています ...", flush=True)
+        report["working tree"] = measure_tree(REPO_DIR, args.repeat)
+    finally:
+        for d in temp_dirs:
+            shutil.rmtree(d, ignore_errors=True)
+
+    os.makedirs(os.path.dirname(os.path.abspath(args.out)), exist_ok=True)
+    with open(args.out, "w", encoding="utf-8") as f:
+        json.dump({"python": sys.version.split()[0], "repeat": args.repeat, "results": report}, f, ensure_ascii=False, indent=2)
+    print_table(report)
+    print(f"✅ 結果を {args.out} に保存しました。")
+
+
+if __name__ == "__main__":
+    main()
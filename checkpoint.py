@@ -0,0 +1,44 @@
+# -----------------------------------------------------------
+# 一括分析ジョブのチェックポイント（追記専用のJSONL）
+# -----------------------------------------------------------
+# 分析が終わったコメントを1行ずつ <ディレクトリ>/<動画ID>.jsonl に追記していく。
+# ジョブが途中で落ちても、再実行時に読み込んで分析済みのコメントを飛ばせる。
+# 各行にプロンプトの版を書いておき、版が変わったら前回分は使わない。
+import json
+import os
+
+
+class CommentCheckpoint:
+    def __init__(self, directory, video_id, prompt_version=None):
+        os.makedirs(directory, exist_ok=True)
+        self.path = os.path.join(directory, f"{video_id}.jsonl")
+        self.prompt_version = prompt_version
+
+    def load(self):
+        # {コメントID: 分析結果}。書き込み途中で落ちた最後の壊れた行は無視する
+        done = {}
+        if not os.path.exists(self.path):
+            return done
+        with open(self.path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                if not isinstance(record, dict) or record.get("id") is None:
+                    continue
+                if self.prompt_version is not None and record.get("prompt_version") != self.prompt_version:
+                    continue
+                done[record["id"]] = record.get("analysis")
+        return done
+
+    def append(self, items):
+        # items: [(コメントID, 分析結果), ...]
+        if not items:
+            return
+        with open(self.path, "a", encoding="utf-8") as f:
+            for comment_id, analysis in items:
+                record = {"id": comment_id, "analysis": analysis, "prompt_version": self.prompt_version}
+                f.write(json.dumps(record, ensure_ascii=False) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
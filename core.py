@@ -0,0 +1,411 @@
+# -----------------------------------------------------------
+# app.py / analyze_video_comments.py 共通の処理（Streamlit に依存しない）
+# -----------------------------------------------------------
+# - Services : YouTube / OpenAI のクライアントを最初に使うときに作る（起動時には作らない）
+# - Analyzer : 1コメント / バッチの分析・結果のパース・キャッシュ（モデルと temperature ごと）
+# - iter_comment_pages / search_videos : YouTube Data API の取得
+# - ReplyFetcher : 返信の取得（一緒に返った返信で足りないスレッドだけ comments.list を並列に呼ぶ）
+# googleapiclient / openai は読み込みだけで0.1〜0.4秒かかるので、ここでは関数の中で import する。
+# YouTube クライアントはリポジトリ同梱の discovery 文書（discovery/youtube.v3.json）から作るため、
+# 起動時に discovery 文書を取得・解析し直すことがない。
+import json
+import os
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from async_engine import call_timeout_from_env
+from batch_analysis import SCORES_OUTPUT_TOKENS_PER_COMMENT, analyze_batch_async, parse_scores_strict, scores_response_format
+from metrics import METRICS
+from youtube_cache import QuotaBudget, youtube_cache_from_env
+
+# googleapiclient 同梱の youtube v3 の文書から、使う list メソッド（search / commentThreads / comments / videos）と
+# その応答のスキーマだけを残し、説明文を削ったもの
+DISCOVERY_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "discovery", "youtube.v3.json")
+
+DEFAULT_REPLY_WORKERS = 4
+DEFAULT_REPLY_QUOTA_UNITS = 50  # 1回のコメント取得（1動画）で返信の追加取得に使ってよいユニット数
+MAX_REPLIES_PER_THREAD = 100  # 1スレッドから取る返信の上限（comments.list 1ページ分）
+
+
+# --- クライアント -----------------------------------------------------
+def build_youtube(api_key, discovery_path=DISCOVERY_PATH):
+    from googleapiclient.discovery import build_from_document
+
+    with open(discovery_path, encoding="utf-8") as f:
+        return build_from_document(f.read(), developerKey=api_key)
+
+
+class Services:
+    # クライアントは初回アクセス時に1度だけ作る（複数スレッドから同時に触っても1つ）
+    def __init__(self, youtube_api_key, openai_api_key):
+        self.youtube_api_key = youtube_api_key
+        self.openai_api_key = openai_api_key
+        self._lock = threading.Lock()
+        self._youtube = None
+        self._youtube_cache = None
+        self._openai = None
+
+    @property
+    def youtube(self):
+        with self._lock:
+            if self._youtube is None:
+                with METRICS.span("build_youtube_client"):
+                    self._youtube = build_youtube(self.youtube_api_key)
+            return self._youtube
+
+    @property
+    def youtube_cache(self):
+        # キャッシュ（SQLite）はすぐ開くが、YouTube クライアントはキャッシュに無いものを取りに行くときに作る
+        with self._lock:
+            if self._youtube_cache is None:
+                self._youtube_cache = youtube_cache_from_env(lambda: self.youtube)
+            return self._youtube_cache
+
+    @property
+    def openai(self):
+        with self._lock:
+            if self._openai is None:
+                from openai import OpenAI
+
+                # 1回の呼び出しの制限時間は非同期エンジンと同じ（超えたら SDK がリトライする）
+                with METRICS.span("build_openai_client"):
+                    self._openai = OpenAI(api_key=self.openai_api_key, timeout=call_timeout_from_env())
+            return self._openai
+
+
+_preload_started = threading.Event()
+
+
+def preload_in_background(modules):
+    # 画面を出し終えた後で、次の操作で使う重いモジュールを裏で読み込んでおく（プロセスで1回だけ）
+    if _preload_started.is_set():
+        return
+    _preload_started.set()
+
+    def _load():
+        import importlib
+
+        for name in modules:
+            try:
+                importlib.import_module(name)
+            except Exception as e:
+                METRICS.record_error("preload", e)
+
+    threading.Thread(target=_load, name="preload-imports", daemon=True).start()
+
+
+# --- YouTube ----------------------------------------------------------
+def search_videos(youtube_cache, query, max_results=6, page_token=None, should_fetch=None):
+    # 動画検索。[{"title", "video_id", "thumbnail"}, ...] と次ページのトークンを返す（取得エラーはそのまま投げる）
+    # should_fetch(resource, params) が False を返したら取得せずに ([], None) を返す（先読みの予算切れ・取り消し）
+    params = dict(
+        part="snippet", q=query, type="video",
+        videoEmbeddable="true", maxResults=max_results, order="relevance",
+        pageToken=page_token
+    )
+    if should_fetch is not None and not should_fetch("search", params):
+        return [], None
+    with METRICS.span("search_videos"):
+        res = youtube_cache.list("search", **params)
+    results = []
+    for item in res.get("items", []):
+        vid = item.get("id", {}).get("videoId")
+        if not vid:
+            continue
+        snip = item.get("snippet", {})
+        results.append({
+            "title": snip.get("title"),
+            "video_id": vid,
+            "thumbnail": snip.get("thumbnails", {}).get("medium", {}).get("url")
+        })
+    return results, res.get("nextPageToken")
+
+
+def comment_from(resource, parent_id=None):
+    # commentThreads の topLevelComment / comments の要素を {"id", "text", "published_at", "like_count", "parent_id"} にする
+    # parent_id は返信なら親コメント（スレッド）のID、親コメントなら None
+    snippet = resource["snippet"]
+    return {
+        "id": resource.get("id"),
+        "text": snippet["textDisplay"],
+        "published_at": snippet.get("publishedAt"),
+        "like_count": snippet.get("likeCount"),
+        "parent_id": parent_id,
+    }
+
+
+def _comments_from(resources, parent_id=None):
+    comments = []
+    for resource in resources:
+        try:
+            comments.append(comment_from(resource, parent_id))
+        except KeyError:
+            continue
+    return comments
+
+
+class ReplyFetcher:
+    # commentThreads を part=snippet,replies で取ると、返信も数件（最大5件）一緒に返る。
+    # 返信の総数（totalReplyCount）に足りているスレッドはそれを使い、足りないスレッドだけ
+    # comments.list(parentId=...) で取りに行く。取りに行くスレッドは executor で同時に取得し、
+    # ユニットは1回のコメント取得（iter_comment_pages 1回）で分け合う予算（QuotaBudget）から予約する。
+    # 予算が尽きたスレッドや取得に失敗したスレッドは、一緒に返った分だけを使う
+    def __init__(self, executor, quota_units=DEFAULT_REPLY_QUOTA_UNITS, max_per_thread=MAX_REPLIES_PER_THREAD):
+        self.executor = executor
+        self.quota_units = quota_units
+        self.max_per_thread = max_per_thread
+
+    def budget(self):
+        return QuotaBudget(self.quota_units)
+
+    def _fetch_thread(self, youtube_cache, thread_id, budget, max_age=None, should_fetch=None):
+        replies = []
+        page_token = None
+        while len(replies) < self.max_per_thread:
+            params = dict(
+                part="snippet",
+                parentId=thread_id,
+                maxResults=100,
+                textFormat="plainText",
+                pageToken=page_token
+            )
+            if should_fetch is not None and not should_fetch("comments", params):
+                break
+            # キャッシュにあるもの（APIを呼ばない）は予算を使わない
+            if not youtube_cache.is_fresh("comments", max_age=max_age, **params) and not budget.take("comments"):
+                METRICS.count("replies", outcome="over_budget")
+                break
+            with METRICS.span("get_replies", page=bool(page_token)):
+                response = youtube_cache.list("comments", max_age=max_age, **params)
+            replies.extend(_comments_from(response.get("items", []), thread_id))
+            page_token = response.get("nextPageToken")
+            if not page_token:
+                break
+        return replies[:self.max_per_thread]
+
+    def replies_for(self, youtube_cache, items, budget, max_age=None, should_fetch=None):
+        # commentThreads の1ページ分の items について {スレッドID: [返信, ...]}（古い順）を返す
+        replies = {}
+        pending = {}
+        for item in items:
+            thread_id = item.get("id")
+            total = item.get("snippet", {}).get("totalReplyCount") or 0
+            if not thread_id or not total:
+                continue
+            replies[thread_id] = _comments_from(item.get("replies", {}).get("comments", []), thread_id)[:self.max_per_thread]
+            if len(replies[thread_id]) < min(total, self.max_per_thread):
+                pending[thread_id] = self.executor.submit(
+                    self._fetch_thread, youtube_cache, thread_id, budget, max_age, should_fetch
+                )
+            else:
+                METRICS.count("replies", outcome="inline")
+        for thread_id, future in pending.items():
+            try:
+                fetched = future.result()
+            except Exception as e:
+                METRICS.record_error("get_replies", e)
+                continue
+            if len(fetched) > len(replies[thread_id]):
+                replies[thread_id] = fetched
+                METRICS.count("replies", outcome="fetched")
+        return {
+            thread_id: sorted(thread, key=lambda c: c.get("published_at") or "")
+            for thread_id, thread in replies.items()
+        }
+
+
+def reply_fetcher_from_env():
+    # YOUTUBE_REPLIES=0 で返信を取得しない。YOUTUBE_REPLY_QUOTA_UNITS=0 なら一緒に返った返信だけを使う
+    if os.getenv("YOUTUBE_REPLIES", "1") == "0":
+        return None
+    executor = ThreadPoolExecutor(
+        max_workers=int(os.getenv("YOUTUBE_REPLY_WORKERS", DEFAULT_REPLY_WORKERS)), thread_name_prefix="replies"
+    )
+    return ReplyFetcher(executor, quota_units=int(os.getenv("YOUTUBE_REPLY_QUOTA_UNITS", DEFAULT_REPLY_QUOTA_UNITS)))
+
+
+def iter_comment_pages(youtube_cache, video_id, max_comments=120, order="relevance", max_age=None, should_fetch=None,
+                       replies=None, until=None):
+    # commentThreads を1ページ（最大100スレッド）ずつ返すジェネレータ。取得エラーは呼び出し側で扱う
+    # 各コメントは comment_from() の辞書
+    # should_fetch(resource, params) が False を返したら、そのページは取得せずに終わる（先読みの予算切れ・取り消し）
+    # replies（ReplyFetcher）を渡すと、各スレッドの返信を親コメントの直後に並べる（max_comments は親コメントの数）
+    # until(親コメント) が True を返したら、そのスレッドの手前で終わる（そこから先のスレッドの返信は取得しない）
+    fetched = 0
+    page_token = None
+    budget = replies.budget() if replies is not None else None
+
+    while fetched < max_comments:
+        params = dict(
+            part="snippet,replies" if replies is not None else "snippet",
+            videoId=video_id,
+            maxResults=100,
+            textFormat="plainText",
+            order=order,
+            pageToken=page_token
+        )
+        if should_fetch is not None and not should_fetch("commentThreads", params):
+            return
+        # 1ページ分の取得を1区間として計測する（分析との重なりを除いたYouTube側の待ち時間）
+        with METRICS.span("get_comments", video=video_id, page=bool(page_token)):
+            response = youtube_cache.list("commentThreads", max_age=max_age, **params)
+        threads = []
+        for item in response.get("items", []):
+            try:
+                top = comment_from(item["snippet"]["topLevelComment"])
+            except KeyError:
+                continue
+            top["id"] = top["id"] or item.get("id")
+            threads.append((item, top))
+        threads = threads[:max_comments - fetched]
+        reached = False
+        if until is not None:
+            for n, (_, top) in enumerate(threads):
+                if until(top):
+                    threads, reached = threads[:n], True
+                    break
+        fetched += len(threads)
+        thread_replies = {}
+        if replies is not None and threads:
+            thread_replies = replies.replies_for(
+                youtube_cache, [item for item, _ in threads], budget, max_age=max_age, should_fetch=should_fetch
+            )
+        page = []
+        for item, top in threads:
+            page.append(top)
+            page.extend(thread_replies.get(item.get("id"), []))
+        if page:
+            yield page
+        if reached:
+            return
+
+        page_token = response.get("nextPageToken")
+        if not page_token:
+            break
+
+
+# --- 分析 -------------------------------------------------------------
+class Analyzer:
+    def __init__(self, services, model, temperature, prompt, cache, local_model=None):
+        self.services = services
+        self.model = model
+        self.temperature = temperature
+        self.prompt = prompt
+        self.cache = cache
+        # local_model.LocalScorer。確信度の高いコメントはGPTに送らずローカルで採点する（結果はキャッシュしない）
+        # 分析ごとに変えるとき（app.py のジョブなど）は、ここを書き換えずに各メソッドの local_model に渡す
+        self.local_model = local_model
+
+    def params(self, scores_only=False):
+        # 分析キャッシュのキー（スコアのみモードの結果は通常モードと別に保存する）
+        version = f"{self.prompt.version}-scores" if scores_only else self.prompt.version
+        return version, self.model, self.temperature
+
+    def call_model(self, prompt):
+        with METRICS.span("openai_call"):
+            resp = self.services.openai.chat.completions.create(
+                model=self.model,
+                messages=[{"role": "user", "content": prompt}],
+                temperature=self.temperature
+            )
+        usage = getattr(resp, "usage", None)
+        if usage is not None:
+            details = getattr(usage, "prompt_tokens_details", None)
+            METRICS.record_usage(self.model, usage.prompt_tokens, usage.completion_tokens, getattr(details, "cached_tokens", None) or 0)
+        return resp.choices[0].message.content.strip()
+
+    def score_locally(self, comment_text, local_model=None):
+        local_model = self.local_model if local_model is None else local_model
+        if local_model is None:
+            return None
+        return local_model.triage([comment_text])[0]
+
+    def parse_model_output(self, comment_text, raw, scores_only=False):
+        # comment_text が分からない（None の）ときはパースだけして分析キャッシュには入れない
+        if scores_only:
+            # スキーマ指定の出力は json.loads 1回と範囲チェックだけで読める（ほぼ全件がここで終わる）
+            result = parse_scores_strict(raw)
+            if result is not None:
+                if comment_text is not None:
+                    self.cache.set(comment_text, *self.params(True), result)
+                return result
+
+        # Markdownのコードブロックを削除
+        raw = re.sub(r"```json", "", raw)
+        raw = re.sub(r"```", "", raw)
+        raw = raw.strip()
+
+        try:
+            result = json.loads(raw)
+        except json.JSONDecodeError:
+            METRICS.count("parse_failures", stage="single")
+            return {"raw_output": raw}
+        # 正しくパースできた結果だけを保存（エラーや非JSONは次回再分析する）
+        if comment_text is not None:
+            self.cache.set(comment_text, *self.params(scores_only), result)
+        return result
+
+    @METRICS.timed("analyze_comment")
+    def analyze_comment(self, comment_text):
+        cached = self.cache.get(comment_text, *self.params())
+        if cached is not None:
+            return cached
+        local = self.score_locally(comment_text)
+        if local is not None:
+            return local
+
+        try:
+            return self.parse_model_output(comment_text, self.call_model(self.prompt.single(comment_text)))
+        except Exception as e:
+            METRICS.record_error("analyze_comment", e)
+            return {"error": str(e) or type(e).__name__}
+
+    @METRICS.timed("analyze_comment")
+    async def analyze_comment_async(self, comment_text, engine, scores_only=False, local_model=None):
+        # analyze_comment の非同期版（async_engine.AnalysisEngine 経由でAPIを呼ぶ）
+        # scores_only=True なら6つのスコアだけを JSON Schema 指定で返してもらう（総合コメントなし）
+        cached = self.cache.get(comment_text, *self.params(scores_only))
+        if cached is not None:
+            return cached
+        local = self.score_locally(comment_text, local_model)
+        if local is not None:
+            return local
+
+        try:
+            if scores_only:
+                raw = await engine.complete(
+                    self.prompt.single(comment_text, scores_only=True),
+                    expected_output_tokens=SCORES_OUTPUT_TOKENS_PER_COMMENT,
+                    response_format=scores_response_format(),
+                )
+            else:
+                raw = await engine.complete(self.prompt.single(comment_text))
+            return self.parse_model_output(comment_text, raw, scores_only=scores_only)
+        except Exception as e:
+            METRICS.record_error("analyze_comment", e)
+            return {"error": str(e) or type(e).__name__}
+
+    @METRICS.timed("analyze_batch")
+    async def analyze_comments_batch_async(self, comments, engine, scores_only=False, local_model=None):
+        # 複数コメントを1リクエストで分析（欠落・不正な要素は analyze_comment_async で再分析）
+        # local_model を省略すると self.local_model を使う
+        local_model = self.local_model if local_model is None else local_model
+        return await analyze_batch_async(
+            comments, self.prompt, engine.complete, lambda c: self.analyze_comment_async(c, engine, scores_only, local_model),
+            cache=self.cache, cache_params=self.params(scores_only), scores_only=scores_only, local_model=local_model
+        )
+
+    def explain_scores(self, comment_text, scores):
+        # スコアのみモードの行について、評価理由（総合コメント）を後から1件だけ生成する
+        params = (f"{self.prompt.version}-rationale", self.model, self.temperature)
+        cached = self.cache.get(comment_text, *params)
+        if cached is not None:
+            return cached.get("総合コメント")
+        try:
+            text = self.call_model(self.prompt.rationale(comment_text, scores))
+        except Exception as e:
+            METRICS.record_error("explain_scores", e)
+            return f"理由の生成に失敗しました: {e}"
+        self.cache.set(comment_text, *params, {"総合コメント": text})
+        return text
@@ -0,0 +1,106 @@
+# -----------------------------------------------------------
+# 分析前の重複・類似コメントのまとめ込み
+# -----------------------------------------------------------
+# 「草」「神回」や絵文字連打、コピペのミームなどを1件だけGPTに送り、
+# 結果を同じグループの全コメントに配る。
+# 1) 正規化した本文のハッシュで完全一致をまとめる
+# 2) 文字n-gramのMinHash＋LSH（バンド分割）で似たコメントを候補に挙げ、
+#    推定Jaccard類似度が閾値以上なら同じグループにする
+# コメントは届いた順に1件ずつ add() できるので、ページ単位のストリーミング処理でも使える。
+import hashlib
+import unicodedata
+import zlib
+
+import numpy as np
+
+NGRAM = 3
+NUM_PERM = 64
+BANDS = 16  # 1バンド = NUM_PERM / BANDS = 4 行
+DEFAULT_THRESHOLD = 0.8
+MAX_RUN = 3  # 「草草草草草」「wwwww」などの連続は3文字に縮める
+_PRIME = 4294967311  # 2^32 より大きい素数
+_rng = np.random.default_rng(20240612)
+_PERM_A = _rng.integers(1, 2 ** 31, size=NUM_PERM, dtype=np.uint64)
+_PERM_B = _rng.integers(0, 2 ** 31, size=NUM_PERM, dtype=np.uint64)
+
+
+def normalize_for_dedup(text):
+    s = unicodedata.normalize("NFKC", str(text or "")).lower()
+    out = []
+    for ch in s:
+        cat = unicodedata.category(ch)
+        # 空白・句読点・記号の揺れは無視する（絵文字などの So は残す）
+        if cat[0] in ("Z", "P", "C"):
+            continue
+        if len(out) >= MAX_RUN and all(c == ch for c in out[-MAX_RUN:]):
+            continue
+        out.append(ch)
+    normalized = "".join(out)
+    return normalized if normalized else s.strip()
+
+
+def shingles(normalized):
+    if len(normalized) <= NGRAM:
+        return {normalized}
+    return {normalized[i:i + NGRAM] for i in range(len(normalized) - NGRAM + 1)}
+
+
+def minhash_signature(normalized):
+    hashes = np.fromiter(
+        (zlib.crc32(s.encode("utf-8")) for s in shingles(normalized)), dtype=np.uint64
+    )
+    return ((_PERM_A[:, None] * hashes[None, :] + _PERM_B[:, None]) % _PRIME).min(axis=1)
+
+
+class DuplicateIndex:
+    def __init__(self, threshold=DEFAULT_THRESHOLD):
+        self.threshold = threshold
+        self.rows_per_band = NUM_PERM // BANDS
+        self._exact = {}       # 正規化本文のハッシュ -> グループID
+        self._buckets = {}     # (バンド番号, バンドのハッシュ値) -> [グループID, ...]
+        self._signatures = []  # グループIDごとの代表コメントのシグネチャ
+        self.members = []      # グループIDごとの元インデックスのリスト
+        self.group_of = []     # add() した順のインデックス -> グループID
+
+    def add(self, text):
+        # (グループID, 新しいグループかどうか) を返す
+        index = len(self.group_of)
+        normalized = normalize_for_dedup(text)
+        key = hashlib.sha1(normalized.encode("utf-8")).hexdigest()
+
+        group = self._exact.get(key)
+        sig = None
+        if group is None:
+            sig = minhash_signature(normalized)
+            band_keys = [
+                (b, sig[b * self.rows_per_band:(b + 1) * self.rows_per_band].tobytes())
+                for b in range(BANDS)
+            ]
+            group = self._find_similar(sig, band_keys)
+            if group is None:
+                group = len(self.members)
+                self._signatures.append(sig)
+                self.members.append([])
+                for bk in band_keys:
+                    self._buckets.setdefault(bk, []).append(group)
+            self._exact[key] = group
+
+        is_new = not self.members[group]
+        self.members[group].append(index)
+        self.group_of.append(group)
+        return group, is_new
+
+    def _find_similar(self, sig, band_keys):
+        seen = set()
+        for bk in band_keys:
+            for group in self._buckets.get(bk, ()):
+                if group in seen:
+                    continue
+                seen.add(group)
+                if float(np.mean(self._signatures[group] == sig)) >= self.threshold:
+                    return group
+        return None
+
+    def group_sizes(self):
+        return [len(m) for m in self.members]
+
@@ -0,0 +1,73 @@
+# -----------------------------------------------------------
+# 分析結果の書き出し（CSV / Parquet / JSONL）
+# -----------------------------------------------------------
+# ダウンロードボタンが押されたときにだけ作る（st.download_button に関数を渡す）。
+# 行をチャンクに分けて一時ファイル（小さいうちはメモリ、大きくなったらディスク）へ順に書き出す。
+# チャンクで抑えられるのは pandas / pyarrow の中間データ（to_csv() の結果全体の文字列やそのエンコード結果など）だけで、
+# ストリーミングではない。st.download_button はバイト列を受け取ってメモリに持つので、
+# 書き出したファイル全体は最後に1回メモリに載る（ピークはファイルの大きさ＋1チャンク分）。
+import tempfile
+
+import numpy as np
+
+from metrics import METRICS
+
+EXPORT_CHUNK_ROWS = 10_000
+SPOOL_MAX_BYTES = 8 * 1024 * 1024
+
+# 形式 → (拡張子, MIMEタイプ)
+FORMATS = {
+    "CSV": ("csv", "text/csv"),
+    "Parquet": ("parquet", "application/vnd.apache.parquet"),
+    "JSONL": ("jsonl", "application/jsonl"),
+}
+
+
+def iter_chunks(df, positions=None, chunk_rows=EXPORT_CHUNK_ROWS):
+    # positions（行番号の配列）で選んだ行を、chunk_rows 行ずつの DataFrame で返す
+    if positions is None:
+        positions = np.arange(len(df))
+    for start in range(0, len(positions), chunk_rows):
+        yield df.iloc[positions[start:start + chunk_rows]]
+
+
+def _write_csv(df, positions, f, chunk_rows):
+    header = True
+    for chunk in iter_chunks(df, positions, chunk_rows):
+        f.write(chunk.to_csv(index=False, header=header).encode("utf-8"))
+        header = False
+    if header:
+        f.write(df.iloc[:0].to_csv(index=False).encode("utf-8"))
+
+
+def _write_jsonl(df, positions, f, chunk_rows):
+    for chunk in iter_chunks(df, positions, chunk_rows):
+        if len(chunk):
+            text = chunk.to_json(orient="records", lines=True, force_ascii=False)
+            f.write(text.encode("utf-8"))
+            if not text.endswith("\n"):
+                f.write(b"\n")
+
+
+def _write_parquet(df, positions, f, chunk_rows):
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    # チャンクごとに行グループとして書き足す（スキーマは空の DataFrame から決める）
+    schema = pa.Table.from_pandas(df.iloc[:0], preserve_index=False).schema
+    with pq.ParquetWriter(f, schema) as writer:
+        for chunk in iter_chunks(df, positions, chunk_rows):
+            writer.write_table(pa.Table.from_pandas(chunk, schema=schema, preserve_index=False))
+
+
+_WRITERS = {"CSV": _write_csv, "Parquet": _write_parquet, "JSONL": _write_jsonl}
+
+
+def export_bytes(df, positions=None, fmt="CSV", chunk_rows=EXPORT_CHUNK_ROWS):
+    # 書き出したファイルの中身を返す（st.download_button はバイト列で受け取るので、ファイル全体を読み込む）
+    rows = len(df) if positions is None else len(positions)
+    with METRICS.span("export", format=fmt, rows=rows):
+        with tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_BYTES) as f:
+            _WRITERS[fmt](df, positions, f, chunk_rows)
+            f.seek(0)
+            return f.read()
@@ -0,0 +1,167 @@
+# -----------------------------------------------------------
+# バックグラウンドの分析ジョブ
+# -----------------------------------------------------------
+# 分析を Streamlit のスクリプト実行（ボタンのハンドラ）から切り離し、ジョブ用のスレッドで動かす。
+# 画面の再実行・「検索に戻る」などで処理が途切れたり二重に走ったりせず、スクリプトのスレッドも塞がない。
+# - ジョブはIDで引ける。状態は queued → running → done / failed / cancelled
+# - 進捗カウンタと途中経過（DataFrame）を持ち、画面は一定間隔で見に来て描画する
+# - 同じキー（動画・分析設定）のジョブが終わっていなければ、新しく作らずそのジョブを返す（single-flight）
+# - 中止は、そのジョブを見ている購読者（セッションなど）が全員中止したときだけ実際に止める。
+#   購読者はIDの集合で持つので、同じセッションが何度合流しても1人として数える
+# - 終わったジョブは一定時間（既定10分）残し、その後に捨てる
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from metrics import METRICS
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+CANCELLED = "cancelled"
+FINISHED_STATES = (DONE, FAILED, CANCELLED)
+
+DEFAULT_MAX_WORKERS = 4
+DEFAULT_RETENTION_SECONDS = 10 * 60
+
+
+class Job:
+    def __init__(self, key=None, label=""):
+        self.id = uuid.uuid4().hex[:12]
+        self.key = key
+        self.label = label
+        self.state = QUEUED
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.result = None
+        self.error = None
+        self.subscribers = set()  # 購読者のID
+        self._lock = threading.Lock()
+        self._cancel = threading.Event()
+        self._counters = {}
+        self._partial = None
+
+    @property
+    def cancelled(self):
+        return self._cancel.is_set()
+
+    @property
+    def finished(self):
+        return self.state in FINISHED_STATES
+
+    def update(self, partial=None, **counters):
+        # ジョブの中から呼ぶ。partial は途中経過の DataFrame（画面にそのまま描画できるもの）
+        with self._lock:
+            if partial is not None:
+                self._partial = partial
+            self._counters.update(counters)
+
+    def snapshot(self):
+        # (カウンタの写し, 途中経過の DataFrame or None)
+        with self._lock:
+            return dict(self._counters), self._partial
+
+    def progress(self):
+        counters, _ = self.snapshot()
+        total = counters.get("total") or 0
+        return min(1.0, counters.get("done", 0) / total) if total else 0.0
+
+    def elapsed(self):
+        if self.started_at is None:
+            return 0.0
+        return (self.finished_at or time.time()) - self.started_at
+
+
+class JobRunner:
+    def __init__(self, max_workers=DEFAULT_MAX_WORKERS, retention_seconds=DEFAULT_RETENTION_SECONDS):
+        self.max_workers = max_workers
+        self.retention_seconds = retention_seconds
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="analysis-job")
+        self._lock = threading.Lock()
+        self._jobs = {}
+        self._active = {}
+
+    def _prune(self):
+        now = time.time()
+        for job_id, job in list(self._jobs.items()):
+            if job.finished and now - job.finished_at > self.retention_seconds:
+                del self._jobs[job_id]
+
+    def submit(self, fn, *args, key=None, label="", subscriber=None, **kwargs):
+        # fn(job, *args, **kwargs) をジョブのスレッドで実行する。戻り値が job.result になる
+        # fn は job.cancelled を見て早めに戻り、job.update() で進捗を知らせる
+        # subscriber は呼び出し元のID（中止するときに cancel に同じものを渡す）
+        with self._lock:
+            self._prune()
+            job = self._active.get(key) if key is not None else None
+            if job is not None:
+                job.subscribers.add(subscriber)
+                METRICS.count("jobs", outcome="coalesced")
+                return job
+            job = Job(key, label)
+            job.subscribers.add(subscriber)
+            self._jobs[job.id] = job
+            if key is not None:
+                self._active[key] = job
+        METRICS.count("jobs", outcome="submitted")
+        self._executor.submit(self._run, job, fn, args, kwargs)
+        return job
+
+    def _run(self, job, fn, args, kwargs):
+        job.started_at = time.time()
+        try:
+            if job.cancelled:
+                job.state = CANCELLED
+                return
+            job.state = RUNNING
+            with METRICS.span("job", label=job.label):
+                job.result = fn(job, *args, **kwargs)
+            job.state = CANCELLED if job.cancelled else DONE
+        except Exception as e:
+            job.error = e
+            job.state = FAILED
+        finally:
+            job.finished_at = time.time()
+            with self._lock:
+                if self._active.get(job.key) is job:
+                    del self._active[job.key]
+            METRICS.count("jobs", outcome=job.state)
+
+    def get(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def cancel(self, job_id, subscriber=None):
+        # subscriber の購読をやめる。誰も見ていなくなったジョブは中止する
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None or job.finished:
+                return job
+            job.subscribers.discard(subscriber)
+            if not job.subscribers:
+                job._cancel.set()
+                # 中止したジョブには合流させない（同じ分析をもう一度頼まれたら新しいジョブにする）
+                if self._active.get(job.key) is job:
+                    del self._active[job.key]
+        return job
+
+    def stats(self):
+        with self._lock:
+            counts = {state: 0 for state in (QUEUED, RUNNING) + FINISHED_STATES}
+            for job in self._jobs.values():
+                counts[job.state] += 1
+        counts["max_workers"] = self.max_workers
+        return counts
+
+
+def runner_from_env():
+    max_workers = os.getenv("ANALYSIS_MAX_JOBS")
+    retention = os.getenv("ANALYSIS_JOB_RETENTION_SECONDS")
+    return JobRunner(
+        max_workers=int(max_workers) if max_workers else DEFAULT_MAX_WORKERS,
+        retention_seconds=int(retention) if retention else DEFAULT_RETENTION_SECONDS,
+    )
@@ -0,0 +1,461 @@
+# -----------------------------------------------------------
+# GPTの採点を真似るローカルモデル（蒸留）
+# -----------------------------------------------------------
+# 「草」「神回」や絵文字だけの短いコメントは採点が簡単なのに、毎回 gpt-4o-mini に送っている。
+# GPTで分析済みの結果（video_state に保存したもの・CLIの出力ファイル）を教師データにして、
+# - 特徴量: 文字 1〜3-gram をハッシュした TF-IDF（L2正規化）
+# - モデル: 6つの特徴量ごとのリッジ回帰（共役勾配法。NumPy だけで学習・推論する）
+# を作り、確信度の高いコメントだけをローカルで採点して、残りをGPTに送る。
+# 確信度は「予測値が四捨五入の境目からどれだけ離れているか」で測り、特徴量ごとの閾値は
+# 学習に使っていない検証用データで「閾値以上の一致率が目標（既定90%）を超える最小の値」に決める。
+# 長いコメントや、学習データに無い文字列ばかりのコメントは常にGPTに送る。
+#
+# 使い方:
+#   python local_model.py train                        # video_state の保存結果から学習し、一致率レポートを表示
+#   python local_model.py train --data output/*.parquet --data analyzed_comments.csv
+#   python local_model.py report --data newer.csv      # 保存済みのモデルを別の（GPT採点済みの）データで評価
+import argparse
+import glob
+import json
+import os
+import time
+import unicodedata
+import zlib
+from collections import Counter
+
+import numpy as np
+
+from batch_analysis import FEATURE_RANGES
+from metrics import METRICS
+
+DEFAULT_MODEL_PATH = os.path.join(".cache", "local_model.npz")
+HASH_BITS = 18
+NGRAM_RANGE = (1, 3)
+DEFAULT_ALPHA = 1.0              # リッジの正則化の強さ
+DEFAULT_TARGET_AGREEMENT = 0.9   # ローカルで採点する行に求める、特徴量ごとのGPTとの一致率
+DEFAULT_MAX_CHARS = 80           # これより長いコメントは常にGPTに送る
+MIN_COVERAGE = 0.8               # 学習データに出てきた n-gram の割合がこれ未満ならGPTに送る
+MIN_TRAIN_EXAMPLES = 200
+CG_MAX_ITER = 200
+CG_TOL = 1e-6
+SOURCE = "local"                 # ローカルで採点した結果に付ける印（学習データからは除く）
+
+FEATURES = list(FEATURE_RANGES)
+
+
+def normalize_text(text):
+    s = unicodedata.normalize("NFKC", str(text or "")).lower()
+    return " ".join(s.split())
+
+
+def char_ngrams(normalized):
+    low, high = NGRAM_RANGE
+    grams = [normalized[i:i + n] for n in range(low, high + 1) for i in range(len(normalized) - n + 1)]
+    # 空のコメントも1つは特徴量を持つようにする
+    return grams or ["\x00"]
+
+
+class _Sparse:
+    # 行列の CSR 表現（indptr, indices, data）と、学習・推論で使う2つの積だけを持つ
+    def __init__(self, indptr, indices, data, n_cols):
+        self.indptr = indptr
+        self.indices = indices
+        self.data = data
+        self.n_cols = n_cols
+        self.n_rows = len(indptr) - 1
+        self._rows = np.repeat(np.arange(self.n_rows), np.diff(indptr))
+
+    def dot(self, w):
+        # X @ w（全ての行が1つ以上の要素を持つので reduceat がそのまま使える）
+        return np.add.reduceat(self.data * w[self.indices], self.indptr[:-1])
+
+    def tdot(self, u):
+        # X.T @ u
+        return np.bincount(self.indices, weights=self.data * u[self._rows], minlength=self.n_cols)
+
+
+def hash_counts(texts, dim):
+    # 文字 n-gram のハッシュごとの出現回数（CSR の材料）
+    indptr = [0]
+    indices = []
+    counts = []
+    for text in texts:
+        c = Counter(zlib.crc32(g.encode("utf-8")) & (dim - 1) for g in char_ngrams(normalize_text(text)))
+        indices.extend(c.keys())
+        counts.extend(c.values())
+        indptr.append(len(indices))
+    return np.asarray(indptr, dtype=np.int64), np.asarray(indices, dtype=np.int64), np.asarray(counts, dtype=np.float64)
+
+
+def tfidf_matrix(indptr, indices, counts, idf):
+    # TF（1 + log 回数）× IDF を行ごとに L2 正規化し、最後の列に切片用の 1 を足す
+    dim = len(idf)
+    values = (1.0 + np.log(counts)) * idf[indices]
+    norms = np.sqrt(np.add.reduceat(values * values, indptr[:-1]))
+    values = values / np.repeat(norms, np.diff(indptr))
+    n_rows = len(indptr) - 1
+    starts = indptr[:-1] + np.arange(n_rows)
+    new_indptr = np.append(starts, len(indices) + n_rows)
+    new_indices = np.empty(len(indices) + n_rows, dtype=np.int64)
+    new_values = np.empty(len(indices) + n_rows, dtype=np.float64)
+    mask = np.ones(len(new_indices), dtype=bool)
+    mask[new_indptr[1:] - 1] = False
+    new_indices[mask] = indices
+    new_values[mask] = values
+    new_indices[~mask] = dim
+    new_values[~mask] = 1.0
+    return _Sparse(new_indptr, new_indices, new_values, dim + 1)
+
+
+def ridge_cg(X, y, alpha, max_iter=CG_MAX_ITER, tol=CG_TOL):
+    # (XᵀX + αI) w = Xᵀy を共役勾配法で解く
+    b = X.tdot(y)
+    w = np.zeros(X.n_cols)
+    r = b.copy()
+    p = r.copy()
+    rs = r @ r
+    b_norm = np.sqrt(b @ b) or 1.0
+    for _ in range(max_iter):
+        ap = X.tdot(X.dot(p)) + alpha * p
+        step = rs / (p @ ap)
+        w += step * p
+        r -= step * ap
+        rs_new = r @ r
+        if np.sqrt(rs_new) < tol * b_norm:
+            break
+        p = r + (rs_new / rs) * p
+        rs = rs_new
+    return w
+
+
+def rounding_margin(pred, low, high):
+    # 予測値から、一番近い四捨五入の境目（low+0.5, ..., high-0.5）までの距離
+    boundaries = np.arange(low, high) + 0.5
+    return np.abs(pred[:, None] - boundaries[None, :]).min(axis=1)
+
+
+def rounded_scores(pred, low, high):
+    return np.clip(np.rint(pred), low, high).astype(np.int64)
+
+
+class LocalScorer:
+    def __init__(self, weights, idf, seen, thresholds, meta):
+        self.weights = weights          # (次元+1, 特徴量数)
+        self.idf = idf                  # (次元,)
+        self.seen = seen                # (次元,) 学習データに出てきたハッシュ
+        self.thresholds = thresholds    # (特徴量数,) 採用に必要な rounding_margin
+        self.meta = meta
+        self.dim = len(idf)
+        self.max_chars = meta.get("max_chars", DEFAULT_MAX_CHARS)
+
+    # --- 推論 ---------------------------------------------------------
+    def predict(self, texts):
+        # (予測値 (件数, 特徴量数), 学習済み n-gram の割合 (件数,))
+        indptr, indices, counts = hash_counts(texts, self.dim)
+        X = tfidf_matrix(indptr, indices, counts, self.idf)
+        preds = np.stack([X.dot(self.weights[:, j]) for j in range(len(FEATURES))], axis=1)
+        coverage = np.add.reduceat(self.seen[indices].astype(np.float64), indptr[:-1]) / np.diff(indptr)
+        return preds, coverage
+
+    def confident(self, texts, preds, coverage):
+        ok = coverage >= MIN_COVERAGE
+        ok &= np.array([len(normalize_text(t)) <= self.max_chars for t in texts])
+        for j, (key, (low, high)) in enumerate(FEATURE_RANGES.items()):
+            ok &= rounding_margin(preds[:, j], low, high) >= self.thresholds[j]
+        return ok
+
+    def triage(self, texts):
+        # 確信度の高いコメントはスコアのみの分析結果、低いものは None（GPTに送る）のリスト
+        if not texts:
+            return []
+        with METRICS.span("local_model", rows=len(texts)):
+            preds, coverage = self.predict(texts)
+            ok = self.confident(texts, preds, coverage)
+        scores = np.stack(
+            [rounded_scores(preds[:, j], low, high) for j, (low, high) in enumerate(FEATURE_RANGES.values())], axis=1
+        )
+        results = []
+        for i in range(len(texts)):
+            if not ok[i]:
+                results.append(None)
+                continue
+            analysis = {key: {"score": int(scores[i, j])} for j, key in enumerate(FEATURES)}
+            analysis["総合コメント"] = None
+            analysis["source"] = SOURCE
+            results.append(analysis)
+        n_local = int(ok.sum())
+        METRICS.count("local_model", n_local, outcome="scored")
+        METRICS.count("local_model", len(texts) - n_local, outcome="deferred")
+        return results
+
+    # --- 保存・読み込み ---------------------------------------------------
+    def save(self, path):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        tmp_path = path + ".tmp.npz"
+        np.savez_compressed(
+            tmp_path, weights=self.weights.astype(np.float32), idf=self.idf.astype(np.float32),
+            seen=np.packbits(self.seen), thresholds=self.thresholds,
+            meta=np.array(json.dumps(self.meta, ensure_ascii=False)),
+        )
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path, allow_pickle=False) as f:
+            idf = f["idf"].astype(np.float64)
+            return cls(
+                f["weights"].astype(np.float64), idf,
+                np.unpackbits(f["seen"], count=len(idf)).astype(bool),
+                f["thresholds"], json.loads(str(f["meta"])),
+            )
+
+
+# --- 学習データ -------------------------------------------------------
+def label_of(analysis):
+    # GPTの分析結果から6つの整数スコアを取り出す（欠けている・ローカル採点のものは None）
+    if not isinstance(analysis, dict) or analysis.get("source") == SOURCE:
+        return None
+    scores = []
+    for key, (low, high) in FEATURE_RANGES.items():
+        val = analysis.get(key)
+        score = val.get("score") if isinstance(val, dict) else val
+        if isinstance(score, bool) or not isinstance(score, (int, float)) or score != score:
+            return None
+        if not (low <= score <= high) or int(score) != score:
+            return None
+        scores.append(int(score))
+    return tuple(scores)
+
+
+def examples_from_state(path, prompt_versions=None):
+    from video_state import VideoStateStore
+
+    if not os.path.exists(path):
+        return []
+    examples = []
+    for item in VideoStateStore(path).labelled_items(prompt_versions):
+        label = label_of(item["analysis"])
+        if label is not None:
+            examples.append((item["text"], label))
+    return examples
+
+
+def examples_from_file(path):
+    # CLI の出力（CSV / Parquet）やアプリの書き出し（CSV / Parquet / JSONL）。
+    # スコア列は「攻撃性」「攻撃性_score」のどちらの名前でもよい
+    import pandas as pd
+
+    if path.endswith(".parquet"):
+        df = pd.read_parquet(path)
+    elif path.endswith(".jsonl"):
+        df = pd.read_json(path, lines=True)
+    else:
+        df = pd.read_csv(path)
+    if "コメント" not in df.columns:
+        return []
+    if "source" in df.columns:
+        df = df[df["source"] != SOURCE]
+    columns = []
+    for key in FEATURES:
+        col = key if key in df.columns else f"{key}_score"
+        if col not in df.columns:
+            return []
+        columns.append(col)
+    examples = []
+    for row in df[["コメント"] + columns].itertuples(index=False):
+        label = label_of(dict(zip(FEATURES, row[1:])))
+        if label is not None and isinstance(row[0], str):
+            examples.append((row[0], label))
+    return examples
+
+
+def load_examples(state_path=None, data_patterns=(), prompt_versions=None):
+    # 正規化した本文が同じものは1件にまとめる（後から読んだものを優先）
+    merged = {}
+    sources = []
+    if state_path:
+        sources.append(examples_from_state(state_path, prompt_versions))
+    for pattern in data_patterns:
+        for path in sorted(glob.glob(pattern)):
+            sources.append(examples_from_file(path))
+    for examples in sources:
+        for text, label in examples:
+            merged[normalize_text(text)] = (text, label)
+    return list(merged.values())
+
+
+def split_of(text):
+    # 本文のハッシュで 学習 70% / 閾値決め 15% / 評価 15% に分ける（同じ本文は常に同じ側）
+    bucket = zlib.crc32(normalize_text(text).encode("utf-8")) % 20
+    return "train" if bucket < 14 else ("calibrate" if bucket < 17 else "test")
+
+
+# --- 学習・評価 -------------------------------------------------------
+def fit(texts, labels, alpha=DEFAULT_ALPHA, hash_bits=HASH_BITS):
+    dim = 1 << hash_bits
+    indptr, indices, counts = hash_counts(texts, dim)
+    df = np.bincount(indices, minlength=dim)
+    idf = np.log((1.0 + len(texts)) / (1.0 + df)) + 1.0
+    X = tfidf_matrix(indptr, indices, counts, idf)
+    y = np.asarray(labels, dtype=np.float64)
+    weights = np.stack([ridge_cg(X, y[:, j], alpha) for j in range(len(FEATURES))], axis=1)
+    return weights, idf, df > 0
+
+
+def calibrate_thresholds(preds, labels, target):
+    # 特徴量ごとに、margin がそれ以上の行の一致率が target を超える最小の margin を選ぶ（無ければ採用しない）
+    thresholds = np.full(len(FEATURES), np.inf)
+    for j, (key, (low, high)) in enumerate(FEATURE_RANGES.items()):
+        margin = rounding_margin(preds[:, j], low, high)
+        correct = rounded_scores(preds[:, j], low, high) == labels[:, j]
+        order = np.argsort(-margin)
+        agreement = np.cumsum(correct[order]) / np.arange(1, len(order) + 1)
+        ok = np.flatnonzero(agreement >= target)
+        if len(ok):
+            thresholds[j] = margin[order][ok[-1]]
+    return thresholds
+
+
+def agreement_report(scorer, texts, labels):
+    # GPTの採点（labels）とローカルモデルの一致率。全件と、ローカルで採点する（確信度の高い）行のそれぞれ
+    labels = np.asarray(labels)
+    preds, coverage = scorer.predict(texts)
+    ok = scorer.confident(texts, preds, coverage)
+    features = {}
+    exact_all = np.ones(len(texts), dtype=bool)
+    for j, (key, (low, high)) in enumerate(FEATURE_RANGES.items()):
+        scores = rounded_scores(preds[:, j], low, high)
+        exact = scores == labels[:, j]
+        exact_all &= exact
+        majority = np.bincount(labels[:, j] - low).argmax() + low
+        features[key] = {
+            "exact": float(exact.mean()),
+            "within_1": float((np.abs(scores - labels[:, j]) <= 1).mean()),
+            "mae": float(np.abs(preds[:, j] - labels[:, j]).mean()),
+            "majority_baseline": float((labels[:, j] == majority).mean()),
+            "exact_local": float(exact[ok].mean()) if ok.any() else None,
+        }
+    return {
+        "examples": len(texts),
+        "local_rate": float(ok.mean()),
+        "all_exact": float(exact_all.mean()),
+        "all_exact_local": float(exact_all[ok].mean()) if ok.any() else None,
+        "features": features,
+    }
+
+
+def train(examples, alpha=DEFAULT_ALPHA, target=DEFAULT_TARGET_AGREEMENT, max_chars=DEFAULT_MAX_CHARS, prompt_version=None):
+    parts = {"train": [], "calibrate": [], "test": []}
+    for text, label in examples:
+        parts[split_of(text)].append((text, label))
+    if len(parts["train"]) < MIN_TRAIN_EXAMPLES or not parts["calibrate"] or not parts["test"]:
+        raise ValueError(f"学習データが足りません（{len(examples)} 件。最低でも約 {MIN_TRAIN_EXAMPLES * 10 // 7} 件必要です）")
+
+    started = time.perf_counter()
+    texts, labels = zip(*parts["train"])
+    weights, idf, seen = fit(list(texts), labels, alpha=alpha)
+    meta = {
+        "prompt_version": prompt_version, "trained_at": time.time(), "alpha": alpha, "target_agreement": target,
+        "max_chars": max_chars, "hash_bits": HASH_BITS, "ngram_range": list(NGRAM_RANGE),
+        "examples": {name: len(part) for name, part in parts.items()},
+    }
+    scorer = LocalScorer(weights, idf, seen, np.full(len(FEATURES), np.inf), meta)
+
+    cal_texts, cal_labels = zip(*parts["calibrate"])
+    preds, _ = scorer.predict(list(cal_texts))
+    scorer.thresholds = calibrate_thresholds(preds, np.asarray(cal_labels), target)
+    meta["train_seconds"] = round(time.perf_counter() - started, 2)
+
+    test_texts, test_labels = zip(*parts["test"])
+    meta["report"] = agreement_report(scorer, list(test_texts), test_labels)
+    return scorer
+
+
+def print_report(report):
+    print(f"評価データ {report['examples']} 件 / ローカル採点の対象 {report['local_rate']:.1%}")
+    local = report["all_exact_local"]
+    print(f"6項目すべて一致: 全件 {report['all_exact']:.1%} / ローカル採点分 {'-' if local is None else f'{local:.1%}'}")
+    print(f"{'特徴量':<8}{'一致率':>8}{'±1以内':>8}{'MAE':>7}{'多数派':>8}{'採点分一致':>10}")
+    for key, m in report["features"].items():
+        local = "-" if m["exact_local"] is None else f"{m['exact_local']:.1%}"
+        print(f"{key:<8}{m['exact']:>9.1%}{m['within_1']:>9.1%}{m['mae']:>8.2f}{m['majority_baseline']:>9.1%}{local:>11}")
+
+
+# --- 読み込み（app.py / CLI） ------------------------------------------
+_loaded = {}
+
+
+def model_path():
+    return os.getenv("LOCAL_MODEL_PATH", DEFAULT_MODEL_PATH)
+
+
+def local_model_available():
+    # LOCAL_MODEL=0 で無効。学習済みのモデルファイルがあるか（読み込みはしない）
+    return os.getenv("LOCAL_MODEL", "1") != "0" and os.path.exists(model_path())
+
+
+def local_model_from_env(prompt_version):
+    # モデルが無い・無効・別のプロンプト版で学習したものなら None（全件GPT）
+    # ファイルが更新されたら（再学習したら）読み直す
+    if not local_model_available():
+        return None
+    path = model_path()
+    key = (path, os.path.getmtime(path))
+    scorer = _loaded.get(key)
+    if scorer is None:
+        try:
+            scorer = LocalScorer.load(path)
+        except Exception as e:
+            METRICS.record_error("local_model", e)
+            return None
+        _loaded.clear()
+        _loaded[key] = scorer
+    if scorer.meta.get("prompt_version") not in (None, prompt_version):
+        return None
+    return scorer
+
+
+def main():
+    from prompts import template_from_env
+    from video_state import DEFAULT_STATE_PATH
+
+    parser = argparse.ArgumentParser(description="GPTの採点を真似るローカルモデルの学習・評価")
+    parser.add_argument("command", choices=["train", "report"], help="train: 学習して保存 / report: 保存済みモデルの一致率を表示")
+    parser.add_argument("--data", action="append", default=[], metavar="GLOB",
+                        help="GPT採点済みの CSV / Parquet / JSONL（複数指定可。report ではこれが評価データ）")
+    parser.add_argument("--state", default=os.getenv("VIDEO_STATE_PATH", DEFAULT_STATE_PATH),
+                        help="学習に使う video_state のパス（空文字で使わない）")
+    parser.add_argument("--all-versions", action="store_true", help="現在と異なるプロンプト版の保存結果も学習に使う")
+    parser.add_argument("--model", default=model_path(), help="モデルの保存先")
+    parser.add_argument("--alpha", type=float, default=DEFAULT_ALPHA, help="リッジ回帰の正則化の強さ")
+    parser.add_argument("--target-agreement", type=float, default=DEFAULT_TARGET_AGREEMENT,
+                        help="ローカル採点する行に求める特徴量ごとの一致率（高いほどGPTに送る件数が増える）")
+    parser.add_argument("--max-chars", type=int, default=DEFAULT_MAX_CHARS, help="これより長いコメントは常にGPTに送る")
+    args = parser.parse_args()
+
+    version = template_from_env().version
+    versions = None if args.all_versions else [version, f"{version}-scores"]
+
+    if args.command == "report":
+        scorer = LocalScorer.load(args.model)
+        examples = load_examples(None, args.data) if args.data else load_examples(args.state, (), versions)
+        if not examples:
+            raise SystemExit("評価データがありません（--data を指定してください）")
+        texts, labels = zip(*examples)
+        print_report(agreement_report(scorer, list(texts), labels))
+        return
+
+    examples = load_examples(args.state or None, args.data, versions)
+    print(f"📚 学習データ: {len(examples)} 件（プロンプト版 {'すべて' if versions is None else version}）")
+    try:
+        scorer = train(examples, alpha=args.alpha, target=args.target_agreement, max_chars=args.max_chars,
+                       prompt_version=None if args.all_versions else version)
+    except ValueError as e:
+        raise SystemExit(f"❌ {e}")
+    scorer.save(args.model)
+    print_report(scorer.meta["report"])
+    print(f"✅ {args.model} に保存しました（学習 {scorer.meta['train_seconds']} 秒）。")
+
+
+if __name__ == "__main__":
+    main()
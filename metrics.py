@@ -0,0 +1,222 @@
+# -----------------------------------------------------------
+# 処理時間・トークン・料金・エラーの計測
+# -----------------------------------------------------------
+# プロセス全体で1つの METRICS に記録する（Streamlit では再実行をまたいで残る）。
+# - span(name)  : 区間の所要時間をヒストグラムに入れ、直近の区間（親子関係つき）を残す
+# - count(name) : ラベル付きカウンタ（パース失敗・リトライなど）
+# - record_usage: トークン数と推定料金（prompts.usage_cost）
+# - record_error: 握りつぶさずに件数と直近のエラー内容を残す
+# snapshot() はJSON向けの辞書、to_prometheus() は Prometheus のテキスト形式を返す。
+import contextvars
+import functools
+import inspect
+import itertools
+import json
+import os
+import threading
+import time
+from bisect import bisect_left
+from collections import deque
+from contextlib import contextmanager
+
+from prompts import usage_cost
+
+# ヒストグラムの上限（秒）
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+MAX_SAMPLES = 2048   # パーセンタイル計算用に区間ごとに残す直近の値
+MAX_SPANS = 500      # 直近の区間の記録
+MAX_ERRORS = 50      # 直近のエラーの記録
+PROMETHEUS_PREFIX = "ytcomment"
+
+_current_span = contextvars.ContextVar("current_span", default=None)
+
+
+def _label_key(labels):
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def _quantile(sorted_values, q):
+    if not sorted_values:
+        return None
+    k = (len(sorted_values) - 1) * q
+    lo = int(k)
+    hi = min(lo + 1, len(sorted_values) - 1)
+    return sorted_values[lo] + (sorted_values[hi] - sorted_values[lo]) * (k - lo)
+
+
+class _Histogram:
+    def __init__(self):
+        self.buckets = [0] * (len(BUCKETS) + 1)  # 最後は +Inf
+        self.count = 0
+        self.errors = 0
+        self.sum = 0.0
+        self.max = 0.0
+        self.samples = deque(maxlen=MAX_SAMPLES)
+
+    def observe(self, seconds, ok=True):
+        self.buckets[bisect_left(BUCKETS, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+        self.max = max(self.max, seconds)
+        self.samples.append(seconds)
+        if not ok:
+            self.errors += 1
+
+
+class Metrics:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._ids = itertools.count(1)
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self._histograms = {}
+            self._counters = {}
+            self._spans = deque(maxlen=MAX_SPANS)
+            self._errors = deque(maxlen=MAX_ERRORS)
+            self.started_at = time.time()
+
+    # --- 記録 ---------------------------------------------------------
+    def observe(self, stage, seconds, ok=True):
+        with self._lock:
+            hist = self._histograms.get(stage)
+            if hist is None:
+                hist = self._histograms[stage] = _Histogram()
+            hist.observe(seconds, ok)
+
+    def count(self, name, value=1, **labels):
+        key = (name, _label_key(labels))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    @contextmanager
+    def span(self, stage, **attrs):
+        # with METRICS.span("get_comments", video=vid): ... の形で使う。例外は記録してそのまま投げ直す
+        span_id = next(self._ids)
+        parent = _current_span.get()
+        token = _current_span.set(span_id)
+        started_at = time.time()
+        started = time.perf_counter()
+        ok = True
+        try:
+            yield
+        except BaseException as e:
+            ok = False
+            self.record_error(stage, e)
+            raise
+        finally:
+            _current_span.reset(token)
+            seconds = time.perf_counter() - started
+            self.observe(stage, seconds, ok)
+            with self._lock:
+                self._spans.append({
+                    "id": span_id, "parent": parent, "stage": stage, "start": started_at,
+                    "seconds": seconds, "ok": ok, "attrs": attrs,
+                })
+
+    def timed(self, stage):
+        # 関数全体を span で囲むデコレータ（async 関数にも使える）
+        def decorator(func):
+            if inspect.iscoroutinefunction(func):
+                @functools.wraps(func)
+                async def async_wrapper(*args, **kwargs):
+                    with self.span(stage):
+                        return await func(*args, **kwargs)
+                return async_wrapper
+
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                with self.span(stage):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def record_error(self, stage, error):
+        self.count("errors", stage=stage, type=type(error).__name__)
+        with self._lock:
+            self._errors.append({"time": time.time(), "stage": stage, "type": type(error).__name__, "message": str(error)[:300]})
+
+    def record_usage(self, model, prompt_tokens, completion_tokens, cached_tokens=0, batch=False):
+        self.count("tokens", prompt_tokens or 0, model=model, kind="prompt")
+        self.count("tokens", completion_tokens or 0, model=model, kind="completion")
+        self.count("tokens", cached_tokens or 0, model=model, kind="cached")
+        cost = usage_cost(model, prompt_tokens or 0, completion_tokens or 0, cached_tokens or 0, batch=batch)
+        if cost is not None:
+            self.count("cost_usd", cost, model=model)
+
+    # --- 集計・出力 -----------------------------------------------------
+    def counter_total(self, name, **labels):
+        # 指定したラベルが一致するカウンタの合計
+        want = set(_label_key(labels))
+        with self._lock:
+            return sum(v for (n, key), v in self._counters.items() if n == name and want <= set(key))
+
+    def snapshot(self):
+        with self._lock:
+            stages = {}
+            for stage, hist in self._histograms.items():
+                samples = sorted(hist.samples)
+                cumulative = list(itertools.accumulate(hist.buckets))
+                stages[stage] = {
+                    "count": hist.count,
+                    "errors": hist.errors,
+                    "total_seconds": round(hist.sum, 6),
+                    "max_seconds": round(hist.max, 6),
+                    "p50_seconds": _quantile(samples, 0.50),
+                    "p95_seconds": _quantile(samples, 0.95),
+                    "p99_seconds": _quantile(samples, 0.99),
+                    "buckets": {str(le): n for le, n in zip(list(BUCKETS) + ["+Inf"], cumulative)},
+                }
+            counters = [
+                {"name": name, "labels": dict(key), "value": value}
+                for (name, key), value in sorted(self._counters.items())
+            ]
+            return {
+                "started_at": self.started_at,
+                "generated_at": time.time(),
+                "stages": stages,
+                "counters": counters,
+                "recent_errors": list(self._errors),
+                "recent_spans": list(self._spans),
+            }
+
+    def to_prometheus(self, prefix=PROMETHEUS_PREFIX):
+        snap = self.snapshot()
+        lines = [
+            f"# HELP {prefix}_stage_seconds Time spent per pipeline stage.",
+            f"# TYPE {prefix}_stage_seconds histogram",
+        ]
+        for stage, s in sorted(snap["stages"].items()):
+            for le, n in s["buckets"].items():
+                lines.append(f'{prefix}_stage_seconds_bucket{{stage="{stage}",le="{le}"}} {n}')
+            lines.append(f'{prefix}_stage_seconds_sum{{stage="{stage}"}} {s["total_seconds"]}')
+            lines.append(f'{prefix}_stage_seconds_count{{stage="{stage}"}} {s["count"]}')
+        names = sorted({c["name"] for c in snap["counters"]})
+        for name in names:
+            lines.append(f"# TYPE {prefix}_{name}_total counter")
+            for c in snap["counters"]:
+                if c["name"] != name:
+                    continue
+                labels = ",".join(f'{k}="{_escape(v)}"' for k, v in c["labels"].items())
+                lines.append(f"{prefix}_{name}_total{{{labels}}} {c['value']}")
+        return "\n".join(lines) + "\n"
+
+    def write(self, path):
+        # 拡張子が .json なら JSON、それ以外は Prometheus のテキスト形式で書き出す
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            if path.endswith(".json"):
+                json.dump(self.snapshot(), f, ensure_ascii=False, indent=2)
+            else:
+                f.write(self.to_prometheus())
+        os.replace(tmp_path, path)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+METRICS = Metrics()
@@ -0,0 +1,125 @@
+# -----------------------------------------------------------
+# 検索画面の先読み（次の検索ページ・上位の動画のコメント）
+# -----------------------------------------------------------
+# 検索結果を描画したら、ユーザが次に押しそうなもの（「もっと動画を読み込む」・上位の動画の「選択」→「分析」）が
+# 使う YouTube API の結果を裏で取得して youtube_cache に入れておく。押したときにはキャッシュから返るので待たない。
+# - セッションごとに1つ持ち、クエリが変わったら reset() で世代を進める。
+#   まだ始まっていない先読みは取り消し、実行中のものも次のページの取得前に止まる
+# - クエリごとにクォータの予算（ユニット数）を決め、取得前に予約できた分だけ取りに行く
+# - 実際の取得は全セッション共通の少数のスレッドで行う（返信の追加取得もこの予算から使う）
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from metrics import METRICS
+from youtube_cache import QUOTA_COST
+
+DEFAULT_WORKERS = 2
+DEFAULT_QUOTA_UNITS = 150  # 次の検索ページ（100）＋上位の動画のコメント数ページ分
+DEFAULT_TOP_VIDEOS = 3
+
+
+class Ticket:
+    # 先読み1件に渡す券。stale なら（クエリが変わったので）やめる。charge() で予算から使う分を予約する
+    def __init__(self, prefetcher, generation):
+        self._prefetcher = prefetcher
+        self.generation = generation
+
+    @property
+    def stale(self):
+        return self.generation != self._prefetcher.generation
+
+    def charge(self, units):
+        return self._prefetcher._charge(self.generation, units)
+
+    def fetch_guard(self, youtube_cache):
+        # core.search_videos / iter_comment_pages の should_fetch に渡す関数
+        # キャッシュにあるもの（APIを呼ばない）は予算を使わずに通し、無いものはクォータ分を予約できたら取りに行く
+        def should_fetch(resource, params):
+            if self.stale:
+                METRICS.count("prefetch", outcome="stale")
+                return False
+            if youtube_cache.is_fresh(resource, **params):
+                return True
+            return self.charge(QUOTA_COST.get(resource, 1))
+
+        return should_fetch
+
+
+class Prefetcher:
+    def __init__(self, executor, quota_units=DEFAULT_QUOTA_UNITS):
+        self.executor = executor
+        self.quota_units = quota_units
+        self.generation = 0
+        self.spent = 0
+        self._lock = threading.Lock()
+        self._futures = []
+        self._on_reset = []
+        self._scheduled = set()
+
+    def reset(self):
+        # クエリが変わった：始まっていない先読みを取り消し、予算を戻す
+        with self._lock:
+            self.generation += 1
+            self.spent = 0
+            futures, self._futures = self._futures, []
+            callbacks, self._on_reset = self._on_reset, []
+            self._scheduled = set()
+        cancelled = sum(1 for f in futures if f.cancel())
+        if cancelled:
+            METRICS.count("prefetch", cancelled, outcome="cancelled")
+        for callback in callbacks:
+            callback()
+
+    def on_reset(self, callback):
+        # 次の reset() で呼ぶ後始末（先読みで始めた分析ジョブの購読をやめる、など）
+        with self._lock:
+            self._on_reset.append(callback)
+
+    def _charge(self, generation, units):
+        with self._lock:
+            if generation != self.generation:
+                METRICS.count("prefetch", outcome="stale")
+                return False
+            if self.spent + units > self.quota_units:
+                METRICS.count("prefetch", outcome="over_budget")
+                return False
+            self.spent += units
+            return True
+
+    def submit(self, name, fn, *args, **kwargs):
+        # fn(ticket, *args, **kwargs) を先読みのスレッドで実行する。同じ世代で同じ name は1回だけ
+        if self.quota_units <= 0:
+            return None
+        with self._lock:
+            if name in self._scheduled:
+                return None
+            self._scheduled.add(name)
+            ticket = Ticket(self, self.generation)
+        future = self.executor.submit(self._run, name, ticket, fn, args, kwargs)
+        with self._lock:
+            self._futures = [f for f in self._futures if not f.done()] + [future]
+        return future
+
+    def _run(self, name, ticket, fn, args, kwargs):
+        if ticket.stale:
+            METRICS.count("prefetch", outcome="stale")
+            return
+        try:
+            with METRICS.span("prefetch", kind=name.split(":")[0]):
+                fn(ticket, *args, **kwargs)
+            METRICS.count("prefetch", outcome="done")
+        except Exception as e:
+            # 先読みの失敗は画面に出さない（本番の取得であらためて扱う）
+            METRICS.record_error("prefetch", e)
+
+
+def executor_from_env():
+    return ThreadPoolExecutor(
+        max_workers=int(os.getenv("PREFETCH_WORKERS", DEFAULT_WORKERS)), thread_name_prefix="prefetch"
+    )
+
+
+def prefetcher_from_env(executor):
+    # PREFETCH_QUOTA_UNITS=0 で先読みしない
+    return Prefetcher(executor, quota_units=int(os.getenv("PREFETCH_QUOTA_UNITS", DEFAULT_QUOTA_UNITS)))
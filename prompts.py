@@ -0,0 +1,291 @@
+# -----------------------------------------------------------
+# プロンプトテンプレートの登録簿（app.py / analyze_video_comments.py 共通）
+# -----------------------------------------------------------
+# - 分析ルール（ルーブリック）はここに1つだけ置き、名前付きで登録する
+# - プロンプトは「固定の前半（ルール＋出力フォーマット）」＋「コメント」の順に並べる。
+#   前半はテンプレートごとに1度だけ組み立てて使い回すので毎回バイト単位で同一になり、
+#   OpenAI 側のプロンプトキャッシュ（共通の接頭辞）が安定して効く
+# - トークン数は tiktoken があれば正確に、無ければ概算で数える
+# - 予算を超える長いコメントは先頭と末尾を残して中略する
+# - version はルール・出力フォーマット・予算のハッシュを含むので、文言を変えると
+#   分析キャッシュや保存済み結果のキーも自動で変わる
+import hashlib
+import json
+import os
+
+DEFAULT_TEMPLATE = "rubric-v2"
+DEFAULT_COMMENT_TOKEN_BUDGET = 1000
+TOKEN_ENCODING = "o200k_base"  # gpt-4o / gpt-4o-mini のトークナイザ
+TRUNCATION_MARK = "\n…（中略）…\n"
+
+# 100万トークンあたりの料金（USD）: (入力, キャッシュ済み入力, 出力)
+MODEL_PRICES = {
+    "gpt-4o-mini": (0.15, 0.075, 0.60),
+    "gpt-4o": (2.50, 1.25, 10.00),
+}
+BATCH_API_DISCOUNT = 0.5
+
+RUBRIC_V2 = """あなたはYouTubeコメントを分析する専門家です。
+以下のルールに【厳密に】従って、指定されたYouTubeコメントを6つの特徴量で分析し、JSON形式で出力してください。
+コメントの表面上の意味だけでなく、文脈的・反語的な意味（例：「良い動画なのでいいねを二回押しました！」などの皮肉表現）も考慮して評価してください。
+
+# 分析ルール
+
+## 1. 攻撃性 (Aggressiveness)
+- **何を測るか**: コメントに含まれる、他者への直接的な敵意、侮辱、脅迫の度合い。
+- **レベル0: なし**: 敬意が払われている、もしくは中立的。無礼な言葉遣いが一切含まれない。（例: 「いつも動画ありがとうございます。」）
+- **レベル1: 低**: 相手を小馬鹿にする、見下すような表現。直接的な暴言ではないが、無礼で相手を不快にさせる可能性がある。（例: 「そんなことも知らないの？」）
+- **レベル2: 中**: 特定の個人や意見に対する直接的な悪口、人格否定、嘲笑。「バカ」「キモい」など、明確な敵意や侮辱が含まれる。（例: 「こいつマジで頭悪いな。」）
+- **レベル3: 高**: 脅迫、ヘイトスピーチ、自殺の教唆など、心身の安全を脅かす表現。（例: 「こういう奴は社会から消えろ。」）
+
+## 2. 挑発性 (Provocation)
+- **何を測るか**: 皮肉、嫌味、決めつけ、煽りなど、相手の感情を逆撫でして反応を引き出そうとする意図の度合い。
+- **レベル0: なし**: 誠実でストレートな表現。裏の意図を感じさせない。（例: 「編集お疲れ様です！」）
+- **レベル1: 低**: 軽度の皮肉や嫌味。分かる人には分かるが、文字通り受け取ることもできるような、曖昧さを含む表現。（例: 「謝罪動画でがっぽり稼げてよかったね。」）
+- **レベル2: 中**: 明確な「上から目線」、レッテル貼り、意図的な揚げ足取り。「信者」「アンチ」などの言葉を使い、対立を煽る。（例: 「信者さんたちが必死に擁護してて草。」）
+- **レベル3: 高**: 議論を破壊し、場を荒らすことを目的とした悪質な煽り。（例: 「はい論破。反論できないなら俺の勝ちね。」）
+
+## 3. 有用性 (Usefulness)
+- **何を測るか**: 動画の内容や他の視聴者に対して、有益な価値を提供している度合い。
+- **レベル0: なし**: 「草」「好き」など、中身のない相槌や単なる感情表現。（例: 「草」）
+- **レベル1: 低**: 具体的な根拠のない、個人の感想や漠然とした意見。（例: 「今回の動画面白くなかったな。」）
+- **レベル2: 中**: 具体的な指摘、改善提案、根拠のある意見、体験談など、参考になる情報を含む。（例: 「BGMが大きすぎてナレーションが聞き取りづらかったです。」）
+- **レベル3: 高**: 専門的な知識に基づく深い分析、データや出典を用いた客観的な訂正など、極めて価値の高い情報を含む。（例: 「この件、〇〇という法律の第△条に抵触する可能性があります。」）
+
+## 4. 感情極性 (Sentiment Polarity)
+- **何を測るか**: コメント全体の感情的なトーン。
+- **レベル-2: 強いネガティブ**: 強い怒り、憎しみ、軽蔑など。（例: 「史上最悪の動画。時間の無駄だった。」）
+- **レベル-1: ネガティブ**: 批判、失望、不満など。（例: 「期待してた内容と違って少し残念でした。」）
+- **レベル0: 中立**: 事実の記述、質問など、感情的な色合いがほとんどない。（例: 「この商品はどこで買えますか？」）
+- **レベル+1: ポジティブ**: 好意、感謝、賞賛など。（例: 「面白かったです！次回の動画も楽しみにしています！」）
+- **レベル+2: 強いポジティブ**: 感動、熱狂、深い感謝など。（例: 「感動で涙が出ました。一生ついていきます！」）
+
+## 5. 自己顕示性 (Self-display / Superiority)
+- **何を測るか**: 自分の知識や経験などをアピールし、優位に立とうとする意図の度合い。
+- **レベル0: なし**: 自分をアピールする意図が見られない。（例: 「この考え方は面白いですね。」）
+- **レベル1: 低**: 話題に関連した自分の体験談や知識を、補足情報として共有している。（例: 「私が昔〇〇に行った時も同じような感じでしたよ。」）
+- **レベル2: 中**: 投稿者の説明に対し、訂正や補足という形で、より専門的な知識や自身の成功体験を披露し、暗に優位性を示している。（例: 「インデックス投資は初心者向けですよね。僕はそれで資産8桁いきました。」）
+- **レベル3: 高**: 経歴、年収などを提示し、他者を直接的・間接的に見下す。（例: 「年収〇〇万以下の人はこの動画見ても意味ないよ。」）
+
+## 6. 文脈依存性 (Context-dependency / In-groupness)
+- **何を測るか**: 内輪にしか真意が伝わらない、専門用語や内輪ネタがどの程度含まれているか。
+- **レベル0: なし**: 誰が読んでも理解できる、一般的で平易な言葉遣い。（例: 「今日の夕飯はカレーにしようと思います。」）
+- **レベル1: 低**: 過去の動画での出来事に言及しているが、文脈を知らなくても大意は推測できる。（例: 「前回の動画で言ってた〇〇の件、解決してよかった！」）
+- **レベル2: 中**: ファンの間だけで通じる愛称、ミーム、決まり文句などが使われており、初見には意味が分かりにくい。（例: 「さすが〇〇さん（ファンの愛称）、今日も平常運転で安心した。」）
+- **レベル3: 高**: 背景知識がなければ、コメントの意味を全く理解できない。（例: 「今日の動画は完全に『例のあの件』だな…」）
+"""
+
+TEMPLATES = {
+    "rubric-v2": RUBRIC_V2,
+}
+
+# 出力フォーマット（ルールの後ろに付く固定部分）。末尾にコメント（またはコメントのJSON配列）が続く
+OUTPUT_FORMATS = {
+    "single": """
+最後に総合コメントとして、なぜそのように評価をしたのか簡潔に説明してください。
+
+# 出力フォーマット（JSON）
+必ず **有効なJSON形式** で出力してください。
+数値には「+」を付けず、引用符の閉じ忘れやコメントは入れないでください。
+{
+  "攻撃性": {"score": 0-3 },
+  "挑発性": {"score": 0-3 },
+  "有用性": {"score": 0-3 },
+  "感情極性": {"score": -2〜+2 },
+  "自己顕示性": {"score": 0-3 },
+  "文脈依存性": {"score": 0-3 },
+  "総合コメント": "..."
+}
+
+# 分析対象コメント
+""",
+    "batch": """
+最後に総合コメントとして、なぜそのように評価をしたのか簡潔に説明してください。
+
+# 出力フォーマット（JSON配列）
+以下の「分析対象コメント」には index 付きで複数のコメントが含まれています。
+各コメントを【互いに独立して】評価し、必ず **有効なJSON配列** だけを出力してください。
+配列の各要素には対応するコメントの "index" を必ず含め、全てのコメントについて1要素ずつ出力してください。
+[
+  {
+    "index": 0,
+    "攻撃性": {"score": 0-3 },
+    "挑発性": {"score": 0-3 },
+    "有用性": {"score": 0-3 },
+    "感情極性": {"score": -2〜+2 },
+    "自己顕示性": {"score": 0-3 },
+    "文脈依存性": {"score": 0-3 },
+    "総合コメント": "..."
+  }
+]
+
+# 分析対象コメント
+""",
+    # スコアのみモード：理由は出さず、6つの整数だけを返してもらう（JSON Schema と併用）
+    "scores": """
+# 出力フォーマット（JSON）
+6つの特徴量の整数スコアだけを出力してください。理由や総合コメントは不要です。
+{"攻撃性": 0, "挑発性": 0, "有用性": 0, "感情極性": 0, "自己顕示性": 0, "文脈依存性": 0}
+
+# 分析対象コメント
+""",
+    "scores_batch": """
+# 出力フォーマット（JSON）
+以下の「分析対象コメント」には index 付きで複数のコメントが含まれています。
+各コメントを【互いに独立して】評価し、6つの特徴量の整数スコアだけを出力してください。理由や総合コメントは不要です。
+全てのコメントについて、対応する "index" 付きで1要素ずつ "results" に入れてください。
+{"results": [{"index": 0, "攻撃性": 0, "挑発性": 0, "有用性": 0, "感情極性": 0, "自己顕示性": 0, "文脈依存性": 0}]}
+
+# 分析対象コメント
+""",
+    # スコアのみモードで付けたスコアについて、理由だけを後から文章で説明してもらう
+    "rationale": """
+# 依頼
+以下のコメントには既に次のスコアが付いています。
+なぜそのスコアになるのか、総合コメントとして2〜3文で簡潔に説明してください（JSONではなく文章のみ）。
+
+""",
+}
+
+
+# --- トークン数 -------------------------------------------------------
+_encoding = None
+_encoding_loaded = False
+
+
+def _get_encoding():
+    # tiktoken は初回にエンコーディングを取得する。入っていない・取得できない環境では概算に切り替える
+    global _encoding, _encoding_loaded
+    if not _encoding_loaded:
+        _encoding_loaded = True
+        try:
+            import tiktoken
+            _encoding = tiktoken.get_encoding(TOKEN_ENCODING)
+        except Exception:
+            _encoding = None
+    return _encoding
+
+
+def estimate_tokens(text):
+    # 日本語はおおよそ1文字≒1トークン、ASCIIは4文字≒1トークンとして概算する
+    text = str(text or "")
+    ascii_chars = sum(1 for ch in text if ord(ch) < 128)
+    return (len(text) - ascii_chars) + ascii_chars // 4 + 1
+
+
+def count_tokens(text):
+    encoding = _get_encoding()
+    if encoding is None:
+        return estimate_tokens(text)
+    return len(encoding.encode(str(text or ""), disallowed_special=()))
+
+
+def truncate_to_tokens(text, budget):
+    # 予算以内ならそのまま。超える場合は先頭2/3・末尾1/3を残して中略する
+    text = str(text or "")
+    tokens = count_tokens(text)
+    if budget is None or tokens <= budget:
+        return text
+    chars_per_token = len(text) / max(tokens, 1)
+    keep = int(budget * chars_per_token)
+    while keep > 0:
+        head, tail = keep * 2 // 3, keep // 3
+        shortened = text[:head] + TRUNCATION_MARK + (text[-tail:] if tail else "")
+        if count_tokens(shortened) <= budget:
+            return shortened
+        keep = int(keep * 0.9)
+    return TRUNCATION_MARK
+
+
+# --- 料金 -------------------------------------------------------------
+def usage_cost(model, prompt_tokens, completion_tokens, cached_tokens=0, batch=False):
+    # 推定料金（USD）。料金表に無いモデルは None
+    prices = MODEL_PRICES.get(model)
+    if prices is None:
+        return None
+    input_price, cached_price, output_price = prices
+    cost = (
+        (prompt_tokens - cached_tokens) * input_price
+        + cached_tokens * cached_price
+        + completion_tokens * output_price
+    ) / 1_000_000
+    return cost * BATCH_API_DISCOUNT if batch else cost
+
+
+def format_usage(stats, model, batch=False):
+    # AnalysisEngine.stats（または同じキーの辞書）から「入力 / 出力トークンと推定料金」の1行を作る
+    cost = usage_cost(
+        model, stats.get("prompt_tokens", 0), stats.get("completion_tokens", 0), stats.get("cached_tokens", 0), batch=batch
+    )
+    text = (
+        f"入力 {stats.get('prompt_tokens', 0):,}（キャッシュ {stats.get('cached_tokens', 0):,}）"
+        f" / 出力 {stats.get('completion_tokens', 0):,} tokens"
+    )
+    if cost is not None:
+        text += f"・推定 ${cost:.4f}"
+    return text
+
+
+# --- テンプレート -----------------------------------------------------
+class PromptTemplate:
+    def __init__(self, name, rules, comment_token_budget=DEFAULT_COMMENT_TOKEN_BUDGET):
+        self.name = name
+        self.comment_token_budget = comment_token_budget
+        # 固定の前半はここで1度だけ組み立てる
+        self.prefixes = {mode: rules + fmt for mode, fmt in OUTPUT_FORMATS.items()}
+        digest = hashlib.sha256(
+            json.dumps([self.prefixes, comment_token_budget], ensure_ascii=False, sort_keys=True).encode("utf-8")
+        ).hexdigest()[:8]
+        self.version = f"{name}@{digest}"
+        self._fixed_tokens = {}
+
+    def fixed_tokens(self, mode):
+        if mode not in self._fixed_tokens:
+            self._fixed_tokens[mode] = count_tokens(self.prefixes[mode])
+        return self._fixed_tokens[mode]
+
+    def fit(self, comment_text):
+        return truncate_to_tokens(comment_text, self.comment_token_budget)
+
+    def single(self, comment_text, scores_only=False):
+        return self.prefixes["scores" if scores_only else "single"] + self.fit(comment_text)
+
+    def batch(self, comments, scores_only=False):
+        items = json.dumps(
+            [{"index": i, "comment": self.fit(c)} for i, c in enumerate(comments)],
+            ensure_ascii=False,
+            indent=2,
+        )
+        return self.prefixes["scores_batch" if scores_only else "batch"] + items
+
+    def rationale(self, comment_text, scores):
+        clean = {}
+        for key, value in scores.items():
+            try:
+                clean[key] = int(value)
+            except (TypeError, ValueError):
+                clean[key] = None
+        return (
+            self.prefixes["rationale"]
+            + f"# 付いているスコア\n{json.dumps(clean, ensure_ascii=False)}\n\n# 分析対象コメント\n"
+            + self.fit(comment_text)
+        )
+
+
+_templates = {}
+
+
+def get_template(name=DEFAULT_TEMPLATE, comment_token_budget=DEFAULT_COMMENT_TOKEN_BUDGET):
+    key = (name, comment_token_budget)
+    if key not in _templates:
+        if name not in TEMPLATES:
+            raise ValueError(f"未登録のプロンプトテンプレートです: {name}（登録済み: {', '.join(TEMPLATES)}）")
+        _templates[key] = PromptTemplate(name, TEMPLATES[name], comment_token_budget)
+    return _templates[key]
+
+
+def template_from_env():
+    return get_template(
+        os.getenv("PROMPT_TEMPLATE", DEFAULT_TEMPLATE),
+        int(os.getenv("COMMENT_TOKEN_BUDGET", DEFAULT_COMMENT_TOKEN_BUDGET)),
+    )
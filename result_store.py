@@ -0,0 +1,141 @@
+# -----------------------------------------------------------
+# 分析結果の列指向ストア
+# -----------------------------------------------------------
+# 1コメント=1辞書で行を作る代わりに、6つのスコアを int8 のNumPy配列（＋欠損マスク）へ
+# 直接書き込み、コメント本文などの文字列は Arrow の文字列配列として持つ。
+# 10万件規模でもメモリが小さく、閾値フィルタも配列の比較だけで済む。
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+
+from batch_analysis import FEATURE_RANGES
+
+SCORE_COLUMNS = [f"{k}_score" for k in FEATURE_RANGES]
+_NA = -128  # int8 で欠損を表す番兵（フィルタ時のみ使用）
+
+
+def _as_int_score(value, low, high):
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+        return None
+    if value != value:  # NaN
+        return None
+    score = int(round(value))
+    return score if low <= score <= high else None
+
+
+def normalize_scores(analysis, fallback=None):
+    # (6つのスコアのタプル, 総合コメント) を返す
+    # よくある {"攻撃性": {"score": 1}, ...} の形は辞書を1回なめるだけで処理し、
+    # それ以外の崩れた出力だけ fallback（app.py の normalize_analysis_to_row）に回す
+    scores = []
+    if isinstance(analysis, dict):
+        for key, (low, high) in FEATURE_RANGES.items():
+            val = analysis.get(key)
+            score = _as_int_score(val.get("score") if isinstance(val, dict) else None, low, high)
+            if score is None:
+                break
+            scores.append(score)
+        overall = analysis.get("総合コメント")
+        if len(scores) == len(FEATURE_RANGES):
+            if isinstance(overall, str) and overall.strip():
+                return tuple(scores), overall
+            if overall is None and "総合コメント" in analysis:
+                # スコアのみモードの結果（総合コメントは必要になった行だけ後から生成する）
+                return tuple(scores), None
+
+    if fallback is None:
+        return tuple(scores + [None] * (len(FEATURE_RANGES) - len(scores))), None
+    row = fallback(analysis)
+    scores = tuple(
+        _as_int_score(row.get(f"{k}_score"), low, high) for k, (low, high) in FEATURE_RANGES.items()
+    )
+    return scores, row.get("総合コメント")
+
+
+class ResultStore:
+    def __init__(self, capacity=1024):
+        self._n = 0
+        self._scores = np.zeros((len(FEATURE_RANGES), capacity), dtype=np.int8)
+        self._mask = np.ones((len(FEATURE_RANGES), capacity), dtype=bool)  # True = 欠損
+        self._groups = np.zeros(capacity, dtype=np.int32)
+        # 返信先 = 返信なら親コメントの本文（親コメント自身は欠損）。返信が1件も無ければ列を作らない
+        self._has_parent = False
+        self._text_chunks = {"コメント": [], "総合コメント": [], "返信先": []}
+        self._pending = {"コメント": [], "総合コメント": [], "返信先": []}
+
+    def __len__(self):
+        return self._n
+
+    def _grow(self, needed):
+        capacity = self._groups.shape[0]
+        if needed <= capacity:
+            return
+        while capacity < needed:
+            capacity *= 2
+        scores = np.zeros((len(FEATURE_RANGES), capacity), dtype=np.int8)
+        mask = np.ones((len(FEATURE_RANGES), capacity), dtype=bool)
+        groups = np.zeros(capacity, dtype=np.int32)
+        scores[:, :self._n] = self._scores[:, :self._n]
+        mask[:, :self._n] = self._mask[:, :self._n]
+        groups[:self._n] = self._groups[:self._n]
+        self._scores, self._mask, self._groups = scores, mask, groups
+
+    def append(self, scores, overall, comment, group=0, parent=None):
+        self._grow(self._n + 1)
+        for j, score in enumerate(scores):
+            if score is None:
+                self._mask[j, self._n] = True
+            else:
+                self._scores[j, self._n] = score
+                self._mask[j, self._n] = False
+        self._groups[self._n] = group
+        self._pending["コメント"].append(comment)
+        self._pending["総合コメント"].append(overall)
+        self._pending["返信先"].append(parent)
+        self._has_parent = self._has_parent or parent is not None
+        self._n += 1
+
+    def _text_column(self, name):
+        # まだArrow化していない分だけ変換してチャンクに追加する（毎回全件を変換しない）
+        if self._pending[name]:
+            self._text_chunks[name].append(pa.array(self._pending[name], type=pa.string()))
+            self._pending[name] = []
+        chunks = self._text_chunks[name] or [pa.array([], type=pa.string())]
+        return pd.arrays.ArrowExtensionArray(pa.chunked_array(chunks, type=pa.string()))
+
+    def to_frame(self, group_sizes=None):
+        n = self._n
+        data = {}
+        for j, col in enumerate(SCORE_COLUMNS):
+            data[col] = pd.arrays.IntegerArray(self._scores[j, :n].copy(), self._mask[j, :n].copy())
+        data["総合コメント"] = self._text_column("総合コメント")
+        data["コメント"] = self._text_column("コメント")
+        if self._has_parent:
+            data["返信先"] = self._text_column("返信先")
+        data["重複グループ"] = self._groups[:n].copy()
+        if group_sizes is not None:
+            data["重複数"] = np.asarray(group_sizes, dtype=np.int32)[self._groups[:n]]
+        return pd.DataFrame(data)
+
+
+def score_values(df, key):
+    # スコア列を int8 配列で返す（欠損は番兵 -128）
+    col = f"{key}_score"
+    if col not in df.columns:
+        return np.full(len(df), _NA, dtype=np.int8)
+    s = df[col]
+    if isinstance(s.dtype, pd.Int8Dtype):
+        return s.to_numpy(dtype=np.int8, na_value=_NA)
+    # 旧形式（object列）のDataFrameが渡された場合
+    return pd.to_numeric(s, errors="coerce").fillna(_NA).to_numpy().astype(np.int8)
+
+
+def score_mask(df, threshold_ranges):
+    # 各スコア列が閾値レンジに入っている行だけ True の bool 配列（欠損は False）
+    mask = np.ones(len(df), dtype=bool)
+    for key, (low, high) in threshold_ranges.items():
+        if f"{key}_score" not in df.columns:
+            continue
+        values = score_values(df, key)
+        mask &= (values != _NA) & (values >= low) & (values <= high)
+    return mask
@@ -0,0 +1,157 @@
+# -----------------------------------------------------------
+# コメントの多い動画のサンプリング推定
+# -----------------------------------------------------------
+# 数万件のコメントを全部GPTで分析する代わりに、
+# - コメントを流し読みし（1ページ100件＝1 unit）、層（高評価数の桁 / 投稿月）ごとに件数を数えながら、
+#   各コメントに無作為な順位を付けて順位の小さいものだけを層ごとに上限件数まで持つ（bottom-k サンプリング）。
+#   順位の小さい順に何件取っても、その層からの単純無作為抽出になる
+# - 層の大きさに比例して割り当てた件数だけを分析し、閾値レンジに入るコメントの割合を層別推定する（95%信頼区間つき）
+# - 区間の半幅が目標より広ければ、必要な件数を見積もって追加で抽出・分析する（目標に届いたら打ち切る）
+import heapq
+import math
+import random
+from collections import Counter
+
+import numpy as np
+
+Z_95 = 1.96
+DEFAULT_SCAN_LIMIT = 20_000
+DEFAULT_MAX_SAMPLE = 600
+DEFAULT_TARGET_MARGIN = 0.05
+FIRST_ROUND_SIZE = 100  # 最初に分析する件数
+MIN_ROUND_SIZE = 50  # 追加で抽出するときの最小件数
+MIN_PER_STRATUM = 2  # 分散を見積もれるよう、どの層からも最低これだけは抽出する
+
+# 層の分け方 → 表示名
+STRATA = {"likes": "高評価数", "month": "投稿月"}
+# 高評価数の層（下限, 名前）
+LIKE_BUCKETS = [
+    (0, "高評価 0"),
+    (1, "高評価 1〜9"),
+    (10, "高評価 10〜99"),
+    (100, "高評価 100〜999"),
+    (1000, "高評価 1000以上"),
+]
+
+
+def stratum_of(comment, by="likes"):
+    if by == "month":
+        return (comment.get("published_at") or "")[:7] or "不明"
+    likes = comment.get("like_count") or 0
+    label = LIKE_BUCKETS[0][1]
+    for low, name in LIKE_BUCKETS:
+        if likes >= low:
+            label = name
+    return label
+
+
+class StratifiedSampler:
+    def __init__(self, by="likes", capacity=DEFAULT_MAX_SAMPLE, seed=None):
+        # capacity: 層ごとに持っておく候補の数（分析する最大件数より多くは要らない）
+        self.by = by
+        self.capacity = capacity
+        self.totals = Counter()
+        self._heaps = {}  # 層 -> [(-順位, 通し番号, コメント)]（順位の小さい capacity 件を最大ヒープで持つ）
+        self._ordered = None
+        self._taken = Counter()
+        self._random = random.Random(seed)
+        self._seq = 0
+
+    @property
+    def population(self):
+        return sum(self.totals.values())
+
+    def add(self, comment):
+        stratum = stratum_of(comment, self.by)
+        self.totals[stratum] += 1
+        heap = self._heaps.setdefault(stratum, [])
+        rank = self._random.random()
+        self._seq += 1
+        item = (-rank, self._seq, comment)
+        if len(heap) < self.capacity:
+            heapq.heappush(heap, item)
+        elif rank < -heap[0][0]:
+            heapq.heapreplace(heap, item)
+
+    def _candidates(self):
+        # 流し読みが終わってから、層ごとの候補を順位の小さい順に並べる（以後 add() はしない）
+        if self._ordered is None:
+            self._ordered = {
+                stratum: [comment for _, _, comment in sorted(heap, reverse=True)]
+                for stratum, heap in self._heaps.items()
+            }
+        return self._ordered
+
+    def allocation(self, n_target):
+        # 層の大きさに比例した割り当て（候補の数まで）。合計は n_target を超えない
+        # どの層にも最低 MIN_PER_STRATUM 件を割り当てるのは、全ての層に配っても n_target に収まるときだけ
+        # （月ごとの層がたくさんあると最低件数だけで上限を超えるため。抽出されなかった層は推定で按分される）
+        population = self.population
+        candidates = self._candidates()
+        floor = MIN_PER_STRATUM if len(self.totals) * MIN_PER_STRATUM <= n_target else 0
+        quotas = {stratum: n_target * total / population for stratum, total in self.totals.items()}
+        result = {
+            stratum: min(len(candidates[stratum]), max(floor, math.floor(quota)))
+            for stratum, quota in quotas.items()
+        }
+        # 端数は最大剰余法で配る（候補が尽きた層は飛ばす）
+        left = n_target - sum(result.values())
+        while left > 0:
+            room = [s for s in result if result[s] < len(candidates[s])]
+            if not room:
+                break
+            for stratum in sorted(room, key=lambda s: result[s] - quotas[s])[:left]:
+                result[stratum] += 1
+                left -= 1
+        return result
+
+    def draw(self, n_target):
+        # 合計が n_target 件になるまで追加で抽出し、[(層, コメント)] を返す（抽出済みのものは返さない）
+        # 前の回に割り当てより多く抽出した層があっても、合計は n_target を超えない
+        candidates = self._candidates()
+        budget = n_target - sum(self._taken.values())
+        allocation = self.allocation(n_target)
+        drawn = []
+        for stratum in sorted(allocation, key=lambda s: self._taken[s] - allocation[s]):
+            n = min(allocation[stratum], self._taken[stratum] + max(0, budget))
+            for comment in candidates[stratum][self._taken[stratum]:n]:
+                drawn.append((stratum, comment))
+            budget -= max(0, n - self._taken[stratum])
+            self._taken[stratum] = max(self._taken[stratum], n)
+        return drawn
+
+def estimate_share(matched, strata, valid, totals, z=Z_95):
+    # 層別推定。matched / strata / valid は分析した行ごとの配列（valid=False の行は分析失敗として除く）
+    # p = Σ W_h p_h,  Var = Σ W_h² (1 - n_h/N_h) p_h(1 - p_h) / n_h
+    # p_h が 0 や 1 のときに区間の幅が 0 にならないよう、分散には (x + 0.5) / (n + 1) を使う
+    # 分析できた行が1件もない層は、残りの層の重みを按分して推定する
+    # (推定値, 下限, 上限, 分析できた件数) を返す
+    matched = np.asarray(matched, dtype=bool)
+    strata = np.asarray(strata)
+    valid = np.asarray(valid, dtype=bool)
+    sampled = {}
+    for stratum in totals:
+        in_stratum = valid & (strata == stratum)
+        n = int(in_stratum.sum())
+        if n:
+            sampled[stratum] = (n, int((matched & in_stratum).sum()))
+    if not sampled:
+        return 0.0, 0.0, 1.0, 0
+    population = sum(totals[s] for s in sampled)
+    estimate = variance = 0.0
+    for stratum, (n, x) in sampled.items():
+        weight = totals[stratum] / population
+        smoothed = (x + 0.5) / (n + 1)
+        fpc = max(0.0, 1.0 - n / totals[stratum])
+        estimate += weight * x / n
+        variance += weight ** 2 * fpc * smoothed * (1 - smoothed) / n
+    half = z * math.sqrt(variance)
+    return estimate, max(0.0, estimate - half), min(1.0, estimate + half), sum(n for n, _ in sampled.values())
+
+
+def next_sample_size(n, margin, target_margin, max_sample):
+    # 半幅は件数の平方根に反比例するので、目標に届くのに必要な件数を見積もる（1割多めに取る）
+    if margin <= 0:
+        return n
+    needed = math.ceil(n * (margin / target_margin) ** 2 * 1.1)
+    return min(max_sample, max(n + MIN_ROUND_SIZE, needed))
@@ -0,0 +1,103 @@
+# -----------------------------------------------------------
+# 閾値フィルタ用のスコアインデックス
+# -----------------------------------------------------------
+# 分析1回につき1度だけ作り、スライダーを動かすたびの再実行では
+# - 件数・特徴量ごとの分布: 4×4×4×5×4×4 の件数キューブを切り出して足すだけ（行数に依存しない）
+# - 該当行のマスク: 特徴量×スコア値ごとのビットマップを OR（範囲内の値）→ AND（特徴量間）
+# で求める。同じレンジ（プリセットなど）のマスクは使い回す。
+# 共有された結果（shared_results）では複数セッションのスレッドから呼ばれるので、マスクのキャッシュはロックで守る。
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+from batch_analysis import FEATURE_RANGES
+from result_store import score_values
+
+MASK_CACHE_SIZE = 32
+
+
+class ScoreIndex:
+    def __init__(self, df):
+        self.n_rows = len(df)
+        self.features = list(FEATURE_RANGES)
+        self.shape = tuple(high - low + 1 for low, high in FEATURE_RANGES.values())
+        self._mask_lock = threading.Lock()
+        self._mask_cache = OrderedDict()
+
+        codes = []
+        complete = np.ones(self.n_rows, dtype=bool)
+        self.bitmaps = {}
+        for key, (low, high) in FEATURE_RANGES.items():
+            values = score_values(df, key)
+            ok = (values >= low) & (values <= high)
+            complete &= ok
+            # 値ごとのビットマップ（1行=1ビット）
+            self.bitmaps[key] = {
+                v: np.packbits(values == v) for v in range(low, high + 1)
+            }
+            codes.append(np.where(ok, values.astype(np.int16) - low, 0))
+
+        # 6つ全てのスコアがそろった行だけがフィルタに残りうるので、キューブにはそれだけを数える
+        flat = np.ravel_multi_index([c[complete] for c in codes], self.shape)
+        self.cube = np.bincount(flat, minlength=int(np.prod(self.shape))).reshape(self.shape)
+        self.n_complete = int(complete.sum())
+        # スコアがそろわなかった（分析に失敗した）行の行番号
+        self.incomplete = np.flatnonzero(~complete)
+
+    @property
+    def nbytes(self):
+        # ビットマップ・キューブ・マスクのキャッシュが占めるメモリ
+        total = self.cube.nbytes + self.incomplete.nbytes + sum(b.nbytes for bitmaps in self.bitmaps.values() for b in bitmaps.values())
+        with self._mask_lock:
+            return total + sum(m.nbytes for m in self._mask_cache.values())
+
+    def _slices(self, ranges):
+        slices = []
+        for key, (low, high) in FEATURE_RANGES.items():
+            lo, hi = ranges.get(key, (low, high))
+            lo, hi = max(lo, low), min(hi, high)
+            slices.append(slice(lo - low, max(hi - low + 1, lo - low)))
+        return tuple(slices)
+
+    def count(self, ranges):
+        return int(self.cube[self._slices(ranges)].sum())
+
+    def histograms(self, ranges):
+        # {特徴量: {スコア値: 件数}}（フィルタ後の分布）
+        sub = self.cube[self._slices(ranges)]
+        result = {}
+        for axis, (key, (low, high)) in enumerate(FEATURE_RANGES.items()):
+            lo = max(ranges.get(key, (low, high))[0], low)
+            other = tuple(a for a in range(len(self.shape)) if a != axis)
+            counts = sub.sum(axis=other)
+            hist = {v: 0 for v in range(low, high + 1)}
+            for offset, c in enumerate(counts):
+                hist[lo + offset] = int(c)
+            result[key] = hist
+        return result
+
+    def mask(self, ranges):
+        cache_key = tuple(tuple(ranges.get(k, FEATURE_RANGES[k])) for k in self.features)
+        with self._mask_lock:
+            cached = self._mask_cache.get(cache_key)
+            if cached is not None:
+                self._mask_cache.move_to_end(cache_key)
+                return cached
+
+        bits = None
+        for key, (low, high) in FEATURE_RANGES.items():
+            lo, hi = ranges.get(key, (low, high))
+            feature_bits = np.zeros((self.n_rows + 7) // 8, dtype=np.uint8)
+            for v in range(max(lo, low), min(hi, high) + 1):
+                feature_bits |= self.bitmaps[key][v]
+            bits = feature_bits if bits is None else (bits & feature_bits)
+        mask = np.unpackbits(bits, count=self.n_rows).astype(bool)
+
+        with self._mask_lock:
+            # 使われていない順に捨てる
+            self._mask_cache[cache_key] = mask
+            self._mask_cache.move_to_end(cache_key)
+            while len(self._mask_cache) > MASK_CACHE_SIZE:
+                self._mask_cache.popitem(last=False)
+        return mask
@@ -0,0 +1,98 @@
+# -----------------------------------------------------------
+# セッションをまたいで共有する分析結果（プロセス内）
+# -----------------------------------------------------------
+# 同じ動画・同じ分析設定（プロンプトの版・モデル・temperature・取得方法）の結果はプロセスで1つだけ持ち、
+# 全セッションが同じ DataFrame / ScoreIndex / SimilarityIndex を読む（pandas の Copy-on-Write により、読む側が加工しても元は変わらない）。
+# - 同じキーの分析の実行中の合流（single-flight）は jobs.JobRunner が受け持ち、ここには完了した結果だけを置く
+# - 保存した結果の合計サイズが上限を超えたら、最後に使われたのが古いものから捨てる（LRU）
+# - 古くなった結果（既定1時間）は使わずに分析し直す
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from metrics import METRICS
+
+DEFAULT_MAX_BYTES = 512 * 1024 * 1024
+DEFAULT_TTL_SECONDS = 60 * 60
+
+
+def frame_nbytes(df, *indexes):
+    # 結果1件が占めるメモリの見積もり（文字列列も含めた DataFrame ＋ インデックス）
+    total = int(df.memory_usage(index=True, deep=True).sum())
+    for index in indexes:
+        if index is not None:
+            total += getattr(index, "nbytes", 0)
+    return total
+
+
+class SharedResult:
+    def __init__(self, key, df, index, nbytes, meta=None, similar=None):
+        self.key = key
+        self.df = df
+        self.index = index
+        self.nbytes = nbytes
+        self.meta = meta  # 結果に付随する小さな情報（サンプリング推定の層の大きさなど）
+        self.similar = similar  # similarity.SimilarityIndex（似たコメントの検索・クラスタ）
+        self.created_at = time.time()
+
+
+class SharedResultStore:
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES, ttl_seconds=DEFAULT_TTL_SECONDS):
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self._lock = threading.Lock()
+        self._results = OrderedDict()
+        self._bytes = 0
+
+    def _drop(self, key):
+        result = self._results.pop(key)
+        self._bytes -= result.nbytes
+
+    def _get_locked(self, key):
+        result = self._results.get(key)
+        if result is None:
+            return None
+        if self.ttl_seconds and time.time() - result.created_at > self.ttl_seconds:
+            self._drop(key)
+            return None
+        self._results.move_to_end(key)
+        return result
+
+    def get(self, key):
+        with self._lock:
+            result = self._get_locked(key)
+        METRICS.count("shared_results", outcome="hit" if result is not None else "miss")
+        return result
+
+    def put(self, key, df, index=None, meta=None, similar=None):
+        nbytes = frame_nbytes(df, index, similar)
+        result = SharedResult(key, df, index, nbytes, meta, similar)
+        with self._lock:
+            if key in self._results:
+                self._drop(key)
+            # 上限より大きい結果は保存しない（分析したセッションだけが使う）
+            if nbytes <= self.max_bytes:
+                self._results[key] = result
+                self._bytes += nbytes
+                while self._bytes > self.max_bytes:
+                    self._drop(next(iter(self._results)))
+                    METRICS.count("shared_results", outcome="evicted")
+        return result
+
+    def stats(self):
+        with self._lock:
+            return {
+                "entries": len(self._results),
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+            }
+
+
+def shared_results_from_env():
+    max_mb = os.getenv("SHARED_RESULTS_MAX_MB")
+    ttl = os.getenv("SHARED_RESULTS_TTL_SECONDS")
+    return SharedResultStore(
+        max_bytes=int(float(max_mb) * 1024 * 1024) if max_mb else DEFAULT_MAX_BYTES,
+        ttl_seconds=int(ttl) if ttl else DEFAULT_TTL_SECONDS,
+    )
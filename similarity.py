@@ -0,0 +1,161 @@
+# -----------------------------------------------------------
+# 分析済みコメントの類似検索・クラスタ
+# -----------------------------------------------------------
+# 攻撃的なコメントが見つかったとき、分析済みの中から似たコメントをまとめて探すための索引（CPUのみ）。
+# - 正規化した本文（dedup.normalize_for_dedup）の文字2〜3-gramを、符号つきハッシュで DIM 次元に落としたベクトル
+#   （feature hashing）を L2 正規化して float32 の行列に持つ。1行 = 重複グループ1つ（同じ本文は1回だけ）
+# - 分析中にグループが増えるたびに add() で行を足す（ResultStore と同じく容量を倍々で広げる）
+# - 検索は行列×ベクトル1回（コサイン類似度）と argpartition で上位だけを取る。10万グループで数ミリ秒
+# - クラスタは球面 k-means（内積で割り当て → 重心を正規化）。同じクラスタ数の結果は使い回す
+#   （共有された結果では複数セッションのスレッドから呼ばれるので、その保存先はロックで守る）
+import threading
+import zlib
+from collections import OrderedDict
+
+import numpy as np
+
+from dedup import normalize_for_dedup
+
+DIM = 256  # 1グループあたり 1KB（10万グループで約100MB）
+NGRAMS = (2, 3)
+DEFAULT_TOP_K = 200
+DEFAULT_MIN_SIMILARITY = 0.5
+KMEANS_ITERATIONS = 10
+CLUSTER_CACHE_SIZE = 8
+
+
+def ngrams(normalized):
+    if len(normalized) <= NGRAMS[0]:
+        return {normalized}
+    return {normalized[i:i + n] for n in NGRAMS for i in range(len(normalized) - n + 1)}
+
+
+def text_vectors(texts):
+    # 本文のリスト → (件数, DIM) の L2 正規化済み float32 行列
+    rows = []
+    hashes = []
+    for i, text in enumerate(texts):
+        grams = ngrams(normalize_for_dedup(text))
+        hashes.extend(zlib.crc32(g.encode("utf-8")) for g in grams)
+        rows.extend([i] * len(grams))
+    n = len(texts)
+    h = np.asarray(hashes, dtype=np.int64)
+    # 下位ビットで次元、別のビットで符号を決める（衝突した n-gram どうしが打ち消し合い、内積が偏らない）
+    signs = ((h >> 16) & 1) * 2 - 1
+    flat = np.asarray(rows, dtype=np.int64) * DIM + h % DIM
+    vectors = np.bincount(flat, weights=signs, minlength=n * DIM).reshape(n, DIM).astype(np.float32)
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.where(norms > 0, norms, 1)
+
+
+class SimilarityIndex:
+    def __init__(self, capacity=1024):
+        self._n = 0
+        self._vectors = np.zeros((capacity, DIM), dtype=np.float32)
+        self._keys = np.zeros(capacity, dtype=np.int64)
+        self._row_of = {}  # キー（重複グループID）-> 行
+        self._cluster_lock = threading.Lock()
+        self._cluster_cache = OrderedDict()
+
+    def __len__(self):
+        return self._n
+
+    @property
+    def nbytes(self):
+        with self._cluster_lock:
+            cached = sum(labels.nbytes + sims.nbytes for labels, sims in self._cluster_cache.values())
+        return self._vectors.nbytes + self._keys.nbytes + cached
+
+    @property
+    def keys(self):
+        return self._keys[:self._n]
+
+    def _grow(self, needed):
+        capacity = self._keys.shape[0]
+        if needed <= capacity:
+            return
+        while capacity < needed:
+            capacity *= 2
+        vectors = np.zeros((capacity, DIM), dtype=np.float32)
+        keys = np.zeros(capacity, dtype=np.int64)
+        vectors[:self._n] = self._vectors[:self._n]
+        keys[:self._n] = self._keys[:self._n]
+        self._vectors, self._keys = vectors, keys
+
+    def add(self, keys, texts):
+        # keys: 重複グループID（行と1対1）、texts: そのグループの本文。既にあるキーは足さない
+        new = [(k, t) for k, t in zip(keys, texts) if k not in self._row_of]
+        if not new:
+            return
+        self._grow(self._n + len(new))
+        self._vectors[self._n:self._n + len(new)] = text_vectors([t for _, t in new])
+        for offset, (k, _) in enumerate(new):
+            self._keys[self._n + offset] = k
+            self._row_of[k] = self._n + offset
+        self._n += len(new)
+        with self._cluster_lock:
+            self._cluster_cache.clear()
+
+    def _top(self, vector, k, min_similarity):
+        sims = self._vectors[:self._n] @ vector
+        k = min(k, self._n)
+        if k <= 0:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)
+        top = np.argpartition(-sims, k - 1)[:k] if k < self._n else np.arange(self._n)
+        top = top[sims[top] >= min_similarity]
+        top = top[np.argsort(-sims[top], kind="stable")]
+        return self._keys[top], sims[top]
+
+    def search(self, text, k=DEFAULT_TOP_K, min_similarity=DEFAULT_MIN_SIMILARITY):
+        # 任意の文に似たグループ。(キーの配列, 類似度の配列) を類似度の高い順に返す
+        return self._top(text_vectors([text])[0], k, min_similarity)
+
+    def similar_to(self, key, k=DEFAULT_TOP_K, min_similarity=DEFAULT_MIN_SIMILARITY):
+        # 索引にあるグループに似たグループ（自分自身も類似度1で含む）
+        row = self._row_of.get(key)
+        if row is None:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)
+        return self._top(self._vectors[row], k, min_similarity)
+
+    def clusters(self, n_clusters, seed=0):
+        # 球面 k-means。行ごとの (クラスタ番号, 重心との類似度) を keys と同じ順で返す
+        with self._cluster_lock:
+            cached = self._cluster_cache.get(n_clusters)
+            if cached is not None:
+                self._cluster_cache.move_to_end(n_clusters)
+                return cached
+        X = self._vectors[:self._n]
+        k = max(1, min(n_clusters, self._n))
+        rng = np.random.default_rng(seed)
+        centers = X[rng.choice(self._n, size=k, replace=False)] if self._n else np.zeros((1, DIM), dtype=np.float32)
+        labels = np.zeros(self._n, dtype=np.int32)
+        for iteration in range(KMEANS_ITERATIONS):
+            sims = X @ centers.T
+            new_labels = sims.argmax(axis=1).astype(np.int32)
+            if iteration and np.array_equal(new_labels, labels):
+                break
+            labels = new_labels
+            # クラスタごとの和は (クラスタ数, 件数) の0/1行列との積1回で求める（np.add.at / reduceat より速い）
+            onehot = np.zeros((k, self._n), dtype=np.float32)
+            onehot[labels, np.arange(self._n)] = 1
+            sums = onehot @ X
+            norms = np.linalg.norm(sums, axis=1, keepdims=True)
+            # 空になったクラスタは前の重心のまま
+            present = norms[:, 0] > 0
+            centers[present] = sums[present] / norms[present]
+        result = (labels, (X * centers[labels]).sum(axis=1))
+        with self._cluster_lock:
+            self._cluster_cache[n_clusters] = result
+            self._cluster_cache.move_to_end(n_clusters)
+            while len(self._cluster_cache) > CLUSTER_CACHE_SIZE:
+                self._cluster_cache.popitem(last=False)
+        return result
+
+
+def similarity_from_frame(df):
+    # 結果の DataFrame（コメント・重複グループの列）から作り直す（分析を中止した途中結果など）
+    groups = df["重複グループ"].to_numpy()
+    keys, first = np.unique(groups, return_index=True)
+    index = SimilarityIndex(capacity=max(1, len(keys)))
+    index.add(keys.tolist(), df["コメント"].to_numpy()[first].tolist())
+    return index
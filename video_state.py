@@ -0,0 +1,139 @@
+# -----------------------------------------------------------
+# 動画ごとの分析状態（差分再分析用）
+# -----------------------------------------------------------
+# 分析済みコメントのID・投稿日時・本文・分析結果（返信なら親コメントのID）を動画IDごとに保存しておき、
+# 再分析時は新着順（order=time）で既知のコメントに当たるところまでだけ取得・分析する。
+# 新着順はスレッド（親コメント）の投稿日時の順なので、打ち切りの判定には親コメントだけを使う。
+# 返信は新しいスレッドの分だけ取得するので、分析済みのスレッドに後から付いた返信は差分再分析では取り込まない。
+# 分析結果はプロンプトの版（prompts.PromptTemplate.version）付きで保存し、版が違う結果は使わない。
+import json
+import os
+import sqlite3
+import threading
+import time
+
+DEFAULT_STATE_PATH = os.path.join(".cache", "video_state.sqlite3")
+
+
+class VideoStateStore:
+    def __init__(self, path=DEFAULT_STATE_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        if path != ":memory:":
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        with self._lock:
+            if path != ":memory:":
+                self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS video_comments (
+                    video_id TEXT NOT NULL,
+                    comment_id TEXT NOT NULL,
+                    published_at TEXT,
+                    text TEXT NOT NULL,
+                    analysis TEXT NOT NULL,
+                    analyzed_at REAL NOT NULL,
+                    prompt_version TEXT,
+                    parent_id TEXT,
+                    PRIMARY KEY (video_id, comment_id)
+                )
+                """
+            )
+            # 版の列が無い古いファイルには列を足す（既存の行は版不明＝使わない扱い）
+            columns = [row[1] for row in self._conn.execute("PRAGMA table_info(video_comments)")]
+            if "prompt_version" not in columns:
+                self._conn.execute("ALTER TABLE video_comments ADD COLUMN prompt_version TEXT")
+            # 返信の親の列が無い古いファイルには列を足す（既存の行は親コメント扱い）
+            if "parent_id" not in columns:
+                self._conn.execute("ALTER TABLE video_comments ADD COLUMN parent_id TEXT")
+            self._conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS videos (
+                    video_id TEXT PRIMARY KEY,
+                    last_refreshed REAL NOT NULL
+                )
+                """
+            )
+            self._conn.commit()
+
+    def load(self, video_id, prompt_version):
+        # 指定した版で分析した結果だけを、新しい順に [{"id", "text", "published_at", "parent_id", "analysis"}, ...] で返す
+        with self._lock:
+            rows = self._conn.execute(
+                """
+                SELECT comment_id, text, published_at, parent_id, analysis FROM video_comments
+                WHERE video_id = ? AND prompt_version = ? ORDER BY published_at DESC
+                """,
+                (video_id, prompt_version),
+            ).fetchall()
+        return [
+            {"id": cid, "text": text, "published_at": published_at, "parent_id": parent_id, "analysis": json.loads(analysis)}
+            for cid, text, published_at, parent_id, analysis in rows
+        ]
+
+    def labelled_items(self, prompt_versions=None):
+        # 全動画の保存結果（ローカルモデルの学習データ用）。prompt_versions を渡すとその版のものだけ
+        query = "SELECT text, analysis, prompt_version FROM video_comments"
+        params = ()
+        if prompt_versions is not None:
+            query += f" WHERE prompt_version IN ({','.join('?' * len(prompt_versions))})"
+            params = tuple(prompt_versions)
+        with self._lock:
+            rows = self._conn.execute(query, params).fetchall()
+        return [
+            {"text": text, "analysis": json.loads(analysis), "prompt_version": version}
+            for text, analysis, version in rows
+        ]
+
+    def save(self, video_id, items, prompt_version):
+        # items: [{"id", "text", "published_at", "parent_id", "analysis"}, ...]（同じIDは上書き）
+        now = time.time()
+        with self._lock:
+            self._conn.executemany(
+                """
+                INSERT OR REPLACE INTO video_comments
+                    (video_id, comment_id, published_at, text, analysis, analyzed_at, prompt_version, parent_id)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                """,
+                [
+                    (video_id, c["id"], c.get("published_at"), c["text"], json.dumps(c["analysis"], ensure_ascii=False), now, prompt_version,
+                     c.get("parent_id"))
+                    for c in items
+                ],
+            )
+            self._conn.execute(
+                "INSERT OR REPLACE INTO videos (video_id, last_refreshed) VALUES (?, ?)", (video_id, now)
+            )
+            self._conn.commit()
+
+    def count(self, video_id, prompt_version):
+        with self._lock:
+            return self._conn.execute(
+                "SELECT COUNT(*) FROM video_comments WHERE video_id = ? AND prompt_version = ?", (video_id, prompt_version)
+            ).fetchone()[0]
+
+    def last_refreshed(self, video_id):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT last_refreshed FROM videos WHERE video_id = ?", (video_id,)
+            ).fetchone()
+        return row[0] if row else None
+
+
+def watermark(items):
+    # 保存済みの親コメントの中で最も新しい投稿日時（ISO 8601 の文字列比較でよい）
+    dates = [c["published_at"] for c in items if c.get("published_at") and not c.get("parent_id")]
+    return max(dates) if dates else None
+
+
+def is_known(comment, known_ids, newest_seen):
+    # 新しい順に読んでいって、ここで打ち切るべき親コメントか（分析済み、または保存済みの最新より古い）
+    # core.iter_comment_pages の until に渡す（打ち切ったスレッドの返信は取得しない）
+    if comment["id"] in known_ids:
+        return True
+    return bool(newest_seen and comment.get("published_at") and comment["published_at"] < newest_seen)
+
+
+def state_from_env():
+    return VideoStateStore(path=os.getenv("VIDEO_STATE_PATH", DEFAULT_STATE_PATH))
@@ -0,0 +1,254 @@
+# -----------------------------------------------------------
+# YouTube Data API のレスポンスキャッシュとクォータ台帳
+# -----------------------------------------------------------
+# キー = リソース名（search / commentThreads ...）+ パラメータ（pageToken 含む）。
+# - TTL内ならAPIを呼ばずに返す（search.list は1回100ユニットなので効果が大きい）
+# - TTLを過ぎていてもETagがあれば If-None-Match で再検証し、304なら保存済みの結果を使う
+# - 消費したユニット数とキャッシュで節約したユニット数を日ごと（太平洋時間）に記録する
+# - 同じリクエストが取得中なら、もう1本は送らずにその結果（キャッシュに入ったもの）を待つ（先読みとの重複を防ぐ）
+# - HTTP の接続はスレッドごとに持つので、別々のリクエストは複数スレッドから同時に取得できる（返信の並列取得など）
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from datetime import datetime
+from zoneinfo import ZoneInfo
+
+DEFAULT_CACHE_PATH = os.path.join(".cache", "youtube_cache.sqlite3")
+DEFAULT_MAX_ENTRIES = 50_000
+EVICT_EVERY = 100
+
+# リソースごとのTTL（秒）
+DEFAULT_TTLS = {
+    "search": 6 * 60 * 60,
+    "commentThreads": 30 * 60,
+    "comments": 30 * 60,
+    "videos": 60 * 60,
+}
+
+# list 1回あたりのクォータ消費量
+QUOTA_COST = {
+    "search": 100,
+    "commentThreads": 1,
+    "comments": 1,
+    "videos": 1,
+}
+
+# YouTube のクォータは太平洋時間の0時にリセットされる
+QUOTA_TZ = ZoneInfo("America/Los_Angeles")
+
+
+class QuotaBudget:
+    # 複数スレッドで分け合うクォータの予算（ユニット数）。取得の前に take() で予約し、足りなければ取りに行かない
+    def __init__(self, units):
+        self.units = units
+        self.spent = 0
+        self._lock = threading.Lock()
+
+    def take(self, resource):
+        cost = QUOTA_COST.get(resource, 1)
+        with self._lock:
+            if self.spent + cost > self.units:
+                return False
+            self.spent += cost
+            return True
+
+
+def make_request_key(resource, params):
+    payload = json.dumps([resource, {k: v for k, v in params.items() if v is not None}], sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def quota_day():
+    return datetime.now(QUOTA_TZ).strftime("%Y-%m-%d")
+
+
+class YouTubeCache:
+    def __init__(self, youtube, path=DEFAULT_CACHE_PATH, ttls=None, max_entries=DEFAULT_MAX_ENTRIES):
+        # youtube はクライアント、またはクライアントを返す関数（キャッシュに無いものを取りに行くまで作らない）
+        self._youtube = youtube
+        self.path = path
+        self.ttls = dict(DEFAULT_TTLS, **(ttls or {}))
+        self.max_entries = max_entries
+        self._writes = 0
+        self._lock = threading.Lock()
+        # googleapiclient（httplib2）の接続はスレッドセーフではないので、スレッドごとに作って使う
+        self._local = threading.local()
+        self._inflight = {}  # 取得中のリクエストのキー -> 取得が終わったら立つ Event
+
+        if path != ":memory:":
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        with self._lock:
+            if path != ":memory:":
+                self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS responses (
+                    key TEXT PRIMARY KEY,
+                    resource TEXT NOT NULL,
+                    body TEXT NOT NULL,
+                    etag TEXT,
+                    fetched_at REAL NOT NULL
+                )
+                """
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS idx_responses_fetched ON responses(fetched_at)")
+            self._conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS quota_ledger (
+                    day TEXT NOT NULL,
+                    resource TEXT NOT NULL,
+                    calls INTEGER NOT NULL DEFAULT 0,
+                    hits INTEGER NOT NULL DEFAULT 0,
+                    revalidated INTEGER NOT NULL DEFAULT 0,
+                    units_spent INTEGER NOT NULL DEFAULT 0,
+                    units_saved INTEGER NOT NULL DEFAULT 0,
+                    PRIMARY KEY (day, resource)
+                )
+                """
+            )
+            self._conn.commit()
+
+    @property
+    def youtube(self):
+        if callable(self._youtube):
+            self._youtube = self._youtube()
+        return self._youtube
+
+    def _http(self):
+        http = getattr(self._local, "http", None)
+        if http is None:
+            from googleapiclient.http import build_http
+
+            http = self._local.http = build_http()
+        return http
+
+    def _record(self, resource, calls=0, hits=0, revalidated=0, spent=0, saved=0):
+        self._conn.execute(
+            """
+            INSERT INTO quota_ledger (day, resource, calls, hits, revalidated, units_spent, units_saved)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT(day, resource) DO UPDATE SET
+                calls = calls + excluded.calls,
+                hits = hits + excluded.hits,
+                revalidated = revalidated + excluded.revalidated,
+                units_spent = units_spent + excluded.units_spent,
+                units_saved = units_saved + excluded.units_saved
+            """,
+            (quota_day(), resource, calls, hits, revalidated, spent, saved),
+        )
+        self._conn.commit()
+
+    def _lookup(self, key):
+        with self._lock:
+            return self._conn.execute(
+                "SELECT body, etag, fetched_at FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+
+    def _store(self, key, resource, body, now):
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO responses (key, resource, body, etag, fetched_at) VALUES (?, ?, ?, ?, ?)",
+                (key, resource, json.dumps(body, ensure_ascii=False), body.get("etag"), now),
+            )
+            self._writes += 1
+            if self._writes % EVICT_EVERY == 0:
+                self._conn.execute(
+                    """
+                    DELETE FROM responses WHERE key IN (
+                        SELECT key FROM responses ORDER BY fetched_at DESC LIMIT -1 OFFSET ?
+                    )
+                    """,
+                    (self.max_entries,),
+                )
+            self._conn.commit()
+
+    def is_fresh(self, resource, max_age=None, **params):
+        # TTL内の結果がキャッシュにあるか（list() がAPIを呼ばずに返せるか）
+        ttl = self.ttls.get(resource, 0) if max_age is None else max_age
+        cached = self._lookup(make_request_key(resource, params))
+        return cached is not None and time.time() - cached[2] <= ttl
+
+    def list(self, resource, max_age=None, **params):
+        # youtube.<resource>().list(**params).execute() のキャッシュ付き版
+        # max_age を指定するとTTLの代わりに使う（0 = 必ず再検証。ETagが一致すれば304で済む）
+        key = make_request_key(resource, params)
+        cost = QUOTA_COST.get(resource, 1)
+        ttl = self.ttls.get(resource, 0) if max_age is None else max_age
+        now = time.time()
+
+        cached = self._lookup(key)
+        if cached is not None and now - cached[2] <= ttl:
+            with self._lock:
+                self._record(resource, hits=1, saved=cost)
+            return json.loads(cached[0])
+
+        with self._lock:
+            pending = self._inflight.get(key)
+            if pending is None:
+                self._inflight[key] = threading.Event()
+        if pending is not None:
+            # 他のスレッド（先読みなど）が取得中。終わるのを待ってからキャッシュを引き直す
+            pending.wait()
+            return self.list(resource, max_age=max_age, **params)
+        try:
+            return self._fetch(key, resource, cost, cached, now, params)
+        finally:
+            with self._lock:
+                self._inflight.pop(key).set()
+
+    def _fetch(self, key, resource, cost, cached, now, params):
+        # googleapiclient はAPIを呼ぶときに初めて読み込む（起動時・キャッシュのヒットだけなら読み込まない）
+        from googleapiclient.errors import HttpError
+
+        try:
+            request = getattr(self.youtube, resource)().list(**params)
+            if cached is not None and cached[1]:
+                request.headers["If-None-Match"] = cached[1]
+            body = request.execute(http=self._http())
+        except HttpError as e:
+            if cached is not None and getattr(e.resp, "status", None) == 304:
+                # 内容が変わっていないので保存済みの結果を延命して使う
+                with self._lock:
+                    self._conn.execute("UPDATE responses SET fetched_at = ? WHERE key = ?", (now, key))
+                    self._record(resource, calls=1, revalidated=1, spent=cost)
+                return json.loads(cached[0])
+            with self._lock:
+                self._record(resource, calls=1, spent=cost)
+            raise
+
+        with self._lock:
+            self._record(resource, calls=1, spent=cost)
+        self._store(key, resource, body, now)
+        return body
+
+    def ledger(self, day=None):
+        # 指定日（省略時は今日）の {"units_spent", "units_saved", "calls", "hits", ...}
+        with self._lock:
+            row = self._conn.execute(
+                """
+                SELECT COALESCE(SUM(calls), 0), COALESCE(SUM(hits), 0), COALESCE(SUM(revalidated), 0),
+                       COALESCE(SUM(units_spent), 0), COALESCE(SUM(units_saved), 0)
+                FROM quota_ledger WHERE day = ?
+                """,
+                (day or quota_day(),),
+            ).fetchone()
+        return {
+            "calls": row[0],
+            "hits": row[1],
+            "revalidated": row[2],
+            "units_spent": row[3],
+            "units_saved": row[4],
+        }
+
+
+def youtube_cache_from_env(youtube):
+    ttls = {}
+    for resource in DEFAULT_TTLS:
+        value = os.getenv(f"YOUTUBE_CACHE_TTL_{resource.upper()}")
+        if value:
+            ttls[resource] = int(value)
+    return YouTubeCache(youtube, path=os.getenv("YOUTUBE_CACHE_PATH", DEFAULT_CACHE_PATH), ttls=ttls)